@@ -84,8 +84,9 @@ class HistoryList(MyTreeWidget, AcceptFileDragDrop):
         self.update_headers(headers)
 
     def get_domain(self):
-        '''Replaced in address_dialog.py'''
-        return self.wallet.get_addresses()
+        '''Replaced in address_dialog.py. None is the whole wallet,
+        which has its history maintained by the wallet.'''
+        return None
 
     def on_combo(self, x):
         s = self.period_combo.itemText(x)
@@ -411,20 +412,9 @@ class HistoryList(MyTreeWidget, AcceptFileDragDrop):
         self.parent.show_message(_("Your wallet history has been successfully exported."))
 
     def do_export_history(self, wallet, fileName, is_csv):
-        history = self.transactions
-        lines = []
-        for item in history:
-            if is_csv:
-                lines.append([item['txid'], item.get('label', ''), item['confirmations'], item['value'], item['date']])
-            else:
-                lines.append(item)
+        # the rows are written as they are computed
+        from electrum.history_export import write_history
+        items = wallet.iter_full_history(domain=self.get_domain(), from_timestamp=self.start_timestamp,
+                                         to_timestamp=self.end_timestamp, fx=self.parent.fx)
         with open(fileName, "w+", encoding='utf-8') as f:
-            if is_csv:
-                import csv
-                transaction = csv.writer(f, lineterminator='\n')
-                transaction.writerow(["transaction_hash","label", "confirmations", "value", "timestamp"])
-                for line in lines:
-                    transaction.writerow(line)
-            else:
-                from electrum.util import json_encode
-                f.write(json_encode(history))
+            write_history(f, items, 'csv' if is_csv else 'json')
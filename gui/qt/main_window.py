@@ -2885,6 +2885,9 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         # Fiat Currency
         hist_checkbox = QCheckBox()
         hist_capgains_checkbox = QCheckBox()
+        cost_basis_combo = QComboBox()
+        cost_basis_methods = [('average', _('Average')), ('fifo', _('First in, first out'))]
+        cost_basis_combo.addItems([x[1] for x in cost_basis_methods])
         fiat_address_checkbox = QCheckBox()
         ccy_combo = QComboBox()
         ex_combo = QComboBox()
@@ -2910,6 +2913,10 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             if not self.fx: return
             hist_capgains_checkbox.setChecked(self.fx.get_history_capital_gains_config())
             hist_capgains_checkbox.setEnabled(hist_checkbox.isChecked())
+            methods = [x[0] for x in cost_basis_methods]
+            method = self.fx.get_cost_basis_method()
+            cost_basis_combo.setCurrentIndex(methods.index(method) if method in methods else 0)
+            cost_basis_combo.setEnabled(hist_checkbox.isChecked() and hist_capgains_checkbox.isChecked())
 
         def update_exchanges():
             if not self.fx: return
@@ -2955,6 +2962,12 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             if not self.fx: return
             self.fx.set_history_capital_gains_config(checked)
             self.history_list.refresh_headers()
+            update_history_capgains_cb()
+
+        def on_cost_basis(idx):
+            if not self.fx: return
+            self.fx.set_cost_basis_method(cost_basis_methods[idx][0])
+            self.history_list.update()
 
         def on_fiat_address(checked):
             if not self.fx: return
@@ -2970,6 +2983,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         ccy_combo.currentIndexChanged.connect(on_currency)
         hist_checkbox.stateChanged.connect(on_history)
         hist_capgains_checkbox.stateChanged.connect(on_history_capgains)
+        cost_basis_combo.currentIndexChanged.connect(on_cost_basis)
         fiat_address_checkbox.stateChanged.connect(on_fiat_address)
         ex_combo.currentIndexChanged.connect(on_exchange)
 
@@ -2977,6 +2991,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         fiat_widgets.append((QLabel(_('Fiat currency')), ccy_combo))
         fiat_widgets.append((QLabel(_('Show history rates')), hist_checkbox))
         fiat_widgets.append((QLabel(_('Show capital gains in history')), hist_capgains_checkbox))
+        fiat_widgets.append((QLabel(_('Cost basis')), cost_basis_combo))
         fiat_widgets.append((QLabel(_('Show Fiat balance for addresses')), fiat_address_checkbox))
         fiat_widgets.append((QLabel(_('Source')), ex_combo))
 
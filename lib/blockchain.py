@@ -21,15 +21,37 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import gzip
+import hashlib
+import json
+import mmap
+import struct
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 from . import util
-from .bitcoin import Hash, hash_encode, int_to_hex, rev_hex
+from .bitcoin import Hash, hash_decode, hash_encode, int_to_hex, rev_hex
 from . import constants
 from .util import bfh, bh2u
 
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
 
+# Headers appended with save_header are fsynced in groups: at most every
+# SYNC_MAX_HEADERS headers or SYNC_INTERVAL seconds, and whenever sync()
+# is called. Anything newer than that is re-verified on startup.
+SYNC_MAX_HEADERS = 500
+SYNC_INTERVAL = 1.0
+
+# number of recently saved headers kept in the hash -> (chain, height) map
+RECENT_HASHES = 2016
+
+NULL_HASH = bytes(32)
+
+# block size used when copying headers between files
+COPY_BLOCK_SIZE = 2016 * 80
+
 
 class MissingHeader(Exception):
     pass
@@ -49,29 +71,210 @@ def deserialize_header(s, height):
         raise Exception('Invalid header: {}'.format(s))
     if len(s) != 80:
         raise Exception('Invalid header length: {}'.format(len(s)))
-    hex_to_int = lambda s: int('0x' + bh2u(s[::-1]), 16)
+    hex_to_int = lambda s: int.from_bytes(s, 'little')
     h = {}
     h['version'] = hex_to_int(s[0:4])
-    h['prev_block_hash'] = hash_encode(s[4:36])
-    h['merkle_root'] = hash_encode(s[36:68])
+    h['prev_block_hash'] = hash_encode(bytes(s[4:36]))
+    h['merkle_root'] = hash_encode(bytes(s[36:68]))
     h['timestamp'] = hex_to_int(s[68:72])
     h['bits'] = hex_to_int(s[72:76])
     h['nonce'] = hex_to_int(s[76:80])
     h['block_height'] = height
     return h
 
+
+class Header(object):
+    """
+    A block header, parsed from its 80 byte serialization.
+
+    The raw bytes are kept, so that the header hash is computed at most
+    once and the header can be written back without re-serializing it.
+    Read-only dict-style access (header['bits'], header.get('bits')) is
+    supported for code written against the output of deserialize_header.
+    """
+    __slots__ = ('raw', 'block_height', 'version', 'timestamp', 'bits', 'nonce', '_hash')
+
+    FIELDS = ('version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits', 'nonce', 'block_height')
+    _struct = struct.Struct('<I32x32xIII')
+
+    def __init__(self, raw, height):
+        if len(raw) != 80:
+            raise Exception('Invalid header length: {}'.format(len(raw)))
+        self.raw = bytes(raw)
+        self.block_height = height
+        self.version, self.timestamp, self.bits, self.nonce = self._struct.unpack_from(self.raw)
+        self._hash = None
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get('prev_block_hash') is None:
+            d = dict(d, prev_block_hash='00'*32)
+        return cls(bfh(serialize_header(d)), d.get('block_height'))
+
+    @property
+    def prev_block_hash(self):
+        return hash_encode(self.raw[4:36])
+
+    @property
+    def merkle_root(self):
+        return hash_encode(self.raw[36:68])
+
+    def hash_bytes(self):
+        """double-SHA256 of the header, in internal byte order"""
+        if self._hash is None:
+            self._hash = Hash(self.raw)
+        return self._hash
+
+    def hash(self):
+        return hash_encode(self.hash_bytes())
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def __eq__(self, other):
+        if isinstance(other, Header):
+            return self.raw == other.raw and self.block_height == other.block_height
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.raw)
+
+    def __repr__(self):
+        return '<Header %d %s>' % (self.block_height, self.hash())
+
+
 def hash_header(header):
     if header is None:
         return '0' * 64
+    if isinstance(header, Header):
+        return header.hash()
     if header.get('prev_block_hash') is None:
         header['prev_block_hash'] = '00'*32
     return hash_encode(Hash(bfh(serialize_header(header))))
 
 
+def verify_chunk_data(data, prev_hash, target, bits, check_pow, first_height=0):
+    """
+    Verifies a chunk of raw headers: every header must link to the
+    previous one and, if check_pow is set, carry the given bits and meet
+    target. prev_hash is the hash (internal byte order) the first header
+    must link to, or None to only check the links inside the chunk.
+    Returns the concatenated hashes of the headers.
+
+    Works on the raw buffer without building Header objects, and only
+    depends on its arguments, so that it can run in a worker process.
+    """
+    if len(data) % 80:
+        raise Exception('Invalid chunk length: {}'.format(len(data)))
+    mv = memoryview(data)
+    sha256 = hashlib.sha256
+    from_bytes = int.from_bytes
+    hashes = bytearray()
+    for offset in range(0, len(data), 80):
+        raw = mv[offset:offset+80]
+        if prev_hash is not None and raw[4:36] != prev_hash:
+            raise Exception("prev hash mismatch at height %d" % (first_height + offset // 80))
+        _hash = sha256(sha256(raw).digest()).digest()
+        if check_pow:
+            if from_bytes(raw[72:76], 'little') != bits:
+                raise Exception("bits mismatch at height %d" % (first_height + offset // 80))
+            if from_bytes(_hash, 'little') > target:
+                raise Exception("insufficient proof of work at height %d" % (first_height + offset // 80))
+        hashes += _hash
+        prev_hash = _hash
+    return bytes(hashes)
+
+def _verify_chunk_data_star(args):
+    return verify_chunk_data(*args)
+
+def copy_file_range(src, dst, size=None):
+    """Copies size bytes (or up to EOF) from src to dst, in blocks."""
+    while size is None or size > 0:
+        n = COPY_BLOCK_SIZE if size is None else min(size, COPY_BLOCK_SIZE)
+        data = src.read(n)
+        if not data:
+            break
+        dst.write(data)
+        if size is not None:
+            size -= len(data)
+
+def root_from_merkle_branch(hash_bytes, branch, index):
+    """merkle root for the leaf hash at index, branch and root in
+    internal byte order"""
+    for item in branch:
+        hash_bytes = Hash(item + hash_bytes) if index & 1 else Hash(hash_bytes + item)
+        index >>= 1
+    return hash_bytes
+
+def merkle_branch_and_root(hashes, index):
+    """branch and root of the merkle tree over hashes for the leaf at
+    index, with odd levels padded by duplicating their last hash"""
+    branch = []
+    while len(hashes) > 1:
+        if len(hashes) & 1:
+            hashes = hashes + [hashes[-1]]
+        branch.append(hashes[index ^ 1])
+        hashes = [Hash(hashes[i] + hashes[i+1]) for i in range(0, len(hashes), 2)]
+        index >>= 1
+    return branch, hashes[0]
+
+
 blockchains = {}
+# header hash (internal byte order) -> (Blockchain, height), for recent blocks
+recent_hashes = OrderedDict()
+
+def add_recent_hash(hash_bytes, chain, height):
+    recent_hashes[hash_bytes] = (chain, height)
+    recent_hashes.move_to_end(hash_bytes)
+    while len(recent_hashes) > RECENT_HASHES:
+        recent_hashes.popitem(last=False)
+
+def swap_marker_path(config):
+    return os.path.join(util.get_headers_dir(config), 'swap_marker')
+
+def rollback_interrupted_swap(config):
+    """Blockchain.swap_with_parent rewrites the parent file in place
+    after saving the replaced branch to a temporary file, and records
+    both in a marker. If the temporary file has not replaced the fork
+    file, the swap was interrupted: the fork file is still intact, and
+    the parent branch is restored from the temporary file."""
+    path = swap_marker_path(config)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            marker = json.loads(f.read())
+    except FileNotFoundError:
+        return
+    except BaseException as e:
+        util.print_error('cannot read swap marker', str(e))
+        os.remove(path)
+        return
+    d = util.get_headers_dir(config)
+    tmp_path = os.path.join(d, marker['tmp'])
+    if os.path.exists(tmp_path):
+        util.print_error('rolling back interrupted swap of', marker['parent'])
+        with open(tmp_path, 'rb') as src, open(os.path.join(d, marker['parent']), 'rb+') as dst:
+            dst.seek(marker['offset'])
+            dst.truncate()
+            copy_file_range(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.remove(tmp_path)
+    os.remove(path)
 
 def read_blockchains(config):
+    rollback_interrupted_swap(config)
     blockchains[0] = Blockchain(config, 0, None)
+    blockchains[0].verify_tail()
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     util.make_dir(fdir)
     l = filter(lambda x: x.startswith('fork_'), os.listdir(fdir))
@@ -83,13 +286,21 @@ def read_blockchains(config):
         h = b.read_header(b.checkpoint)
         if b.parent().can_connect(h, check_height=False):
             blockchains[b.checkpoint] = b
+            b.verify_tail()
         else:
             util.print_error("cannot connect", filename)
     return blockchains
 
 def check_header(header):
-    if type(header) is not dict:
+    if not isinstance(header, (Header, dict)):
         return False
+    if not isinstance(header, Header):
+        header = Header.from_dict(header)
+    entry = recent_hashes.get(header.hash_bytes())
+    if entry is not None:
+        b, height = entry
+        if height == header.block_height and b.check_header(header):
+            return b
     for b in blockchains.values():
         if b.check_header(header):
             return b
@@ -114,6 +325,15 @@ class Blockchain(util.PrintError):
         self.checkpoints = constants.net.CHECKPOINTS
         self.parent_id = parent_id
         self.lock = threading.Lock()
+        self._mmap = None
+        self._hashes = bytearray()  # height -> header hash, 32 bytes each; zeros if not computed yet
+        self._unsynced = 0  # number of appended headers not yet fsynced
+        self._last_sync = time.time()
+        # chunk index -> (hash of the last header of the chunk, target)
+        self._targets = {}
+        self._targets_dirty = False
+        if parent_id is None:
+            self.load_targets()
         with self.lock:
             self.update_size()
 
@@ -135,9 +355,12 @@ class Blockchain(util.PrintError):
         return self.get_hash(self.get_checkpoint()).lstrip('00')[0:10]
 
     def check_header(self, header):
-        header_hash = hash_header(header)
-        height = header.get('block_height')
-        return header_hash == self.get_hash(height)
+        if not isinstance(header, Header):
+            header = Header.from_dict(header)
+        height = header.block_height
+        if height < len(self.checkpoints) * 2016:
+            return header.hash() == self.get_hash(height)
+        return header.hash_bytes() == self.get_hash_bytes(height)
 
     def fork(parent, header):
         checkpoint = header.get('block_height')
@@ -154,44 +377,152 @@ class Blockchain(util.PrintError):
             return self._size
 
     def update_size(self):
+        # the file may have grown or shrunk: drop the current mapping,
+        # it is recreated on the next read
+        self.close_mmap()
         p = self.path()
         self._size = os.path.getsize(p)//80 if os.path.exists(p) else 0
+        self._resize_hash_index()
+
+    def _resize_hash_index(self):
+        n = self._size * 32
+        if len(self._hashes) > n:
+            del self._hashes[n:]
+        else:
+            self._hashes.extend(bytes(n - len(self._hashes)))
+
+    def close_mmap(self):
+        # must be called with self.lock held
+        mm, self._mmap = self._mmap, None
+        if mm is None:
+            return
+        try:
+            mm.close()
+        except BufferError:
+            # a caller still holds a memoryview of the old mapping;
+            # it will be unmapped once that view is released
+            pass
+
+    def get_mmap(self):
+        # must be called with self.lock held
+        if self._mmap is None:
+            name = self.path()
+            self.assert_headers_file_available(name)
+            with open(name, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    # empty files cannot be mapped
+                    return None
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
 
     def verify_header(self, header, prev_hash, target):
-        _hash = hash_header(header)
-        if prev_hash != header.get('prev_block_hash'):
-            raise Exception("prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash')))
+        if not isinstance(header, Header):
+            header = Header.from_dict(header)
+        if prev_hash != header.prev_block_hash:
+            raise Exception("prev hash mismatch: %s vs %s" % (prev_hash, header.prev_block_hash))
         if constants.net.TESTNET:
             return
         bits = self.target_to_bits(target)
-        if bits != header.get('bits'):
-            raise Exception("bits mismatch: %s vs %s" % (bits, header.get('bits')))
-        if int('0x' + _hash, 16) > target:
-            raise Exception("insufficient proof of work: %s vs target %s" % (int('0x' + _hash, 16), target))
+        if bits != header.bits:
+            raise Exception("bits mismatch: %s vs %s" % (bits, header.bits))
+        _hash = int.from_bytes(header.hash_bytes(), 'little')
+        if _hash > target:
+            raise Exception("insufficient proof of work: %s vs target %s" % (_hash, target))
 
     def verify_chunk(self, index, data):
-        num = len(data) // 80
-        prev_hash = self.get_hash(index * 2016 - 1)
+        """Returns the hashes of the headers in the chunk."""
+        prev_hash = hash_decode(self.get_hash(index * 2016 - 1))
+        check_pow = not constants.net.TESTNET
         target = self.get_target(index-1)
-        for i in range(num):
-            raw_header = data[i*80:(i+1) * 80]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target)
-            prev_hash = hash_header(header)
+        bits = self.target_to_bits(target) if check_pow else 0
+        hashes = verify_chunk_data(data, prev_hash, target, bits, check_pow, index * 2016)
+        self.check_chunk_checkpoint(index, hashes)
+        return hashes
+
+    def check_chunk_checkpoint(self, index, hashes):
+        if index < len(self.checkpoints) and len(hashes) == 2016 * 32:
+            h, t = self.checkpoints[index]
+            if hash_encode(hashes[-32:]) != h:
+                raise Exception("chunk %d does not match checkpoint" % index)
+
+    def verify_chunks(self, index, chunks, processes=None):
+        """
+        Verifies consecutive chunks, starting at chunk index. The headers
+        of each chunk are checked on a pool of worker processes if
+        processes > 1; links between chunks are then checked in order.
+        Returns a list of (chunk, hashes) for the chunks that verified,
+        stopping at the first chunk that does not.
+        """
+        check_pow = not constants.net.TESTNET
+        jobs = []
+        for i, data in enumerate(chunks):
+            idx = index + i
+            if not check_pow:
+                target = 0
+            elif i == 0 or idx - 1 < len(self.checkpoints):
+                target = self.get_target(idx - 1)
+            else:
+                # the retarget only depends on the previous chunk
+                prev_data = chunks[i - 1]
+                if len(prev_data) != 2016 * 80:
+                    break
+                target = self.retarget(Header(prev_data[:80], (idx-1) * 2016),
+                                       Header(prev_data[-80:], idx * 2016 - 1))
+            bits = self.target_to_bits(target) if check_pow else 0
+            jobs.append((data, None, target, bits, check_pow, idx * 2016))
+        if processes and processes > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(processes) as executor:
+                futures = [executor.submit(_verify_chunk_data_star, job) for job in jobs]
+                results = []
+                for f in futures:
+                    try:
+                        results.append(f.result())
+                    except Exception as e:
+                        results.append(e)
+        else:
+            results = []
+            for job in jobs:
+                try:
+                    results.append(_verify_chunk_data_star(job))
+                except Exception as e:
+                    results.append(e)
+        out = []
+        prev_hash = hash_decode(self.get_hash(index * 2016 - 1))
+        for i, hashes in enumerate(results):
+            data = chunks[i]
+            if isinstance(hashes, Exception):
+                self.print_error('verify_chunk %d failed' % (index + i), str(hashes))
+                break
+            if data[4:36] != prev_hash:
+                self.print_error('verify_chunk %d failed' % (index + i), 'prev hash mismatch')
+                break
+            try:
+                self.check_chunk_checkpoint(index + i, hashes)
+            except Exception as e:
+                self.print_error('verify_chunk %d failed' % (index + i), str(e))
+                break
+            out.append((data, hashes))
+            prev_hash = hashes[-32:]
+        return out
 
     def path(self):
         d = util.get_headers_dir(self.config)
         filename = 'blockchain_headers' if self.parent_id is None else os.path.join('forks', 'fork_%d_%d'%(self.parent_id, self.checkpoint))
         return os.path.join(d, filename)
 
-    def save_chunk(self, index, chunk):
+    def save_chunk(self, index, chunk, hashes=None):
         filename = self.path()
         d = (index * 2016 - self.checkpoint) * 80
         if d < 0:
             chunk = chunk[-d:]
+            if hashes is not None:
+                hashes = hashes[(-d)//80*32:]
             d = 0
         truncate = index >= len(self.checkpoints)
         self.write(chunk, d, truncate)
+        if hashes is not None:
+            with self.lock:
+                self._hashes[d//80*32:d//80*32 + len(hashes)] = hashes
         self.swap_with_parent()
 
     def swap_with_parent(self):
@@ -204,22 +535,57 @@ class Blockchain(util.PrintError):
         parent_id = self.parent_id
         checkpoint = self.checkpoint
         parent = self.parent()
+        delta = checkpoint - parent.checkpoint
         self.assert_headers_file_available(self.path())
-        with open(self.path(), 'rb') as f:
-            my_data = f.read()
         self.assert_headers_file_available(parent.path())
-        with open(parent.path(), 'rb') as f:
-            f.seek((checkpoint - parent.checkpoint)*80)
-            parent_data = f.read(parent_branch_size*80)
-        self.write(parent_data, 0)
-        parent.write(my_data, (checkpoint - parent.checkpoint)*80)
-        # store file path
-        for b in blockchains.values():
-            b.old_path = b.path()
-        # swap parameters
-        self.parent_id = parent.parent_id; parent.parent_id = parent_id
-        self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
-        self._size = parent._size; parent._size = parent_branch_size
+        # Only the two branches after the fork point are copied, in
+        # blocks of COPY_BLOCK_SIZE bytes. The parent branch goes to a
+        # temporary file that then replaces our fork file, so the files
+        # end up exchanged without holding either branch in memory.
+        # The parent file is rewritten in place; until our fork file is
+        # replaced, a marker lets rollback_interrupted_swap undo that.
+        tmp_path = os.path.join(os.path.dirname(self.path()), 'swap_tmp')
+        headers_dir = util.get_headers_dir(self.config)
+        marker_path = swap_marker_path(self.config)
+        marker = {
+            'parent': os.path.relpath(parent.path(), headers_dir),
+            'offset': delta*80,
+            'tmp': os.path.relpath(tmp_path, headers_dir),
+        }
+        with parent.lock, self.lock:
+            parent.close_mmap()
+            self.close_mmap()
+            with open(parent.path(), 'rb') as src, open(tmp_path, 'wb') as dst:
+                src.seek(delta*80)
+                copy_file_range(src, dst, parent_branch_size*80)
+                dst.flush()
+                os.fsync(dst.fileno())
+            with open(marker_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(json.dumps(marker))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(marker_path + '.tmp', marker_path)
+            with open(self.path(), 'rb') as src, open(parent.path(), 'rb+') as dst:
+                dst.seek(delta*80)
+                dst.truncate()
+                copy_file_range(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp_path, self.path())
+            os.remove(marker_path)
+            # store file path
+            for b in blockchains.values():
+                b.old_path = b.path()
+            # swap parameters
+            self.parent_id = parent.parent_id; parent.parent_id = parent_id
+            self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
+            # the two chains have exchanged their files
+            self._hashes, parent._hashes = parent._hashes[:delta*32] + self._hashes, parent._hashes[delta*32:]
+            for b in [self, parent]:
+                b.update_size()
+                b._unsynced = 0
+                b._targets.clear()
+                b._targets_dirty = True
         # move files
         for b in blockchains.values():
             if b in [self, parent]: continue
@@ -238,10 +604,12 @@ class Blockchain(util.PrintError):
         else:
             raise FileNotFoundError('Cannot find headers file but headers_dir is there. Should be at {}'.format(path))
 
-    def write(self, data, offset, truncate=True):
+    def write(self, data, offset, truncate=True, sync=True):
         filename = self.path()
         with self.lock:
             self.assert_headers_file_available(filename)
+            # some platforms cannot truncate a file that is mapped
+            self.close_mmap()
             with open(filename, 'rb+') as f:
                 if truncate and offset != self._size*80:
                     f.seek(offset)
@@ -249,15 +617,93 @@ class Blockchain(util.PrintError):
                 f.seek(offset)
                 f.write(data)
                 f.flush()
-                os.fsync(f.fileno())
+                # forget hashes of overwritten headers
+                start = offset//80*32
+                if truncate:
+                    del self._hashes[start:]
+                else:
+                    end = start + len(data)//80*32
+                    self._hashes[start:end] = bytes(len(self._hashes[start:end]))
+                # and of the targets computed from them; a chunk target
+                # depends on the headers of that chunk only
+                first_height = self.checkpoint + offset//80
+                if truncate:
+                    overlaps = lambda i: i*2016 + 2015 >= first_height
+                else:
+                    last_height = first_height + len(data)//80 - 1
+                    overlaps = lambda i: i*2016 + 2015 >= first_height and i*2016 <= last_height
+                for index in [i for i in self._targets if overlaps(i)]:
+                    del self._targets[index]
+                    self._targets_dirty = True
+                self._unsynced += len(data) // 80
+                if (sync or self._unsynced >= SYNC_MAX_HEADERS
+                        or time.time() - self._last_sync >= SYNC_INTERVAL):
+                    self._fsync(f)
             self.update_size()
 
+    def _fsync(self, f):
+        os.fsync(f.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def sync(self):
+        """Makes headers appended by save_header durable."""
+        with self.lock:
+            if self._unsynced:
+                filename = self.path()
+                self.assert_headers_file_available(filename)
+                with open(filename, 'rb+') as f:
+                    self._fsync(f)
+        self.save_targets()
+
+    def targets_path(self):
+        return os.path.join(util.get_headers_dir(self.config), 'blockchain_targets')
+
+    def load_targets(self):
+        # entries are checked against our headers when they are used
+        try:
+            with open(self.targets_path(), 'r', encoding='utf-8') as f:
+                d = json.loads(f.read())
+            self._targets = {int(k): (bfh(v[0]), int(v[1])) for k, v in d.items()}
+        except FileNotFoundError:
+            pass
+        except BaseException as e:
+            self.print_error('cannot load targets', str(e))
+
+    def save_targets(self):
+        # only the main chain persists its targets
+        if self.parent_id is not None or not self._targets_dirty:
+            return
+        with self.lock:
+            d = {str(k): [bh2u(v[0]), v[1]] for k, v in self._targets.items()}
+            self._targets_dirty = False
+        path = self.targets_path()
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(json.dumps(d))
+        os.replace(path + '.tmp', path)
+
+    def verify_tail(self):
+        """Headers written since the last group commit may have been
+        lost or torn by a crash. Re-verify them and truncate the file
+        at the first header that does not connect."""
+        start = max(self.checkpoint, len(self.checkpoints) * 2016,
+                    self.height() - SYNC_MAX_HEADERS + 1)
+        for height in range(start, self.height() + 1):
+            if not self.can_connect(self.read_header(height), check_height=False):
+                self.print_error("truncating unverified headers from", height)
+                self.write(b'', (height - self.checkpoint) * 80)
+                return
+
     def save_header(self, header):
         delta = header.get('block_height') - self.checkpoint
-        data = bfh(serialize_header(header))
+        data = header.raw if isinstance(header, Header) else bfh(serialize_header(header))
         assert delta == self.size()
         assert len(data) == 80
-        self.write(data, delta*80)
+        self.write(data, delta*80, sync=False)
+        if isinstance(header, Header):
+            with self.lock:
+                self._hashes[delta*32:(delta+1)*32] = header.hash_bytes()
+            add_recent_hash(header.hash_bytes(), self, header.block_height)
         self.swap_with_parent()
 
     def read_header(self, height):
@@ -268,17 +714,24 @@ class Blockchain(util.PrintError):
             return self.parent().read_header(height)
         if height > self.height():
             return
-        delta = height - self.checkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * 80)
-            h = f.read(80)
-            if len(h) < 80:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        h = self.read_raw_header(height)
         if h == bytes([0])*80:
             return None
-        return deserialize_header(h, height)
+        return Header(h, height)
+
+    def read_raw_header(self, height):
+        """Returns the 80 bytes of the header at height as a memoryview
+        of the mapped headers file. The caller must not keep the view
+        around, as it pins the current mapping."""
+        if height < self.checkpoint:
+            return self.parent().read_raw_header(height)
+        delta = height - self.checkpoint
+        with self.lock:
+            mm = self.get_mmap()
+            h = memoryview(mm)[delta*80:(delta+1)*80] if mm is not None else b''
+        if len(h) < 80:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        return h
 
     def get_hash(self, height):
         if height == -1:
@@ -291,7 +744,28 @@ class Blockchain(util.PrintError):
             h, t = self.checkpoints[index]
             return h
         else:
-            return hash_header(self.read_header(height))
+            return hash_encode(self.get_hash_bytes(height))
+
+    def get_hash_bytes(self, height):
+        """Hash of the header at height in internal byte order, or
+        NULL_HASH if we do not have it. Served from the hash index,
+        which is filled lazily from the headers file."""
+        if height < self.checkpoint:
+            return self.parent().get_hash_bytes(height)
+        delta = height - self.checkpoint
+        with self.lock:
+            if delta >= self._size:
+                return NULL_HASH
+            h = bytes(self._hashes[delta*32:(delta+1)*32])
+            if h != NULL_HASH:
+                return h
+            mm = self.get_mmap()
+            raw = mm[delta*80:(delta+1)*80]
+            if raw == bytes(80):
+                return NULL_HASH
+            h = Hash(raw)
+            self._hashes[delta*32:(delta+1)*32] = h
+            return h
 
     def get_target(self, index):
         # compute target from chunk x, used in chunk x+1
@@ -302,14 +776,32 @@ class Blockchain(util.PrintError):
         if index < len(self.checkpoints):
             h, t = self.checkpoints[index]
             return t
+        last_height = index * 2016 + 2015
+        if last_height < self.checkpoint:
+            return self.parent().get_target(index)
+        # a cached target is valid as long as the chunk ends with the same header
+        last_hash = self.get_hash_bytes(last_height)
+        if last_hash == NULL_HASH:
+            raise MissingHeader()
+        cached = self._targets.get(index)
+        if cached is not None and cached[0] == last_hash:
+            return cached[1]
         # new target
         first = self.read_header(index * 2016)
-        last = self.read_header(index * 2016 + 2015)
+        last = self.read_header(last_height)
         if not first or not last:
             raise MissingHeader()
-        bits = last.get('bits')
+        target = self.retarget(first, last)
+        with self.lock:
+            self._targets[index] = (last_hash, target)
+            self._targets_dirty = True
+        return target
+
+    def retarget(self, first, last):
+        """target of the chunk following the one from first to last"""
+        bits = last.bits
         target = self.bits_to_target(bits)
-        nActualTimespan = last.get('timestamp') - first.get('timestamp')
+        nActualTimespan = last.timestamp - first.timestamp
         nTargetTimespan = 14 * 24 * 60 * 60
         nActualTimespan = max(nActualTimespan, nTargetTimespan // 4)
         nActualTimespan = min(nActualTimespan, nTargetTimespan * 4)
@@ -338,7 +830,9 @@ class Blockchain(util.PrintError):
     def can_connect(self, header, check_height=True):
         if header is None:
             return False
-        height = header['block_height']
+        if not isinstance(header, Header):
+            header = Header.from_dict(header)
+        height = header.block_height
         if check_height and self.height() != height - 1:
             #self.print_error("cannot connect at height", height)
             return False
@@ -348,7 +842,7 @@ class Blockchain(util.PrintError):
             prev_hash = self.get_hash(height - 1)
         except:
             return False
-        if prev_hash != header.get('prev_block_hash'):
+        if prev_hash != header.prev_block_hash:
             return False
         try:
             target = self.get_target(height // 2016 - 1)
@@ -363,14 +857,137 @@ class Blockchain(util.PrintError):
     def connect_chunk(self, idx, hexdata):
         try:
             data = bfh(hexdata)
-            self.verify_chunk(idx, data)
+            hashes = self.verify_chunk(idx, data)
             #self.print_error("validated chunk %d" % idx)
-            self.save_chunk(idx, data)
+            self.save_chunk(idx, data, hashes)
             return True
         except BaseException as e:
             self.print_error('verify_chunk %d failed'%idx, str(e))
             return False
 
+    def connect_chunks(self, idx, chunks, processes=None):
+        """Verifies consecutive raw chunks, possibly in parallel, and
+        saves them in order. Returns the number of chunks saved."""
+        try:
+            verified = self.verify_chunks(idx, chunks, processes)
+        except BaseException as e:
+            self.print_error('verify_chunks %d failed'%idx, str(e))
+            return 0
+        for i, (data, hashes) in enumerate(verified):
+            self.save_chunk(idx + i, data, hashes)
+        return len(verified)
+
+    def checkpoint_height(self):
+        """height of the last header covered by the checkpoints"""
+        return len(self.checkpoints) * 2016 - 1
+
+    def get_checkpoint_merkle_root(self):
+        """Merkle root of the hashes of all headers covered by the
+        checkpoints, for use as cp_height root. Needs all of them."""
+        cp_height = self.checkpoint_height()
+        hashes = []
+        for height in range(cp_height + 1):
+            h = self.get_hash_bytes(height)
+            if h == NULL_HASH:
+                raise MissingHeader(height)
+            hashes.append(h)
+        return hash_encode(merkle_branch_and_root(hashes, 0)[1])
+
+    def connect_checkpointed_header(self, height, result, cp_root):
+        """Verifies a header below the checkpoints with the merkle proof
+        returned by blockchain.block.header(height, cp_height), against
+        the trusted root cp_root. The header is stored at its height in
+        the sparse part of the headers file, so that single headers can
+        be fetched instead of whole chunks."""
+        try:
+            assert self.parent_id is None
+            if not 0 <= height <= self.checkpoint_height():
+                raise Exception('height %d not below checkpoint' % height)
+            header = Header(bfh(result['header']), height)
+            if result.get('root') != cp_root:
+                raise Exception('unexpected checkpoint root {}'.format(result.get('root')))
+            branch = [hash_decode(x) for x in result['branch']]
+            if hash_encode(root_from_merkle_branch(header.hash_bytes(), branch, height)) != cp_root:
+                raise Exception('invalid merkle branch for header %d' % height)
+            delta = height - self.checkpoint
+            self.write(header.raw, delta*80, truncate=False)
+            with self.lock:
+                self._hashes[delta*32:(delta+1)*32] = header.hash_bytes()
+            return True
+        except BaseException as e:
+            self.print_error('checkpointed header %d failed' % height, str(e))
+            return False
+
+    def init_headers_file(self):
+        # the headers covered by checkpoints are downloaded on demand,
+        # into a sparse file
+        filename = self.path()
+        length = 80 * len(self.checkpoints) * 2016
+        if not os.path.exists(filename) or os.path.getsize(filename) < length:
+            with open(filename, 'wb') as f:
+                if length>0:
+                    f.seek(length-1)
+                    f.write(b'\x00')
+        with self.lock:
+            self.update_size()
+
+    def export_headers(self, path):
+        """Writes our headers, from genesis up to the first missing one,
+        to a gzip compressed snapshot. Returns the number of headers."""
+        assert self.parent_id is None
+        n = 0
+        self.assert_headers_file_available(self.path())
+        with open(self.path(), 'rb') as src, gzip.open(path, 'wb') as dst:
+            while True:
+                data = src.read(2016 * 80)
+                data = data[:len(data) - len(data) % 80]
+                for offset in range(0, len(data), 80):
+                    if data[offset:offset+80] == bytes(80):
+                        data = data[:offset]
+                        break
+                dst.write(data)
+                n += len(data) // 80
+                if len(data) < 2016 * 80:
+                    break
+        return n
+
+    def import_headers(self, path, processes=None):
+        """Streams headers from a snapshot created by export_headers into
+        our headers file. Chunks are verified against the checkpoints and
+        proof of work as they are read, processes chunks at a time.
+        Headers beyond the checkpoints are only imported if they extend
+        our chain. Returns our height."""
+        assert self.parent_id is None
+        self.init_headers_file()
+        batch_size = max(1, processes or 1)
+        index = 0
+        with gzip.open(path, 'rb') as f:
+            while True:
+                chunks = []
+                for i in range(batch_size):
+                    data = f.read(2016 * 80)
+                    if data:
+                        chunks.append(data)
+                    if len(data) < 2016 * 80:
+                        break
+                # skip what we already have after the checkpoints
+                while chunks and index >= len(self.checkpoints) \
+                        and self.height() >= index * 2016 + len(chunks[0]) // 80 - 1:
+                    index += 1
+                    chunks.pop(0)
+                if not chunks:
+                    if len(data) < 2016 * 80:
+                        break
+                    continue
+                n = self.connect_chunks(index, chunks, processes)
+                if n < len(chunks):
+                    raise Exception('invalid headers in chunk %d' % (index + n))
+                index += n
+                if len(chunks[-1]) < 2016 * 80:
+                    break
+        self.sync()
+        return self.height()
+
     def get_checkpoints(self):
         # for each chunk, store the hash of the last block and the target after the chunk
         cp = []
@@ -285,6 +285,20 @@ class Commands:
         domain = address
         return [self.wallet.export_private_key(address, password)[0] for address in domain]
 
+    @command('w')
+    def getstoragestats(self):
+        """Wallet file write statistics: number of writes, bytes written,
+        total and maximum write time in seconds, and the number of writes
+        that were coalesced with a pending one."""
+        return self.wallet.storage.get_write_stats()
+
+    @command('w')
+    def convert(self, file_format):
+        """Convert the wallet file to another format: json, binary or
+        sqlite. Binary and sqlite wallet files cannot be encrypted."""
+        self.wallet.storage.convert_format(file_format)
+        return True
+
     @command('w')
     def ismine(self, address):
         """Check if address is in wallet. Return true if and only address is in wallet"""
@@ -446,9 +460,13 @@ class Commands:
         return tx.as_dict()
 
     @command('w')
-    def history(self, year=None, show_addresses=False, show_fiat=False):
-        """Wallet history. Returns the transaction history of your wallet."""
-        kwargs = {'show_addresses': show_addresses}
+    def history(self, year=None, show_addresses=False, show_fiat=False, offset=0, limit=None,
+                export_path=None, export_format='jsonl'):
+        """Wallet history. Returns the transaction history of your wallet.
+        Use offset and limit to get one page of it. With export_path, the
+        history is written to that file as it is computed, and only the
+        summary is returned."""
+        kwargs = {'show_addresses': show_addresses, 'offset': offset, 'limit': limit}
         if year:
             import time
             start_date = datetime.datetime(year, 1, 1)
@@ -459,6 +477,15 @@ class Commands:
             from .exchange_rate import FxThread
             fx = FxThread(self.config, None)
             kwargs['fx'] = fx
+        if export_path:
+            from .history_export import write_history, EXPORT_FORMATS
+            if export_format not in EXPORT_FORMATS:
+                raise Exception('unknown export format: {}'.format(export_format))
+            summary = {}
+            with open(export_path, 'w', encoding='utf-8') as f:
+                count = write_history(f, self.wallet.iter_full_history(summary=summary, **kwargs),
+                                      export_format, summary)
+            return json_encode({'path': export_path, 'count': count, 'summary': summary})
         return json_encode(self.wallet.get_full_history(**kwargs))
 
     @command('w')
@@ -675,6 +702,29 @@ class Commands:
             fee_level = Decimal(fee_level)
         return self.config.fee_per_kb(dyn=dyn, mempool=mempool, fee_level=fee_level)
 
+    def _main_chain(self):
+        if self.network:
+            return self.network.blockchains[0]
+        from .blockchain import read_blockchains
+        return read_blockchains(self.config)[0]
+
+    @command('')
+    def exportheaders(self, path):
+        """Export the block headers of the main chain to a compressed
+        snapshot file, to bootstrap other installations with importheaders."""
+        return self._main_chain().export_headers(path)
+
+    @command('')
+    def importheaders(self, path):
+        """Import block headers from a snapshot created with exportheaders.
+        Headers are verified against checkpoints and proof of work. Returns
+        the local height. Set 'headers_snapshot' to import on first start."""
+        if self.network and self.network.is_running():
+            # the network writes the same headers file
+            raise Exception('Cannot import headers while the network is running. Stop the daemon first.')
+        b = self._main_chain()
+        return b.import_headers(path, self.config.get('headers_verify_processes'))
+
     @command('')
     def help(self):
         # for the python console
@@ -697,6 +747,8 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in BTC).',
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'path': 'File path',
+    'file_format': 'Wallet file format: json, binary or sqlite',
 }
 
 command_options = {
@@ -732,6 +784,10 @@ command_options = {
     'show_addresses': (None, "Show input and output addresses"),
     'show_fiat':   (None, "Show fiat value of transactions"),
     'year':        (None, "Show history for a given year"),
+    'offset':      (None, "Number of history items to skip"),
+    'limit':       (None, "Maximum number of history items to show"),
+    'export_path': (None, "Write the history to this file"),
+    'export_format': (None, "Format of the history file: csv, json or jsonl"),
     'fee_method':  (None, "Fee estimation method to use"),
     'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position")
 }
@@ -745,6 +801,8 @@ arg_types = {
     'nbits': int,
     'imax': int,
     'year': int,
+    'offset': int,
+    'limit': int,
     'tx': tx_from_str,
     'pubkeys': json_loads,
     'jsontx': json_loads,
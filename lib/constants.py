@@ -48,6 +48,11 @@ class BitcoinMainnet:
     DEFAULT_PORTS = {'t': '50001', 's': '50002'}
     DEFAULT_SERVERS = read_json('servers.json', {})
     CHECKPOINTS = read_json('checkpoints.json', [])
+    # merkle root of all header hashes covered by CHECKPOINTS, used to
+    # verify blockchain.block.header proofs (see Blockchain.get_checkpoint_merkle_root).
+    # Not computed yet; until then the root comes from the
+    # 'checkpoint_merkle_root' config key
+    CHECKPOINT_MERKLE_ROOT = None
 
     XPRV_HEADERS = {
         'standard':    0x0488ade4,  # xprv
@@ -77,6 +82,7 @@ class BitcoinTestnet:
     DEFAULT_PORTS = {'t': '51001', 's': '51002'}
     DEFAULT_SERVERS = read_json('servers_testnet.json', {})
     CHECKPOINTS = read_json('checkpoints_testnet.json', [])
+    CHECKPOINT_MERKLE_ROOT = None
 
     XPRV_HEADERS = {
         'standard':    0x04358394,  # tprv
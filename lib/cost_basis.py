@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+'''Acquisition cost of the coins of a wallet, for capital gains.
+
+Two methods are supported:
+
+    average:  a coin costs what the inputs of the transaction that
+              created it cost, per bitcoin. Coins received from others
+              cost their fiat value at the time they were received.
+    fifo:     the wallet holds lots of coins, one per incoming
+              transaction. Outgoing transactions use up the oldest
+              lots first.
+
+The history is walked once, parents before children, and the price of
+each transaction is looked up once. It does not have to be held in a
+list.
+'''
+import time
+from collections import deque
+from decimal import Decimal
+
+from .bitcoin import COIN
+
+
+AVERAGE = 'average'
+FIFO = 'fifo'
+METHODS = (AVERAGE, FIFO)
+
+NaN = Decimal('NaN')
+
+
+class CostBasis:
+
+    def __init__(self, wallet, price_func, ccy, method=AVERAGE):
+        if method not in METHODS:
+            raise ValueError('unknown cost basis method: {}'.format(method))
+        self.wallet = wallet
+        self.price_func = price_func
+        self.ccy = ccy
+        self.method = method
+        self._prices = {}       # txid -> price of a bitcoin when the tx was made
+        self._coin_prices = {}  # txid -> acquisition price of a bitcoin of its outputs
+        self.fiat_values = {}   # txid -> (fiat value, True if it was not set by the user)
+        self.acquisition_prices = {}  # txid -> acquisition price of what an outgoing tx spent
+        self.unrealized_gains = NaN
+        self._lots = deque()    # fifo: [satoshis, price per satoshi], oldest first
+
+    def price(self, txid):
+        p = self._prices.get(txid)
+        if p is None:
+            timestamp = self.wallet.get_tx_height(txid)[2]
+            p = self._prices[txid] = self.price_func(timestamp if timestamp else time.time())
+        return p
+
+    def fiat_value(self, txid, value):
+        fiat_value = self.wallet.get_fiat_value(txid, self.ccy)
+        if fiat_value is not None:
+            return fiat_value, False
+        return value / Decimal(COIN) * self.price(txid), True
+
+    def coin_price(self, txid):
+        """Acquisition price of a bitcoin of the outputs of txid (average method)."""
+        result = self._coin_prices.get(txid)
+        if result is not None:
+            return result
+        # the prices of the parents are needed first; no recursion, chains may be long
+        todo = [txid]
+        while todo:
+            t = todo[-1]
+            if t in self._coin_prices:
+                todo.pop()
+                continue
+            inputs = self._inputs(t)
+            missing = {parent for parent, v in inputs if parent not in self._coin_prices}
+            if missing:
+                todo.extend(missing)
+                continue
+            todo.pop()
+            if inputs:
+                input_value = sum(v for parent, v in inputs)
+                cost = sum(v * self._coin_prices[parent] for parent, v in inputs)
+                result = cost / input_value if input_value else NaN
+            else:
+                # coins received from others
+                result = self.price(t)
+                fiat_value = self.wallet.get_fiat_value(t, self.ccy)
+                if fiat_value is not None:
+                    delta = self.wallet.get_tx_value(t)
+                    if delta > 0:
+                        result = fiat_value / (delta / Decimal(COIN))
+            self._coin_prices[t] = result
+        return self._coin_prices[txid]
+
+    def _inputs(self, txid):
+        # (parent txid, value) of the inputs of txid that are mine
+        return [(ser.split(':')[0], v) for d in self.wallet.txi.get(txid, {}).values() for ser, v in d]
+
+    def _spend_lots(self, value):
+        cost = Decimal(0)
+        while value > 0 and self._lots:
+            lot = self._lots[0]
+            n = min(value, lot[0])
+            cost += n * lot[1]
+            value -= n
+            lot[0] -= n
+            if lot[0] == 0:
+                self._lots.popleft()
+        # spent more than was received: the history is incomplete
+        return cost if value == 0 else NaN
+
+    def run(self, history, utxos, in_history=None):
+        """Walk history, (txid, wallet delta) pairs in the order of the
+        wallet history, and value utxos, the coins still held, at the
+        current price. history may be an iterator if in_history tells
+        whether a txid is part of it. Deltas may be None if the wallet
+        is not synchronized."""
+        if in_history is None:
+            history = list(history)
+            in_history = {txid for txid, value in history}.__contains__
+        for txid, value in self._parents_first(history, in_history):
+            if value is None:
+                continue
+            fiat_value, fiat_default = self.fiat_value(txid, value)
+            self.fiat_values[txid] = fiat_value, fiat_default
+            if self.method == FIFO:
+                if value >= 0:
+                    if value:
+                        self._lots.append([value, fiat_value / value])
+                else:
+                    self.acquisition_prices[txid] = self._spend_lots(-value)
+            elif value < 0:
+                self.acquisition_prices[txid] = - value / Decimal(COIN) * self.coin_price(txid)
+        p = self.price_func(time.time())
+        if self.method == FIFO:
+            held = sum(lot[0] for lot in self._lots)
+            cost = sum(lot[0] * lot[1] for lot in self._lots)
+        else:
+            held = sum(coin['value'] for coin in utxos)
+            cost = sum(coin['value'] / Decimal(COIN) * self.coin_price(coin['prevout_hash'])
+                       for coin in utxos)
+        self.unrealized_gains = held * p / Decimal(COIN) - cost
+        return self
+
+    def _parents_first(self, history, in_history):
+        # the history is sorted by height, unconfirmed children may come
+        # before their parents; those wait until their parents were seen
+        done = set()
+        waiting = {}  # txid -> [(child, value), ...]
+        for item in history:
+            ready = [item]
+            while ready:
+                txid, value = ready.pop()
+                parent = next((parent for parent, v in self._inputs(txid)
+                               if parent not in done and in_history(parent)), None)
+                if parent is not None:
+                    waiting.setdefault(parent, []).append((txid, value))
+                    continue
+                done.add(txid)
+                yield txid, value
+                ready.extend(reversed(waiting.pop(txid, [])))
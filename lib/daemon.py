@@ -242,6 +242,14 @@ class Daemon(DaemonThread):
             return
         if storage.get_action():
             return
+        if self.config.get('wallet_sqlite') and not storage.is_sqlite() and not storage.is_encrypted():
+            storage.upgrade_to_sqlite()
+        journal = self.config.get('wallet_journal')
+        if not storage.is_sqlite() and journal is not None and bool(journal) != storage.is_journaled():
+            storage.set_journal(journal)
+        write_delay = self.config.get('wallet_write_delay', 0)
+        if write_delay:
+            storage.set_write_behind(write_delay, self.config.get('wallet_write_max_changes', 100))
         wallet = Wallet(storage)
         wallet.start_threads(self.network)
         self.wallets[path] = wallet
@@ -478,6 +478,12 @@ class FxThread(ThreadJob):
     def set_history_capital_gains_config(self, b):
         self.config.set_key('history_rates_capital_gains', bool(b))
 
+    def get_cost_basis_method(self):
+        return self.config.get('cost_basis_method', 'average')
+
+    def set_cost_basis_method(self, method):
+        self.config.set_key('cost_basis_method', method)
+
     def get_fiat_address_config(self):
         return bool(self.config.get('fiat_address'))
 
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+'''Export of the wallet history to a file.
+
+The items of Abstract_Wallet.iter_full_history are written as they are
+produced, so the history is never held in memory as a whole:
+
+    csv:    one row per transaction
+    json:   the same object as the history command, or a list of the
+            transactions if there is no summary
+    jsonl:  one transaction per line, then the summary
+'''
+import csv
+import json
+
+from .util import MyEncoder
+
+
+EXPORT_FORMATS = ('csv', 'json', 'jsonl')
+
+CSV_HEADER = ["transaction_hash", "label", "confirmations", "value", "timestamp"]
+
+
+def _dumps(obj, indent=None):
+    return json.dumps(obj, sort_keys=True, indent=indent, cls=MyEncoder)
+
+
+def write_history(f, items, export_format, summary=None):
+    """Write the history items to the text file f and return their number.
+    summary is a dict filled in by the time items is exhausted, as with
+    iter_full_history; it is not written in the csv format."""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('unknown export format: {}'.format(export_format))
+    count = 0
+    if export_format == 'csv':
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(CSV_HEADER)
+        for item in items:
+            writer.writerow([item['txid'], item.get('label', ''), item['confirmations'], item['value'], item['date']])
+            count += 1
+    elif export_format == 'jsonl':
+        for item in items:
+            f.write(_dumps(item) + '\n')
+            count += 1
+        if summary is not None:
+            f.write(_dumps({'summary': summary}) + '\n')
+    else:
+        f.write('{"transactions": [' if summary is not None else '[')
+        for item in items:
+            f.write(',\n' if count else '\n')
+            f.write(_dumps(item, 4))
+            count += 1
+        f.write('\n]')
+        if summary is not None:
+            f.write(',\n"summary": ' + _dumps(summary, 4) + '}')
+        f.write('\n')
+    return count
@@ -46,7 +46,7 @@ from .bitcoin import COIN
 from . import constants
 from .interface import Connection, Interface
 from . import blockchain
-from .version import ELECTRUM_VERSION, PROTOCOL_VERSION
+from .version import ELECTRUM_VERSION, PROTOCOL_VERSION, PROTOCOL_VERSION_HEADER_PROOFS
 from .i18n import _
 
 
@@ -225,6 +225,7 @@ class Network(util.DaemonThread):
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
         self.requested_chunks = set()
+        self.requested_header_proofs = set()
         self.socket_queue = queue.Queue()
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
@@ -349,11 +350,18 @@ class Network(util.DaemonThread):
         return value
 
     def notify(self, key):
+        if key == 'updated':
+            # headers must be durable before a new tip is announced
+            self.sync_blockchains()
         if key in ['status', 'updated']:
             self.trigger_callback(key)
         else:
             self.trigger_callback(key, self.get_status_value(key))
 
+    def sync_blockchains(self):
+        for b in list(self.blockchains.values()):
+            b.sync()
+
     def get_parameters(self):
         host, port, protocol = deserialize_server(self.default_server)
         return host, port, protocol, self.proxy, self.auto_connect
@@ -572,6 +580,8 @@ class Network(util.DaemonThread):
         # We handle some responses; return the rest to the client.
         if method == 'server.version':
             interface.server_version = result
+            if isinstance(params[1], list):
+                self.on_server_version(interface, response)
         elif method == 'blockchain.headers.subscribe':
             if error is None:
                 self.on_notify_header(interface, result)
@@ -610,6 +620,11 @@ class Network(util.DaemonThread):
             self.on_block_headers(interface, response)
         elif method == 'blockchain.block.get_header':
             self.on_get_header(interface, response)
+        elif method == 'blockchain.block.header':
+            if len(params) > 1:
+                self.on_header_proof(interface, response)
+            else:
+                self.on_get_header(interface, response)
 
         for callback in callbacks:
             callback(response)
@@ -734,11 +749,19 @@ class Network(util.DaemonThread):
         interface.tip = 0
         interface.mode = 'default'
         interface.request = None
+        interface.protocol_version = PROTOCOL_VERSION
         self.interfaces[server] = interface
         # server.version should be the first message
-        params = [ELECTRUM_VERSION, PROTOCOL_VERSION]
-        self.queue_request('server.version', params, interface)
-        self.queue_request('blockchain.headers.subscribe', [True], interface)
+        if self.get_checkpoint_merkle_root() is None:
+            params = [ELECTRUM_VERSION, PROTOCOL_VERSION]
+            self.queue_request('server.version', params, interface)
+            self.queue_request('blockchain.headers.subscribe', [True], interface)
+        else:
+            # header proofs need 1.4, but older servers will do. The
+            # headers subscription waits for the negotiated version,
+            # its raw argument is gone in 1.4
+            params = [ELECTRUM_VERSION, [PROTOCOL_VERSION, PROTOCOL_VERSION_HEADER_PROOFS]]
+            self.queue_request('server.version', params, interface)
         if server == self.default_server:
             self.switch_to_interface(server)
         #self.notify('interfaces')
@@ -798,6 +821,64 @@ class Network(util.DaemonThread):
         self.queue_request('blockchain.block.headers', [height, 2016],
                            interface)
 
+    def get_checkpoint_merkle_root(self):
+        if not self.config.get('header_proofs', False):
+            return None
+        return self.config.get('checkpoint_merkle_root', constants.net.CHECKPOINT_MERKLE_ROOT)
+
+    def supports_header_proofs(self, interface):
+        return util.normalize_version(interface.protocol_version) \
+               >= util.normalize_version(PROTOCOL_VERSION_HEADER_PROOFS)
+
+    def on_server_version(self, interface, response):
+        '''Handle the answer to a version range: subscribe to headers in
+        the way of the negotiated version'''
+        result = response.get('result')
+        if response.get('error') is not None or not isinstance(result, list) or len(result) < 2:
+            interface.print_error(response.get('error') or 'bad response')
+            self.connection_down(interface.server)
+            return
+        interface.protocol_version = result[1]
+        interface.print_error("protocol version", interface.protocol_version)
+        params = [] if self.supports_header_proofs(interface) else [True]
+        self.queue_request('blockchain.headers.subscribe', params, interface)
+
+    def request_checkpointed_header(self, interface, height):
+        '''Fetch the header at a height covered by the checkpoints: as a
+        single header with a proof against the checkpoint merkle root if
+        we know it and the server supports it, otherwise as part of its
+        chunk.'''
+        if self.get_checkpoint_merkle_root() is None or not self.supports_header_proofs(interface):
+            self.request_chunk(interface, height // 2016)
+            return
+        if height in self.requested_header_proofs:
+            return
+        interface.print_error("requesting header %d" % height)
+        self.requested_header_proofs.add(height)
+        cp_height = self.blockchains[0].checkpoint_height()
+        self.queue_request('blockchain.block.header', [height, cp_height], interface)
+
+    def on_header_proof(self, interface, response):
+        '''Handle receiving a header with a checkpoint merkle proof'''
+        error = response.get('error')
+        result = response.get('result')
+        params = response.get('params')
+        if params is None or params[0] not in self.requested_header_proofs:
+            interface.print_error("received header proof (unsolicited)")
+            return
+        height = params[0]
+        self.requested_header_proofs.discard(height)
+        if result is None or error is not None:
+            # the server might not support header proofs; fall back to chunks
+            interface.print_error(error or 'bad response')
+            self.request_chunk(interface, height // 2016)
+            return
+        b = self.blockchains[0]
+        if not b.connect_checkpointed_header(height, result, self.get_checkpoint_merkle_root()):
+            self.connection_down(interface.server)
+            return
+        self.notify('updated')
+
     def on_block_headers(self, interface, response):
         '''Handle receiving a chunk of block headers'''
         error = response.get('error')
@@ -837,7 +918,17 @@ class Network(util.DaemonThread):
             interface.print_error(response)
             self.connection_down(interface.server)
             return
-        height = header.get('block_height')
+        try:
+            if isinstance(header, str):
+                # blockchain.block.header returns the raw header
+                header = blockchain.Header(util.bfh(header), response['params'][0])
+            else:
+                header = blockchain.Header.from_dict(header)
+        except Exception as e:
+            interface.print_error('invalid header', e)
+            self.connection_down(interface.server)
+            return
+        height = header.block_height
         if interface.request != height:
             interface.print_error("unsolicited header",interface.request, height)
             self.connection_down(interface.server)
@@ -990,15 +1081,16 @@ class Network(util.DaemonThread):
 
     def init_headers_file(self):
         b = self.blockchains[0]
-        filename = b.path()
-        length = 80 * len(constants.net.CHECKPOINTS) * 2016
-        if not os.path.exists(filename) or os.path.getsize(filename) < length:
-            with open(filename, 'wb') as f:
-                if length>0:
-                    f.seek(length-1)
-                    f.write(b'\x00')
-        with b.lock:
-            b.update_size()
+        b.init_headers_file()
+        # bootstrap a fresh headers file from a snapshot, if configured
+        snapshot = self.config.get('headers_snapshot')
+        if snapshot and os.path.exists(snapshot) and b.height() <= self.max_checkpoint():
+            self.print_error('importing headers from', snapshot)
+            try:
+                b.import_headers(snapshot, self.config.get('headers_verify_processes'))
+            except Exception as e:
+                self.print_error('headers import failed', str(e))
+            self.print_error('imported headers up to', b.height())
 
     async def run(self):
         self.init_headers_file()
@@ -1010,6 +1102,7 @@ class Network(util.DaemonThread):
             await self.run_jobs()    # Synchronizer and Verifier
             self.process_pending_sends()
         self.stop_network()
+        self.sync_blockchains()
         self.on_stop()
 
     def on_notify_header(self, interface, header_dict):
@@ -1019,7 +1112,7 @@ class Network(util.DaemonThread):
             # no point in keeping this connection without headers sub
             self.connection_down(interface.server)
             return
-        header = blockchain.deserialize_header(util.bfh(header_hex), height)
+        header = blockchain.Header(util.bfh(header_hex), height)
         if height < self.max_checkpoint():
             self.connection_down(interface.server)
             return
@@ -1120,7 +1213,11 @@ class Network(util.DaemonThread):
         invocation(callback)
 
     def request_header(self, interface, height):
-        self.queue_request('blockchain.block.get_header', [height], interface)
+        if self.supports_header_proofs(interface):
+            # blockchain.block.get_header is gone in 1.4
+            self.queue_request('blockchain.block.header', [height], interface)
+        else:
+            self.queue_request('blockchain.block.get_header', [height], interface)
         interface.request = height
         interface.req_time = time.time()
 
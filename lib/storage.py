@@ -29,24 +29,28 @@ import json
 import copy
 import re
 import stat
-import pbkdf2, hmac, hashlib
+import time
+import hmac, hashlib
 import base64
 import zlib
 from collections import defaultdict
 
 from . import util
-from .util import PrintError, profiler, InvalidPassword, WalletFileException, bfh
+from .util import PrintError, profiler, InvalidPassword, WalletFileException, bfh, bh2u
 from .plugins import run_hook, plugin_loaders
 from .keystore import bip44_derivation
 from . import bitcoin
 from . import ecc
+from .crypto import aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot
+from .wallet_db import WalletDB, is_sqlite_file
+from . import wallet_binary
 
 
 # seed_version is now used for the version of the wallet file
 
 OLD_SEED_VERSION = 4        # electrum versions < 2.0
 NEW_SEED_VERSION = 11       # electrum versions >= 2.0
-FINAL_SEED_VERSION = 17     # electrum >= 2.7 will set this to prevent
+FINAL_SEED_VERSION = 18     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
 
@@ -61,6 +65,13 @@ def multisig_type(wallet_type):
         match = [int(x) for x in match.group(1, 2)]
     return match
 
+def json_key(k):
+    '''Return k the way json.dumps writes it as an object key.'''
+    return k if isinstance(k, str) else json.dumps(k)
+
+def password_secret(password):
+    return hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), b'', iterations=1024, dklen=64)
+
 def get_derivation_used_for_hw_device_encryption():
     return ("m"
             "/4541509'"      # ascii 'ELE'  as decimal ("BIP43 purpose")
@@ -69,6 +80,20 @@ def get_derivation_used_for_hw_device_encryption():
 # storage encryption version
 STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW = range(0, 3)
 
+# a journal is compacted into the snapshot once it is larger than this,
+# or than a quarter of the snapshot, whichever is bigger
+JOURNAL_MIN_COMPACT_SIZE = 1 << 20
+
+# encrypted wallet files are written as independently encrypted segments,
+# one per top-level key; dicts are split into segments of about this many items.
+# The ECIES header holds the segment key, a write counter and the digests of
+# the segments, in order, so that segments cannot be dropped, added, moved or
+# taken from another write of the file.
+SEGMENT_ITEMS = 1000
+
+# see WalletStorage.convert_format
+FILE_FORMATS = ('json', 'binary', 'sqlite')
+
 class WalletStorage(PrintError):
 
     def __init__(self, path, manual_upgrades=False):
@@ -79,7 +104,47 @@ class WalletStorage(PrintError):
         self.path = path
         self.modified = False
         self.pubkey = None
-        if self.file_exists():
+        # journal mode: changes are appended to path + '.journal' as
+        # records, and only compaction rewrites the whole file
+        self._journal = False
+        self._journal_records = []
+        # number of records in the journal file
+        self._journal_length = 0
+        self._needs_snapshot = not self.file_exists()
+        self._snapshot_lock = threading.Lock()
+        self._compaction_thread = None
+        self._db = None
+        # binary file format, see wallet_binary
+        self._binary = False
+        # serialized key-value pairs of the snapshot, by key
+        self._fragments = {}
+        # encrypted segments of the snapshot:
+        # key -> [(digest of the plaintext, segment, digest of the segment)]
+        self._segments = {}
+        self._dirty_segments = set()
+        self._segment_key = None
+        self._segment_generation = 0
+        # kept while the storage is unlocked
+        self._password_secret = None
+        # write-behind, see set_write_behind
+        self._write_delay = 0
+        self._write_max_changes = 100
+        self._write_timer = None
+        self._pending_writes = 0
+        self.write_stats = {'writes': 0, 'bytes': 0, 'time': 0., 'max_latency': 0., 'coalesced': 0}
+        if self.file_exists() and is_sqlite_file(self.path):
+            self.raw = None
+            self._encryption_version = STO_EV_PLAINTEXT
+            self._db = WalletDB(self.path)
+            self.load_data(None)
+        elif self.file_exists() and wallet_binary.is_binary_file(self.path):
+            with open(self.path, "rb") as f:
+                b = f.read()
+            self.raw = None
+            self._encryption_version = STO_EV_PLAINTEXT
+            self._binary = True
+            self.load_data(wallet_binary.decode(b))
+        elif self.file_exists():
             with open(self.path, "r", encoding='utf-8') as f:
                 self.raw = f.read()
             self._encryption_version = self._init_encryption_version()
@@ -90,7 +155,32 @@ class WalletStorage(PrintError):
             # avoid new wallets getting 'upgraded'
             self.put('seed_version', FINAL_SEED_VERSION)
 
-    def load_data(self, s):
+    def load_data(self, s, ec_key=None):
+        self._fragments = {}
+        self._dirty_segments = set()
+        if self._db is not None:
+            self.data = self._db.load_data()
+        elif isinstance(s, dict):
+            self.data = s
+            self._journal = bool(self.data.get('use_journal'))
+            self._replay_journal(ec_key is not None)
+        else:
+            self._load_json(s)
+            self._journal = bool(self.data.get('use_journal'))
+            self._replay_journal(ec_key is not None)
+
+        # check here if I need to load a plugin
+        t = self.get('wallet_type')
+        l = plugin_loaders.get(t)
+        if l: l()
+
+        if not self.manual_upgrades:
+            if self.requires_split():
+                raise WalletFileException("This wallet has multiple accounts and must be split")
+            if self.requires_upgrade():
+                self.upgrade()
+
+    def _load_json(self, s):
         try:
             self.data = json.loads(s)
         except:
@@ -109,17 +199,6 @@ class WalletStorage(PrintError):
                     continue
                 self.data[key] = value
 
-        # check here if I need to load a plugin
-        t = self.get('wallet_type')
-        l = plugin_loaders.get(t)
-        if l: l()
-
-        if not self.manual_upgrades:
-            if self.requires_split():
-                raise WalletFileException("This wallet has multiple accounts and must be split")
-            if self.requires_upgrade():
-                self.upgrade()
-
     def is_past_initial_decryption(self):
         """Return if storage is in a usable state for normal operations.
 
@@ -152,7 +231,7 @@ class WalletStorage(PrintError):
 
     def _init_encryption_version(self):
         try:
-            magic = base64.b64decode(self.raw)[0:4]
+            magic = base64.b64decode(self.raw.split('\n', 1)[0])[0:4]
             if magic == b'BIE1':
                 return STO_EV_USER_PW
             elif magic == b'BIE2':
@@ -167,7 +246,7 @@ class WalletStorage(PrintError):
 
     @staticmethod
     def get_eckey_from_password(password):
-        secret = pbkdf2.PBKDF2(password, '', iterations=1024, macmodule=hmac, digestmodule=hashlib.sha512).read(64)
+        secret = password_secret(password)
         ec_key = ecc.ECPrivkey.from_arbitrary_size_secret(secret)
         return ec_key
 
@@ -181,20 +260,153 @@ class WalletStorage(PrintError):
             raise WalletFileException('no encryption magic for version: %s' % v)
 
     def decrypt(self, password):
-        ec_key = self.get_eckey_from_password(password)
-        if self.raw:
-            enc_magic = self._get_encryption_magic()
-            s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
-        else:
-            s = None
+        secret = password_secret(password)
+        ec_key = ecc.ECPrivkey.from_arbitrary_size_secret(secret)
+        lines = self.raw.split()
+        enc_magic = self._get_encryption_magic()
+        s = zlib.decompress(ec_key.decrypt_message(lines[0], enc_magic)).decode('utf8')
+        header = self._parse_segment_header(s) if len(lines) == 1 else json.loads(s)
+        if header is not None:
+            s = self._decrypt_segments(header, lines[1:])
         self.pubkey = ec_key.get_public_key_hex()
-        s = s.decode('utf8')
-        self.load_data(s)
+        self._password_secret = secret
+        self.load_data(s, ec_key)
+
+    @staticmethod
+    def _parse_segment_header(s):
+        # a file without segments is either a header alone, if the
+        # wallet is empty, or the whole wallet as one ECIES message
+        try:
+            d = json.loads(s)
+        except ValueError:
+            return None
+        return d if isinstance(d, dict) and 'segment_key' in d else None
+
+    @staticmethod
+    def _segment_digest(segment):
+        return hashlib.sha256(segment.encode('ascii')).hexdigest()
+
+    def _segment_keys(self):
+        k = hashlib.sha512(self._segment_key).digest()
+        return k[0:32], k[32:]
+
+    def _journal_keys(self):
+        k = hmac_oneshot(self._segment_key, b'journal', hashlib.sha512)
+        return k[0:32], k[32:]
+
+    @staticmethod
+    def _seal(keys, s, context=b''):
+        # AES-CBC then HMAC-SHA256 over the context and the ciphertext
+        key_e, key_m = keys
+        iv = os.urandom(16)
+        e = iv + aes_encrypt_with_iv(key_e, iv, zlib.compress(s))
+        return base64.b64encode(e + hmac_oneshot(key_m, context + e, hashlib.sha256)).decode('ascii')
+
+    @staticmethod
+    def _unseal(keys, sealed, context=b''):
+        key_e, key_m = keys
+        e = base64.b64decode(sealed)
+        e, mac = e[:-32], e[-32:]
+        if not hmac.compare_digest(mac, hmac_oneshot(key_m, context + e, hashlib.sha256)):
+            return None
+        return zlib.decompress(aes_decrypt_with_iv(key_e, e[:16], e[16:]))
+
+    def _encrypt_segment(self, s):
+        return self._seal(self._segment_keys(), s)
+
+    def _decrypt_segment(self, segment):
+        s = self._unseal(self._segment_keys(), segment)
+        if s is None:
+            raise WalletFileException('Corrupt wallet file segment')
+        return s
+
+    @staticmethod
+    def _record_context(journal_id, i):
+        # a record is only valid at its place in the journal of its snapshot
+        return ('%s:%d:' % (journal_id, i)).encode('utf8')
+
+    def _encrypt_record(self, record, journal_id, i):
+        return self._seal(self._journal_keys(), record.encode('utf8'), self._record_context(journal_id, i))
+
+    def _decrypt_record(self, line, journal_id, i):
+        s = self._unseal(self._journal_keys(), line, self._record_context(journal_id, i))
+        if s is None:
+            raise WalletFileException('Corrupt wallet journal record')
+        return s.decode('utf8')
+
+    def _decrypt_segments(self, header, segments):
+        """Return the data in a segmented file, and remember its segments
+        so that the next write only re-encrypts the ones that changed."""
+        manifest = header.get('segments')
+        if manifest is None or len(manifest) != len(segments):
+            raise WalletFileException('Corrupt wallet file: missing or extra segments')
+        segment_digests = [self._segment_digest(segment) for segment in segments]
+        if any(not hmac.compare_digest(a, b) for a, b in zip(manifest, segment_digests)):
+            raise WalletFileException('Corrupt wallet file: segment does not match the header')
+        self._segment_key = bfh(header['segment_key'])
+        self._segment_generation = header['generation']
+        self._segments = {}
+        data = {}
+        for segment, segment_digest in zip(segments, segment_digests):
+            s = self._decrypt_segment(segment)
+            d = json.loads(s.decode('utf8'))
+            key = d['k']
+            if 'items' in d:
+                data.setdefault(key, {}).update(d['items'])
+            else:
+                data[key] = d['v']
+            self._segments.setdefault(key, []).append((hashlib.sha256(s).digest(), segment, segment_digest))
+        return data
+
+    def _serialize_segments(self):
+        if self._segment_key is None:
+            self._segment_key = os.urandom(32)
+            self._segments = {}
+        segments = []
+        for key in sorted(self.data):
+            cached = self._segments.get(key)
+            if cached is None or key in self._dirty_segments:
+                cached = self._segments[key] = self._encrypt_value(key, self.data[key], cached or [])
+            segments.extend(cached)
+        for key in set(self._segments) - set(self.data):
+            del self._segments[key]
+        self._dirty_segments.clear()
+        self._segment_generation += 1
+        header = self._encrypt(json.dumps({
+            'segment_key': bh2u(self._segment_key),
+            'generation': self._segment_generation,
+            'segments': [segment_digest for digest, segment, segment_digest in segments],
+        }))
+        return '\n'.join([header] + [segment for digest, segment, segment_digest in segments])
+
+    def _encrypt_value(self, key, value, cached):
+        if isinstance(value, dict) and value:
+            n = 1 + (len(value) - 1) // SEGMENT_ITEMS
+            buckets = [{} for i in range(n)]
+            for k, v in value.items():
+                buckets[zlib.crc32(json_key(k).encode('utf8')) % n][k] = v
+            parts = [{'k': key, 'items': b} for b in buckets]
+        else:
+            parts = [{'k': key, 'v': value}]
+        result = []
+        for i, part in enumerate(parts):
+            s = json.dumps(part, sort_keys=True, cls=util.MyEncoder).encode('utf8')
+            digest = hashlib.sha256(s).digest()
+            if i < len(cached) and cached[i][0] == digest:
+                result.append(cached[i])
+            else:
+                segment = self._encrypt_segment(s)
+                result.append((digest, segment, self._segment_digest(segment)))
+        return result
 
     def check_password(self, password):
         """Raises an InvalidPassword exception on invalid password"""
         if not self.is_encrypted():
             return
+        if self._password_secret is not None:
+            if not hmac.compare_digest(self._password_secret, password_secret(password)):
+                raise InvalidPassword()
+            return
         if self.pubkey and self.pubkey != self.get_eckey_from_password(password).get_public_key_hex():
             raise InvalidPassword()
 
@@ -205,16 +417,40 @@ class WalletStorage(PrintError):
         """Set a password to be used for encrypting this storage."""
         if enc_version is None:
             enc_version = self._encryption_version
+        if password and enc_version != STO_EV_PLAINTEXT and self._db is not None:
+            raise WalletFileException('SQLite wallet files cannot be encrypted')
+        if password and enc_version != STO_EV_PLAINTEXT and self._binary:
+            raise WalletFileException('Binary wallet files cannot be encrypted')
         if password and enc_version != STO_EV_PLAINTEXT:
-            ec_key = self.get_eckey_from_password(password)
+            secret = password_secret(password)
+            ec_key = ecc.ECPrivkey.from_arbitrary_size_secret(secret)
             self.pubkey = ec_key.get_public_key_hex()
+            self._password_secret = secret
             self._encryption_version = enc_version
         else:
             self.pubkey = None
+            self._password_secret = None
             self._encryption_version = STO_EV_PLAINTEXT
         # make sure next storage.write() saves changes
         with self.lock:
+            # a new key for the segments, they are all encrypted again
+            self._segment_key = None
             self.modified = True
+            self._needs_snapshot = True
+
+    def is_journaled(self):
+        return self._journal
+
+    def set_journal(self, enable):
+        """Switch between rewriting the whole file on every write and
+        appending changes to a journal. The next write rewrites the file."""
+        if self._db is not None:
+            raise WalletFileException('SQLite wallet files have no journal')
+        with self.lock:
+            self.put('use_journal', bool(enable) or None)
+            self._journal = bool(enable)
+            self._journal_records = []
+            self._needs_snapshot = True
 
     def get(self, key, default=None):
         with self.lock:
@@ -225,26 +461,319 @@ class WalletStorage(PrintError):
                 v = copy.deepcopy(v)
         return v
 
+    def get_view(self, key, default=None):
+        """Like get, but without copying. The caller must not modify
+        the returned value."""
+        with self.lock:
+            v = self.data.get(key)
+        return default if v is None else v
+
     def put(self, key, value):
-        try:
-            json.dumps(key, cls=util.MyEncoder)
-            json.dumps(value, cls=util.MyEncoder)
-        except:
-            self.print_error("json error: cannot save", key)
+        with self.lock:
+            # values that did not change are neither validated nor copied
+            if value is not None and self.data.get(key) == value:
+                return
+            try:
+                json.dumps(key, cls=util.MyEncoder)
+                json.dumps(value, cls=util.MyEncoder)
+            except:
+                self.print_error("json error: cannot save", key)
+                return
+            self._set(key, copy.deepcopy(value))
+
+    def put_owned(self, key, value):
+        """Like put, but takes ownership of value instead of copying it.
+        The caller must not modify value afterwards. value is not
+        validated; it must be serializable by util.MyEncoder."""
+        with self.lock:
+            if value is not None and self.data.get(key) == value:
+                return
+            self._set(key, value)
+
+    def put_item(self, key, item, value):
+        """Set one item of the dict stored under key, or remove it if
+        value is None. Like put_owned, value is neither copied nor
+        validated. Only the item is recorded in the journal."""
+        with self.lock:
+            d = self.data.get(key)
+            if value is None:
+                if d is None or item not in d:
+                    return
+                del d[item]
+                record = ['pop_item', key, json_key(item)]
+            else:
+                if d is None:
+                    d = self.data[key] = {}
+                elif item in d and d[item] == value:
+                    return
+                d[item] = value
+                record = ['put_item', key, json_key(item), value]
+            # the views of WalletDB write to the database themselves
+            if self._records_changes() and isinstance(d, dict):
+                self._add_journal_record(record)
+            self._invalidate(key)
+            self.modified = True
+
+    def _set(self, key, value):
+        if value is None:
+            if key not in self.data:
+                return
+            self.data.pop(key)
+            if self._records_changes():
+                self._add_journal_record(['pop', key])
+        else:
+            old = self.data.get(key)
+            self.data[key] = value
+            if self._records_changes():
+                self._journal_put(key, old, value)
+        self._invalidate(key)
+        self.modified = True
+
+    def _invalidate(self, key):
+        self._fragments.pop(key, None)
+        self._dirty_segments.add(key)
+
+    def _records_changes(self):
+        return self._journal or self._db is not None
+
+    def _journal_put(self, key, old, value):
+        if not (isinstance(old, dict) and isinstance(value, dict)):
+            self._add_journal_record(['put', key, value])
             return
+        # only record the items of a dict that changed
+        for k, v in value.items():
+            if k not in old or old[k] != v:
+                self._add_journal_record(['put_item', key, json_key(k), v])
+        for k in old:
+            if k not in value:
+                self._add_journal_record(['pop_item', key, json_key(k)])
+
+    def _add_journal_record(self, record):
+        # serialize now, the caller may go on mutating the value
+        self._journal_records.append(json.dumps(record, cls=util.MyEncoder, separators=(',', ':')))
+
+    def _apply_journal_record(self, record):
+        op, key = record[0], record[1]
+        if op == 'put':
+            self.data[key] = record[2]
+        elif op == 'pop':
+            self.data.pop(key, None)
+        elif op == 'put_item':
+            self.data.setdefault(key, {})[record[2]] = record[3]
+        elif op == 'pop_item':
+            self.data.get(key, {}).pop(record[2], None)
+        else:
+            raise WalletFileException('unknown journal record: %s' % op)
+
+    def journal_path(self):
+        return self.path + '.journal'
+
+    def _rotated_journal_path(self):
+        return self.path + '.journal.old'
+
+    def _replay_journal(self, encrypted):
+        """Apply the journals that follow the snapshot in self.data.
+
+        Each journal starts with a header naming the snapshot it applies
+        to ('base'), and, if it was started by a compaction, the snapshot
+        that compaction replaced ('prev'). Journals that do not follow the
+        snapshot are left over from an interrupted rewrite and skipped.
+
+        The records of an encrypted wallet are encrypted with a key derived
+        from the segment key, and authenticated with their journal and
+        position in it.
+        """
+        snapshot_id = self.data.get('journal_id')
+        replayed = None
+        for path in (self._rotated_journal_path(), self.journal_path()):
+            if not os.path.exists(path):
+                continue
+            if path != self.journal_path():
+                # finish the interrupted compaction with the next write
+                self._needs_snapshot = True
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.read().split('\n')
+            # the last line is either empty or a record torn by a crash
+            lines = lines[:-1]
+            if not lines:
+                continue
+            header = json.loads(lines[0])
+            if header.get('base') != snapshot_id and (replayed is None or header.get('prev') != replayed):
+                self.print_error('skipping stale journal', path)
+                self._needs_snapshot = True
+                continue
+            for i, line in enumerate(lines[1:]):
+                try:
+                    if encrypted:
+                        line = self._decrypt_record(line, header.get('base'), i)
+                    record = json.loads(line)
+                except Exception as e:
+                    raise WalletFileException('Cannot read wallet journal %s: %r' % (path, e))
+                self._apply_journal_record(record)
+            if path == self.journal_path():
+                self._journal_length = len(lines) - 1
+            replayed = header.get('base')
+            self.print_error('replayed journal', path, len(lines) - 1)
+
+    def _create_journal(self, header):
+        fd = os.open(self.journal_path(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IREAD | stat.S_IWRITE)
+        with open(fd, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_length = 0
+
+    def _append_journal(self):
+        if not os.path.exists(self.journal_path()):
+            self._create_journal({'base': self.data.get('journal_id')})
+        records = self._journal_records
+        if self.pubkey:
+            journal_id = self.data.get('journal_id')
+            records = [self._encrypt_record(r, journal_id, self._journal_length + i)
+                       for i, r in enumerate(records)]
+        self._journal_length += len(records)
+        s = ''.join(r + '\n' for r in records)
+        with open(self.journal_path(), 'a', encoding='utf-8') as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        self._journal_records = []
+        if size > max(JOURNAL_MIN_COMPACT_SIZE, os.path.getsize(self.path) // 4):
+            if not (self._compaction_thread and self._compaction_thread.is_alive()):
+                self._compaction_thread = threading.Thread(target=self.compact, name='wallet journal compaction')
+                self._compaction_thread.daemon = False
+                self._compaction_thread.start()
+        return len(s)
+
+    def compact(self):
+        """Fold the journal into a new snapshot.
+
+        The journal is moved aside and a new one started under the lock;
+        the snapshot is serialized from memory and written without it.
+        """
+        with self.lock:
+            if not self._journal or self._needs_snapshot or not os.path.exists(self.journal_path()):
+                return
+            self._snapshot_lock.acquire()
+            try:
+                prev_id = self.data.get('journal_id')
+                new_id = bh2u(os.urandom(16))
+                os.replace(self.journal_path(), self._rotated_journal_path())
+                self._create_journal({'base': new_id, 'prev': prev_id})
+                self.data['journal_id'] = new_id
+                self._invalidate('journal_id')
+                s = self._serialize()
+            except BaseException:
+                self._snapshot_lock.release()
+                raise
+        try:
+            t0 = time.time()
+            self._write_file(s)
+            os.remove(self._rotated_journal_path())
+            self.print_error("compacted", self.path)
+        finally:
+            self._snapshot_lock.release()
         with self.lock:
-            if value is not None:
-                if self.data.get(key) != value:
-                    self.modified = True
-                    self.data[key] = copy.deepcopy(value)
-            elif key in self.data:
-                self.modified = True
-                self.data.pop(key)
+            self._count_write(time.time() - t0, len(s))
+
+    def _encrypt(self, s):
+        c = zlib.compress(bytes(s, 'utf8'))
+        enc_magic = self._get_encryption_magic()
+        public_key = ecc.ECPubkey(bfh(self.pubkey))
+        return public_key.encrypt_message(c, enc_magic).decode('utf8')
+
+    def _serialize(self):
+        if self.pubkey:
+            s = self._serialize_segments()
+        elif self._binary:
+            s = self._serialize_binary()
+        elif self._records_changes():
+            s = json.dumps(self.data, indent=4, sort_keys=True, cls=util.MyEncoder)
+        else:
+            s = self._serialize_fragments()
+        if self._records_changes():
+            # the snapshot is written rarely, do not keep its pieces around
+            self._fragments.clear()
+            self._segments.clear()
+        return s
+
+    def _serialize_fragments(self):
+        """Same as json.dumps(self.data, indent=4, sort_keys=True), but
+        reusing the serialization of the keys that did not change since
+        the last write."""
+        parts = []
+        for key in sorted(self.data):
+            f = self._fragments.get(key)
+            if f is None:
+                v = json.dumps(self.data[key], indent=4, sort_keys=True, cls=util.MyEncoder)
+                # newlines within strings are escaped, these are all indentation
+                f = self._fragments[key] = '    %s: %s' % (json.dumps(key), v.replace('\n', '\n    '))
+            parts.append(f)
+        return '{\n' + ',\n'.join(parts) + '\n}' if parts else '{}'
+
+    def _serialize_binary(self):
+        parts = [wallet_binary.encode_header()]
+        for key in sorted(self.data):
+            f = self._fragments.get(key)
+            if f is None:
+                f = self._fragments[key] = wallet_binary.encode_key(key, self.data[key])
+            parts.append(f)
+        return b''.join(parts)
+
+    def set_write_behind(self, delay, max_changes=100):
+        """Make write() schedule the write instead of doing it.
+
+        Writes are coalesced, and done by a background thread at most
+        delay seconds, or max_changes calls to write(), after the first
+        one. flush() writes synchronously. A delay of 0 turns this off.
+        """
+        with self.lock:
+            self._write_delay = delay
+            self._write_max_changes = max_changes
+        if not delay:
+            self.flush()
 
     @profiler
     def write(self):
         with self.lock:
+            if self._write_delay:
+                self._schedule_write()
+            else:
+                self._write()
+
+    def _schedule_write(self):
+        self._pending_writes += 1
+        if self._pending_writes >= self._write_max_changes:
+            delay = 0
+        elif self._write_timer is not None:
+            self.write_stats['coalesced'] += 1
+            return
+        else:
+            delay = self._write_delay
+        if self._write_timer is not None:
+            self._write_timer.cancel()
+        # not a daemon thread, so that a pending write is done before exit
+        self._write_timer = threading.Timer(delay, self.flush)
+        self._write_timer.daemon = False
+        self._write_timer.name = 'wallet write-behind'
+        self._write_timer.start()
+
+    def flush(self):
+        """Write pending changes now."""
+        if threading.currentThread().isDaemon():
+            # daemon threads may be killed in the middle of a write at exit
+            t = threading.Thread(target=self.flush, name='wallet flush')
+            t.daemon = False
+            t.start()
+            t.join()
+            return
+        with self.lock:
+            self._pending_writes = 0
             self._write()
+            if self._write_timer is not None:
+                self._write_timer.cancel()
+                self._write_timer = None
 
     def _write(self):
         if threading.currentThread().isDaemon():
@@ -252,17 +781,61 @@ class WalletStorage(PrintError):
             return
         if not self.modified:
             return
-        s = json.dumps(self.data, indent=4, sort_keys=True, cls=util.MyEncoder)
-        if self.pubkey:
-            s = bytes(s, 'utf8')
-            c = zlib.compress(s)
-            enc_magic = self._get_encryption_magic()
-            public_key = ecc.ECPubkey(bfh(self.pubkey))
-            s = public_key.encrypt_message(c, enc_magic)
-            s = s.decode('utf8')
+        t0 = time.time()
+        n = self._write_changes()
+        self._count_write(time.time() - t0, n)
+
+    def _count_write(self, latency, n):
+        stats = self.write_stats
+        stats['writes'] += 1
+        stats['bytes'] += n
+        stats['time'] += latency
+        stats['max_latency'] = max(stats['max_latency'], latency)
+
+    def _write_changes(self):
+        """Write the changes, return the number of bytes written."""
+        if self._db is not None:
+            records = self._journal_records
+            self._db.apply([json.loads(r) for r in records])
+            self._db.attach_views(self.data)
+            self._journal_records = []
+            self.modified = False
+            return sum(len(r) for r in records)
+        # the journal of an encrypted wallet needs the key of its segments,
+        # a file written as one ECIES message by older versions has none
+        if (self._journal and not self._needs_snapshot and self.file_exists()
+                and (not self.pubkey or self._segment_key is not None)):
+            n = self._append_journal()
+            self.modified = False
+            return n
+        with self._snapshot_lock:
+            if self._journal:
+                self.data['journal_id'] = bh2u(os.urandom(16))
+                self._invalidate('journal_id')
+            elif self.data.pop('journal_id', None):
+                self._invalidate('journal_id')
+            s = self._serialize()
+            self._write_file(s)
+            # the journals, if any, are now stale
+            for path in (self.journal_path(), self._rotated_journal_path()):
+                if os.path.exists(path):
+                    os.remove(path)
+        self._journal_records = []
+        self._needs_snapshot = False
+        self.modified = False
+        return len(s)
 
+    def get_write_stats(self):
+        with self.lock:
+            return dict(self.write_stats)
+
+    def _write_file(self, s):
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
-        with open(temp_path, "w", encoding='utf-8') as f:
+        if isinstance(s, bytes):
+            f = open(temp_path, "wb")
+        else:
+            f = open(temp_path, "w", encoding='utf-8')
+        with f:
             f.write(s)
             f.flush()
             os.fsync(f.fileno())
@@ -276,7 +849,80 @@ class WalletStorage(PrintError):
             os.rename(temp_path, self.path)
         os.chmod(self.path, mode)
         self.print_error("saved", self.path)
-        self.modified = False
+
+    def is_sqlite(self):
+        return self._db is not None
+
+    def upgrade_to_sqlite(self):
+        """Convert the wallet file to an SQLite database."""
+        if self._db is not None:
+            return
+        if self.is_encrypted():
+            raise WalletFileException('SQLite wallet files cannot be encrypted')
+        if self.requires_upgrade():
+            self.upgrade()
+        with self.lock:
+            self.data.pop('use_journal', None)
+            self.data.pop('journal_id', None)
+            temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            db = WalletDB(temp_path)
+            db.save_data(self.data)
+            # fold the WAL into the database file before moving it
+            db.conn.execute('PRAGMA journal_mode=DELETE')
+            db.close()
+            mode = os.stat(self.path).st_mode if os.path.exists(self.path) else stat.S_IREAD | stat.S_IWRITE
+            os.replace(temp_path, self.path)
+            os.chmod(self.path, mode)
+            for path in (self.journal_path(), self._rotated_journal_path()):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._db = WalletDB(self.path)
+            self._db.attach_views(self.data)
+            self._binary = False
+            self._journal = False
+            self._journal_records = []
+            self._needs_snapshot = False
+            self.modified = False
+            self.print_error("converted to sqlite", self.path)
+
+    def get_file_format(self):
+        if self._db is not None:
+            return 'sqlite'
+        return 'binary' if self._binary else 'json'
+
+    def convert_format(self, file_format):
+        """Rewrite the wallet file in another format: 'json', 'binary'
+        or 'sqlite'. The conversion is lossless in every direction."""
+        if file_format not in FILE_FORMATS:
+            raise WalletFileException('Unknown wallet file format: %s' % file_format)
+        if file_format == self.get_file_format():
+            return
+        if file_format == 'sqlite':
+            self.upgrade_to_sqlite()
+            return
+        if file_format == 'binary' and self.is_encrypted():
+            raise WalletFileException('Binary wallet files cannot be encrypted')
+        if self.requires_upgrade():
+            self.upgrade()
+        with self.lock:
+            if self._db is not None:
+                self._db.detach_views(self.data)
+                self._db.close()
+                self._db = None
+                for path in (self.path + '-wal', self.path + '-shm'):
+                    if os.path.exists(path):
+                        os.remove(path)
+            self._binary = file_format == 'binary'
+            self._fragments = {}
+            self._segments = {}
+            self._dirty_segments = set()
+            self._journal_records = []
+            self._needs_snapshot = True
+            self.modified = True
+        self.flush()
+        self.print_error("converted to", file_format, self.path)
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -343,6 +989,7 @@ class WalletStorage(PrintError):
         self.convert_version_15()
         self.convert_version_16()
         self.convert_version_17()
+        self.convert_version_18()
 
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
         self.write()
@@ -557,6 +1204,15 @@ class WalletStorage(PrintError):
 
         self.put('seed_version', 17)
 
+    def convert_version_18(self):
+        # nothing to convert. Files of this version may be journaled,
+        # encrypted in segments, binary or sqlite, which older versions
+        # would misread, or read without the journal.
+        if not self._is_upgrade_method_needed(17, 17):
+            return
+
+        self.put('seed_version', 18)
+
     def convert_imported(self):
         if not self._is_upgrade_method_needed(0, 13):
             return
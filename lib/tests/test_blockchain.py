@@ -0,0 +1,468 @@
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from lib import blockchain, constants
+from lib.network import Network
+from lib.blockchain import (Blockchain, Header, MAX_TARGET, deserialize_header,
+                            hash_header, merkle_branch_and_root, root_from_merkle_branch,
+                            verify_chunk_data)
+from lib.bitcoin import hash_encode
+from lib.simple_config import SimpleConfig
+from lib.util import bfh, make_dir
+
+from . import SequentialTestCase
+
+
+def make_headers(count, prev_hash='00'*32, nonce=0, bits=0x207fffff, spacing=600):
+    """Builds a chain of linked (regtest, no PoW) raw headers."""
+    headers = []
+    for i in range(count):
+        h = {
+            'version': 0x20000000,
+            'prev_block_hash': prev_hash,
+            'merkle_root': '%064x' % (i + 1),
+            'timestamp': 1500000000 + spacing * i,
+            'bits': bits,
+            'nonce': nonce,
+        }
+        raw = bfh(blockchain.serialize_header(h))
+        headers.append(raw)
+        prev_hash = hash_header(deserialize_header(raw, i))
+    return headers
+
+
+class TestHeader(SequentialTestCase):
+
+    GENESIS_RAW = bfh(
+        '0100000000000000000000000000000000000000000000000000000000000000'
+        '000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa'
+        '4b1e5e4a29ab5f49ffff001d1dac2b7c')
+
+    def test_parse(self):
+        header = Header(self.GENESIS_RAW, 0)
+        self.assertEqual(1, header.version)
+        self.assertEqual('00'*32, header.prev_block_hash)
+        self.assertEqual('4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b', header.merkle_root)
+        self.assertEqual(1231006505, header.timestamp)
+        self.assertEqual(0x1d00ffff, header.bits)
+        self.assertEqual(2083236893, header.nonce)
+        self.assertEqual('000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f', header.hash())
+
+    def test_dict_compatibility(self):
+        header = Header(self.GENESIS_RAW, 0)
+        d = deserialize_header(self.GENESIS_RAW, 0)
+        self.assertEqual(d, header.as_dict())
+        self.assertEqual(header, d)
+        self.assertEqual(d['bits'], header['bits'])
+        self.assertEqual(d.get('merkle_root'), header.get('merkle_root'))
+        self.assertIsNone(header.get('unknown'))
+        with self.assertRaises(KeyError):
+            header['unknown']
+        self.assertEqual(hash_header(d), hash_header(header))
+        self.assertEqual(header, Header.from_dict(d))
+
+    def test_invalid_length(self):
+        with self.assertRaises(Exception):
+            Header(self.GENESIS_RAW[:79], 0)
+
+    def test_verify_chunk_data_pow(self):
+        hashes = verify_chunk_data(self.GENESIS_RAW, bytes(32), MAX_TARGET, 0x1d00ffff, True)
+        self.assertEqual(Header(self.GENESIS_RAW, 0).hash_bytes(), hashes)
+        with self.assertRaises(Exception):
+            verify_chunk_data(self.GENESIS_RAW, bytes(32), MAX_TARGET, 0x1d00fffe, True)
+        bad_nonce = self.GENESIS_RAW[:76] + bytes(4)
+        with self.assertRaises(Exception):
+            verify_chunk_data(bad_nonce, bytes(32), MAX_TARGET, 0x1d00ffff, True)
+        verify_chunk_data(bad_nonce, bytes(32), MAX_TARGET, 0x1d00ffff, False)
+
+    def test_verify_chunk_data_links(self):
+        headers = make_headers(5)
+        hashes = verify_chunk_data(b''.join(headers), bytes(32), 0, 0, False)
+        self.assertEqual(b''.join(Header(h, i).hash_bytes() for i, h in enumerate(headers)), hashes)
+        with self.assertRaises(Exception):
+            verify_chunk_data(b''.join(headers[:2] + headers[3:]), bytes(32), 0, 0, False)
+        with self.assertRaises(Exception):
+            verify_chunk_data(b''.join(headers[1:]), bytes(32), 0, 0, False)
+        verify_chunk_data(b''.join(headers[1:]), None, 0, 0, False)
+        with self.assertRaises(Exception):
+            verify_chunk_data(b''.join(headers)[:-1], bytes(32), 0, 0, False)
+
+
+class BlockchainTestCase(SequentialTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        make_dir(os.path.join(self.data_dir, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.data_dir})
+        blockchain.blockchains.clear()
+        blockchain.recent_hashes.clear()
+        self.headers = make_headers(10)
+        open(os.path.join(self.data_dir, 'blockchain_headers'), 'wb').close()
+        self.chain = Blockchain(self.config, 0, None)
+        blockchain.blockchains[0] = self.chain
+
+    def tearDown(self):
+        blockchain.blockchains.clear()
+        shutil.rmtree(self.data_dir)
+        super().tearDown()
+
+
+class TestBlockchain(BlockchainTestCase):
+
+    def test_read_header_empty_file(self):
+        self.assertEqual(-1, self.chain.height())
+        self.assertIsNone(self.chain.read_header(0))
+
+    def test_read_header_after_growth(self):
+        self.chain.write(b''.join(self.headers[:5]), 0)
+        self.assertEqual(deserialize_header(self.headers[4], 4), self.chain.read_header(4).as_dict())
+        self.chain.write(b''.join(self.headers[5:]), 5*80)
+        self.assertEqual(9, self.chain.height())
+        for i, raw in enumerate(self.headers):
+            self.assertEqual(Header(raw, i), self.chain.read_header(i))
+            self.assertEqual(raw, bytes(self.chain.read_raw_header(i)))
+
+    def test_read_header_after_truncation(self):
+        self.chain.write(b''.join(self.headers), 0)
+        self.assertIsNotNone(self.chain.read_header(9))
+        other = make_headers(3, prev_hash=hash_header(self.chain.read_header(6)), nonce=1)
+        self.chain.write(b''.join(other), 7*80)
+        self.assertEqual(9, self.chain.height())
+        self.assertEqual(Header(other[0], 7), self.chain.read_header(7))
+        self.chain.write(b'', 4*80)
+        self.assertEqual(3, self.chain.height())
+        self.assertIsNone(self.chain.read_header(4))
+
+    def test_outstanding_view_does_not_block_writes(self):
+        self.chain.write(b''.join(self.headers[:5]), 0)
+        view = self.chain.read_raw_header(0)
+        self.chain.write(b''.join(self.headers[5:]), 5*80)
+        self.assertEqual(self.headers[0], bytes(view))
+        self.assertEqual(self.headers[9], bytes(self.chain.read_raw_header(9)))
+        view.release()
+
+    def test_can_connect(self):
+        self.chain.write(b''.join(self.headers[:5]), 0)
+        self.assertTrue(self.chain.can_connect(Header(self.headers[5], 5)))
+        self.assertTrue(self.chain.can_connect(deserialize_header(self.headers[5], 5)))
+        self.assertFalse(self.chain.can_connect(Header(self.headers[6], 6)))
+        self.assertFalse(self.chain.can_connect(Header(self.headers[6], 5)))
+        self.chain.save_header(Header(self.headers[5], 5))
+        self.assertEqual(5, self.chain.height())
+        self.assertEqual(self.chain, blockchain.check_header(Header(self.headers[3], 3)))
+
+    def test_save_header_group_commit(self):
+        self.chain.write(self.headers[0], 0)
+        with mock.patch('os.fsync') as fsync, \
+                mock.patch.object(blockchain, 'SYNC_INTERVAL', 3600):
+            for i in range(1, 10):
+                self.chain.save_header(Header(self.headers[i], i))
+            self.assertEqual(0, fsync.call_count)
+            self.chain.sync()
+            self.assertEqual(1, fsync.call_count)
+            self.chain.sync()
+            self.assertEqual(1, fsync.call_count)
+        self.assertEqual(9, self.chain.height())
+
+    def test_save_header_sync_after_max_headers(self):
+        self.chain.write(self.headers[0], 0)
+        with mock.patch('os.fsync') as fsync, \
+                mock.patch.object(blockchain, 'SYNC_INTERVAL', 3600), \
+                mock.patch.object(blockchain, 'SYNC_MAX_HEADERS', 4):
+            for i in range(1, 10):
+                self.chain.save_header(Header(self.headers[i], i))
+            self.assertEqual(2, fsync.call_count)
+
+    def test_read_blockchains_truncates_torn_tail(self):
+        torn = bytearray(self.headers[7])
+        torn[20:] = bytes(60)
+        self.chain.write(b''.join(self.headers[:7]) + bytes(torn) + self.headers[8], 0)
+        self.assertEqual(8, self.chain.height())
+        # only the unsynced tail is verified; our synthetic genesis would not pass
+        with mock.patch.object(blockchain, 'SYNC_MAX_HEADERS', 4):
+            chains = blockchain.read_blockchains(self.config)
+        self.assertEqual(6, chains[0].height())
+
+    def test_hash_index(self):
+        self.chain.write(b''.join(self.headers), 0)
+        for i, raw in enumerate(self.headers[1:], 1):
+            self.assertEqual(Header(raw, i).hash(), self.chain.get_hash(i))
+        self.assertEqual('00'*32, self.chain.get_hash(10))
+        # overwriting headers must invalidate their cached hashes
+        other = make_headers(3, prev_hash=self.chain.get_hash(6), nonce=1)
+        self.chain.write(b''.join(other), 7*80)
+        self.assertEqual(Header(other[2], 9).hash(), self.chain.get_hash(9))
+        self.assertEqual(Header(self.headers[6], 6).hash(), self.chain.get_hash(6))
+
+    def test_fork_and_swap_with_parent(self):
+        self.chain.write(b''.join(self.headers[:8]), 0)
+        fork_headers = make_headers(4, prev_hash=self.chain.get_hash(5), nonce=1)
+        fork = self.chain.fork(Header(fork_headers[0], 6))
+        blockchain.blockchains[6] = fork
+        self.assertEqual(fork, blockchain.check_header(Header(fork_headers[0], 6)))
+        self.assertEqual(self.chain, blockchain.check_header(Header(self.headers[6], 6)))
+        fork.save_header(Header(fork_headers[1], 7))
+        self.assertEqual(0, self.chain.checkpoint)
+        # fork becomes longer than its parent branch
+        fork.save_header(Header(fork_headers[2], 8))
+        self.assertEqual(0, fork.checkpoint)
+        self.assertIsNone(fork.parent_id)
+        self.assertEqual(6, self.chain.checkpoint)
+        self.assertIs(fork, blockchain.blockchains[0])
+        self.assertIs(self.chain, blockchain.blockchains[6])
+        self.assertEqual(8, fork.height())
+        self.assertEqual(7, self.chain.height())
+        for i in range(1, 6):
+            self.assertEqual(Header(self.headers[i], i).hash(), fork.get_hash(i))
+        for i in range(6, 9):
+            self.assertEqual(Header(fork_headers[i - 6], i).hash(), fork.get_hash(i))
+            self.assertEqual(fork, blockchain.check_header(Header(fork_headers[i - 6], i)))
+        for i in range(6, 8):
+            self.assertEqual(Header(self.headers[i], i).hash(), self.chain.get_hash(i))
+            self.assertEqual(self.chain, blockchain.check_header(Header(self.headers[i], i)))
+        blockchain.recent_hashes.clear()
+        self.assertEqual(fork, blockchain.check_header(Header(fork_headers[2], 8)))
+        self.assertEqual(self.chain, blockchain.check_header(Header(self.headers[7], 7)))
+
+    def test_swap_with_parent_streams_in_blocks(self):
+        with mock.patch.object(blockchain, 'COPY_BLOCK_SIZE', 160):
+            self.test_fork_and_swap_with_parent()
+        self.assertEqual([], os.listdir(os.path.join(self.data_dir, 'forks'))[1:])
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir, 'forks', 'swap_tmp')))
+        # the demoted branch is a fork file that connects on restart
+        blockchain.blockchains.clear()
+        with mock.patch.object(blockchain, 'SYNC_MAX_HEADERS', 4):
+            chains = blockchain.read_blockchains(self.config)
+        self.assertEqual([0, 6], sorted(chains.keys()))
+        self.assertEqual(8, chains[0].height())
+        self.assertEqual(7, chains[6].height())
+
+    def test_interrupted_swap_is_rolled_back(self):
+        self.chain.write(b''.join(self.headers[:8]), 0)
+        fork_headers = make_headers(3, prev_hash=self.chain.get_hash(5), nonce=1)
+        fork = self.chain.fork(Header(fork_headers[0], 6))
+        blockchain.blockchains[6] = fork
+        fork.save_header(Header(fork_headers[1], 7))
+        replace = os.replace
+        def crash_before_fork_file_is_replaced(src, dst):
+            if src.endswith('swap_tmp'):
+                raise KeyboardInterrupt()
+            replace(src, dst)
+        with mock.patch('os.replace', crash_before_fork_file_is_replaced):
+            with self.assertRaises(KeyboardInterrupt):
+                fork.save_header(Header(fork_headers[2], 8))
+        self.assertTrue(os.path.exists(blockchain.swap_marker_path(self.config)))
+        blockchain.blockchains.clear()
+        with mock.patch.object(blockchain, 'SYNC_MAX_HEADERS', 4):
+            chains = blockchain.read_blockchains(self.config)
+        self.assertFalse(os.path.exists(blockchain.swap_marker_path(self.config)))
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir, 'forks', 'swap_tmp')))
+        self.assertEqual([0, 6], sorted(chains.keys()))
+        self.assertEqual(7, chains[0].height())
+        self.assertEqual(8, chains[6].height())
+        for i in range(1, 8):
+            self.assertEqual(Header(self.headers[i], i).hash(), chains[0].get_hash(i))
+        for i in range(6, 9):
+            self.assertEqual(Header(fork_headers[i - 6], i).hash(), chains[6].get_hash(i))
+        # a swap that got to replace the fork file is left alone
+        open(blockchain.swap_marker_path(self.config), 'w').write(
+            '{"parent": "blockchain_headers", "offset": 0, "tmp": "forks/swap_tmp"}')
+        blockchain.rollback_interrupted_swap(self.config)
+        self.assertFalse(os.path.exists(blockchain.swap_marker_path(self.config)))
+        self.assertEqual(7, chains[0].height())
+
+    def test_target_cache(self):
+        headers = make_headers(2 * 2016, bits=0x1d00ffff, spacing=300)
+        self.chain.write(b''.join(headers), 0)
+        self.chain.checkpoints = []
+        with mock.patch.object(constants, 'net', constants.BitcoinMainnet):
+            target = self.chain.get_target(0)
+            self.assertEqual(MAX_TARGET * 2015 * 300 // (14 * 24 * 60 * 60), target)
+            with mock.patch.object(self.chain, 'read_header', side_effect=Exception):
+                self.assertEqual(target, self.chain.get_target(0))
+            # persisted alongside the headers file
+            self.chain.sync()
+            chain = Blockchain(self.config, 0, None)
+            chain.checkpoints = []
+            with mock.patch.object(chain, 'read_header', side_effect=Exception):
+                self.assertEqual(target, chain.get_target(0))
+            # a reorg of the chunk invalidates it
+            other = make_headers(2, prev_hash=self.chain.get_hash(2013), bits=0x1d00ffff, spacing=600)
+            self.chain.write(b''.join(other), 2014 * 80)
+            self.assertEqual(2015, self.chain.height())
+            self.assertNotEqual(target, self.chain.get_target(0))
+            # entries loaded from disk are checked against the headers
+            chain = Blockchain(self.config, 0, None)
+            chain.checkpoints = []
+            self.assertEqual(self.chain.get_target(0), chain.get_target(0))
+
+    def test_target_cache_non_truncating_write(self):
+        headers = make_headers(3 * 2016, bits=0x1d00ffff, spacing=300)
+        self.chain.write(b''.join(headers), 0)
+        self.chain.checkpoints = []
+        with mock.patch.object(constants, 'net', constants.BitcoinMainnet):
+            for index in range(3):
+                self.chain.get_target(index)
+            self.assertEqual({0, 1, 2}, set(self.chain._targets))
+            # rewriting headers of chunk 1 only drops its target
+            self.chain.write(b''.join(headers[2100:2200]), 2100 * 80, truncate=False)
+            self.assertEqual({0, 2}, set(self.chain._targets))
+            self.chain.write(b''.join(headers[2015:2017]), 2015 * 80, truncate=False)
+            self.assertEqual({2}, set(self.chain._targets))
+            self.assertEqual(3 * 2016 - 1, self.chain.height())
+
+    def test_connect_chunks(self):
+        headers = make_headers(3 * 2016)
+        chunks = [b''.join(headers[i*2016:(i+1)*2016]) for i in range(3)]
+        self.assertTrue(self.chain.connect_chunk(0, chunks[0].hex()))
+        self.assertEqual(2015, self.chain.height())
+        broken = chunks[2][:80] + chunks[2][160:]
+        self.assertEqual(1, self.chain.connect_chunks(1, [chunks[1], broken]))
+        self.assertEqual(4031, self.chain.height())
+        self.chain.write(b'', 2016 * 80)
+        self.assertEqual(2, self.chain.connect_chunks(1, chunks[1:], processes=2))
+        self.assertEqual(3 * 2016 - 1, self.chain.height())
+        self.assertEqual(Header(headers[-1], 3 * 2016 - 1).hash(), self.chain.get_hash(3 * 2016 - 1))
+        self.assertEqual(self.chain, blockchain.check_header(Header(headers[3000], 3000)))
+
+    def test_export_import_headers(self):
+        headers = make_headers(2016 + 10)
+        self.chain.write(b''.join(headers), 0)
+        snapshot = os.path.join(self.data_dir, 'headers.gz')
+        self.assertEqual(2026, self.chain.export_headers(snapshot))
+
+        other_dir = tempfile.mkdtemp()
+        try:
+            make_dir(os.path.join(other_dir, 'forks'))
+            config = SimpleConfig({'electrum_path': other_dir})
+            blockchain.blockchains.clear()
+            chain = blockchain.read_blockchains(config)[0]
+            self.assertEqual(2025, chain.import_headers(snapshot))
+            self.assertEqual(self.chain.get_hash(2025), chain.get_hash(2025))
+            # importing again is a no-op
+            self.assertEqual(2025, chain.import_headers(snapshot, processes=2))
+        finally:
+            shutil.rmtree(other_dir)
+
+    def test_import_headers_rejects_invalid_snapshot(self):
+        headers = make_headers(20)
+        snapshot = os.path.join(self.data_dir, 'headers.gz')
+        with gzip.open(snapshot, 'wb') as f:
+            f.write(b''.join(headers[:5] + headers[6:]))
+        with self.assertRaises(Exception):
+            self.chain.import_headers(snapshot)
+        self.assertEqual(-1, self.chain.height())
+
+
+class FakeHeaderServer:
+    """Stand-in for a server answering blockchain.block.header with cp_height."""
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.hashes = [Header(raw, i).hash_bytes() for i, raw in enumerate(headers)]
+
+    def block_header(self, height, cp_height):
+        branch, root = merkle_branch_and_root(self.hashes[:cp_height + 1], height)
+        return {
+            'header': self.headers[height].hex(),
+            'branch': [hash_encode(h) for h in branch],
+            'root': hash_encode(root),
+        }
+
+
+class TestCheckpointedHeaders(BlockchainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.headers = make_headers(2 * 2016 + 5)
+        hashes = [Header(raw, i).hash() for i, raw in enumerate(self.headers)]
+        self.chain.checkpoints = [(hashes[2015], 0), (hashes[4031], 0)]
+        self.chain.init_headers_file()
+        self.server = FakeHeaderServer(self.headers)
+        # what we would ship in constants
+        self.cp_root = hash_encode(merkle_branch_and_root(self.server.hashes[:4032], 0)[1])
+
+    def test_merkle_branch(self):
+        for index in (0, 1, 5, 2015, 4031):
+            branch, root = merkle_branch_and_root(self.server.hashes[:4032], index)
+            self.assertEqual(root, root_from_merkle_branch(self.server.hashes[index], branch, index))
+            self.assertNotEqual(root, root_from_merkle_branch(self.server.hashes[index], branch, index ^ 1))
+
+    def test_connect_checkpointed_header(self):
+        self.assertEqual(4031, self.chain.checkpoint_height())
+        self.assertIsNone(self.chain.read_header(100))
+        for height in (100, 3000, 4031):
+            result = self.server.block_header(height, 4031)
+            self.assertTrue(self.chain.connect_checkpointed_header(height, result, self.cp_root))
+            self.assertEqual(Header(self.headers[height], height), self.chain.read_header(height))
+        self.assertIsNone(self.chain.read_header(101))
+        self.assertEqual(4031, self.chain.height())
+
+    def test_reject_bad_proof(self):
+        result = self.server.block_header(100, 4031)
+        self.assertFalse(self.chain.connect_checkpointed_header(101, result, self.cp_root))
+        result = dict(result, header=self.headers[101].hex())
+        self.assertFalse(self.chain.connect_checkpointed_header(100, result, self.cp_root))
+        result = self.server.block_header(100, 4031)
+        self.assertFalse(self.chain.connect_checkpointed_header(100, result, '00' * 32))
+        self.assertFalse(self.chain.connect_checkpointed_header(4032, self.server.block_header(4032, 4032), self.cp_root))
+        self.assertIsNone(self.chain.read_header(100))
+
+    def test_get_checkpoint_merkle_root(self):
+        self.chain.write(b''.join(self.headers[:4032]), 0, truncate=False)
+        self.assertEqual(self.cp_root, self.chain.get_checkpoint_merkle_root())
+
+    def make_network(self, protocol_version):
+        network = mock.Mock(spec=Network)
+        network.blockchains = {0: self.chain}
+        network.requested_header_proofs = set()
+        network.get_checkpoint_merkle_root.return_value = self.cp_root
+        network.supports_header_proofs = lambda interface: Network.supports_header_proofs(network, interface)
+        interface = mock.Mock(server='server', protocol_version=protocol_version)
+        return network, interface
+
+    def test_on_header_proof(self):
+        network, interface = self.make_network('1.4')
+        Network.request_checkpointed_header(network, interface, 100)
+        network.queue_request.assert_called_once_with('blockchain.block.header', [100, 4031], interface)
+        response = {'params': [100, 4031], 'result': self.server.block_header(100, 4031), 'error': None}
+        Network.on_header_proof(network, interface, response)
+        network.connection_down.assert_not_called()
+        self.assertEqual(Header(self.headers[100], 100), self.chain.read_header(100))
+
+    def test_on_header_proof_rejects_branch_not_matching_root(self):
+        network, interface = self.make_network('1.4')
+        Network.request_checkpointed_header(network, interface, 100)
+        result = self.server.block_header(100, 4031)
+        # a branch of another header, with the root we trust
+        result['branch'] = self.server.block_header(101, 4031)['branch']
+        response = {'params': [100, 4031], 'result': result, 'error': None}
+        Network.on_header_proof(network, interface, response)
+        network.connection_down.assert_called_once_with('server')
+        self.assertIsNone(self.chain.read_header(100))
+
+    def test_header_proofs_need_protocol_1_4(self):
+        network, interface = self.make_network('1.2')
+        Network.request_checkpointed_header(network, interface, 100)
+        network.request_chunk.assert_called_once_with(interface, 0)
+        network.queue_request.assert_not_called()
+        # the negotiated version decides how to subscribe to headers
+        for version, params in (('1.4', []), ('1.2', [True])):
+            network.queue_request.reset_mock()
+            Network.on_server_version(network, interface, {'result': ['ElectrumX 1.8', version], 'error': None})
+            self.assertEqual(version, interface.protocol_version)
+            network.queue_request.assert_called_once_with('blockchain.headers.subscribe', params, interface)
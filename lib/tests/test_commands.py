@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 from decimal import Decimal
 
 from lib.commands import Commands
@@ -31,3 +32,11 @@ class TestCommands(unittest.TestCase):
         self.assertEqual("2asd", Commands._setconfig_normalize_value('rpcpassword', '2asd'))
         self.assertEqual("['file:///var/www/','https://electrum.org']",
             Commands._setconfig_normalize_value('rpcpassword', "['file:///var/www/','https://electrum.org']"))
+
+    def test_importheaders_refused_while_network_runs(self):
+        network = mock.Mock()
+        network.is_running.return_value = True
+        cmds = Commands(config=None, wallet=None, network=network)
+        with self.assertRaises(Exception) as e:
+            cmds.importheaders('headers.gz')
+        self.assertIn('network is running', str(e.exception))
@@ -0,0 +1,110 @@
+from decimal import Decimal
+
+from lib.bitcoin import COIN
+from lib.cost_basis import CostBasis, AVERAGE, FIFO
+
+from . import SequentialTestCase
+
+
+PRICES = {1: 100, 2: 200, 3: 250}
+CURRENT_PRICE = 300
+
+
+def price_func(timestamp):
+    return Decimal(PRICES.get(timestamp, CURRENT_PRICE))
+
+
+class FakeWallet:
+
+    def __init__(self):
+        self.txi = {}
+        self.timestamps = {}
+        self.values = {}
+        self.fiat_values = {}
+
+    def add_tx(self, txid, timestamp, value, inputs=()):
+        self.timestamps[txid] = timestamp
+        self.values[txid] = value
+        self.txi[txid] = {'addr': set(inputs)} if inputs else {}
+
+    def get_tx_height(self, txid):
+        return 1, 1, self.timestamps.get(txid)
+
+    def get_fiat_value(self, txid, ccy):
+        return self.fiat_values.get(txid)
+
+    def get_tx_value(self, txid):
+        return self.values[txid]
+
+
+class TestCostBasis(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # a and b receive 1 BTC each, c spends both: 1.5 BTC are sent,
+        # 0.4 BTC come back as change and 0.1 BTC are paid in fees
+        self.wallet = w = FakeWallet()
+        w.add_tx('a', 1, COIN)
+        w.add_tx('b', 2, COIN)
+        w.add_tx('c', 3, -16 * COIN // 10, [('a:0', COIN), ('b:0', COIN)])
+        self.history = [(txid, w.values[txid]) for txid in 'abc']
+        self.utxos = [{'prevout_hash': 'c', 'prevout_n': 1, 'value': 4 * COIN // 10}]
+
+    def run_cost_basis(self, method, history=None):
+        cb = CostBasis(self.wallet, price_func, 'USD', method)
+        return cb.run(history or self.history, self.utxos)
+
+    def test_average(self):
+        cb = self.run_cost_basis(AVERAGE)
+        self.assertEqual({'c': Decimal(240)}, cb.acquisition_prices)
+        self.assertEqual((Decimal(-400), True), cb.fiat_values['c'])
+        self.assertEqual(Decimal(60), cb.unrealized_gains)
+
+    def test_fifo(self):
+        cb = self.run_cost_basis(FIFO)
+        self.assertEqual({'c': Decimal(220)}, cb.acquisition_prices)
+        self.assertEqual(Decimal(40), cb.unrealized_gains)
+
+    def test_fiat_value_set_by_user(self):
+        self.wallet.fiat_values['b'] = Decimal(300)
+        cb = self.run_cost_basis(AVERAGE)
+        self.assertEqual((Decimal(300), False), cb.fiat_values['b'])
+        self.assertEqual({'c': Decimal(320)}, cb.acquisition_prices)
+        cb = self.run_cost_basis(FIFO)
+        self.assertEqual({'c': Decimal(280)}, cb.acquisition_prices)
+
+    def test_children_before_parents(self):
+        history = [self.history[i] for i in (0, 2, 1)]
+        self.assertEqual({'c': Decimal(240)}, self.run_cost_basis(AVERAGE, history).acquisition_prices)
+        self.assertEqual({'c': Decimal(220)}, self.run_cost_basis(FIFO, history).acquisition_prices)
+        history = self.history[::-1]
+        self.assertEqual({'c': Decimal(240)}, self.run_cost_basis(AVERAGE, history).acquisition_prices)
+        # b comes first in this history
+        self.assertEqual({'c': Decimal(260)}, self.run_cost_basis(FIFO, history).acquisition_prices)
+
+    def test_history_iterator(self):
+        history = iter([self.history[i] for i in (0, 2, 1)])
+        cb = CostBasis(self.wallet, price_func, 'USD', FIFO)
+        cb.run(history, self.utxos, {'a', 'b', 'c'}.__contains__)
+        self.assertEqual({'c': Decimal(220)}, cb.acquisition_prices)
+
+    def test_incomplete_history(self):
+        cb = self.run_cost_basis(FIFO, self.history[1:])
+        self.assertTrue(cb.acquisition_prices['c'].is_nan())
+
+    def test_long_chain(self):
+        w = self.wallet = FakeWallet()
+        w.add_tx('0', 1, COIN)
+        for i in range(1, 5000):
+            w.add_tx(str(i), 2, -1000, [('%d:0' % (i - 1), COIN - 1000 * (i - 1))])
+        self.history = [(str(i), w.values[str(i)]) for i in reversed(range(5000))]
+        self.utxos = [{'prevout_hash': '4999', 'prevout_n': 0, 'value': COIN - 1000 * 4999}]
+        cb = self.run_cost_basis(AVERAGE)
+        self.assertEqual(Decimal(100) * 1000 / COIN, cb.acquisition_prices['4999'])
+        self.assertEqual(Decimal(200) * (COIN - 1000 * 4999) / COIN, cb.unrealized_gains)
+        cb = self.run_cost_basis(FIFO)
+        self.assertEqual(Decimal(100) * 1000 / COIN, cb.acquisition_prices['4999'])
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            CostBasis(self.wallet, price_func, 'USD', 'lifo')
@@ -0,0 +1,77 @@
+import csv
+import datetime
+import io
+import json
+
+from lib.history_export import write_history
+from lib.util import Satoshis, json_encode
+
+from . import SequentialTestCase
+
+
+def make_items(n, summary=None):
+    balance = 0
+    for i in range(n):
+        balance += 1000 * (i + 1)
+        yield {
+            'txid': '%064x' % i,
+            'height': 100 + i,
+            'confirmations': n - i,
+            'timestamp': 1500000000 + i,
+            'date': datetime.datetime(2017, 7, 14, 2, 40, i),
+            'label': 'label %d' % i,
+            'value': Satoshis(1000 * (i + 1)),
+            'balance': Satoshis(balance),
+        }
+    # filled in at the end, like Abstract_Wallet.iter_full_history
+    if summary is not None and n:
+        summary['end_balance'] = Satoshis(balance)
+
+
+class TestHistoryExport(SequentialTestCase):
+
+    def test_csv(self):
+        f = io.StringIO()
+        self.assertEqual(3, write_history(f, make_items(3), 'csv'))
+        rows = list(csv.reader(io.StringIO(f.getvalue())))
+        self.assertEqual(["transaction_hash", "label", "confirmations", "value", "timestamp"], rows[0])
+        self.assertEqual(['%064x' % 2, 'label 2', '1', '0.00003 BTC', '2017-07-14 02:40:02'], rows[3])
+        self.assertEqual(4, len(rows))
+
+    def test_json(self):
+        f = io.StringIO()
+        self.assertEqual(3, write_history(f, make_items(3), 'json'))
+        self.assertEqual(json.loads(json_encode(list(make_items(3)))), json.loads(f.getvalue()))
+
+    def test_json_with_summary(self):
+        f = io.StringIO()
+        summary = {}
+        write_history(f, make_items(3, summary), 'json', summary)
+        expected_summary = {}
+        expected = {'transactions': list(make_items(3, expected_summary)), 'summary': expected_summary}
+        self.assertEqual(json.loads(json_encode(expected)), json.loads(f.getvalue()))
+
+    def test_jsonl(self):
+        f = io.StringIO()
+        summary = {}
+        self.assertEqual(3, write_history(f, make_items(3, summary), 'jsonl', summary))
+        lines = f.getvalue().splitlines()
+        self.assertEqual(4, len(lines))
+        self.assertEqual(json.loads(json_encode(list(make_items(3)))), [json.loads(l) for l in lines[:3]])
+        self.assertEqual({'summary': {'end_balance': '0.00006 BTC'}}, json.loads(lines[3]))
+
+    def test_empty(self):
+        f = io.StringIO()
+        self.assertEqual(0, write_history(f, make_items(0), 'json'))
+        self.assertEqual([], json.loads(f.getvalue()))
+        f = io.StringIO()
+        self.assertEqual(0, write_history(f, make_items(0), 'jsonl'))
+        self.assertEqual('', f.getvalue())
+        f = io.StringIO()
+        summary = {}
+        write_history(f, make_items(0, summary), 'json', summary)
+        self.assertEqual({'transactions': [], 'summary': {}}, json.loads(f.getvalue()))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            write_history(io.StringIO(), make_items(1), 'xml')
@@ -0,0 +1,633 @@
+import json
+import os
+from unittest import mock
+
+from lib import storage, wallet_binary, wallet_db
+from lib.storage import WalletStorage
+
+from lib.tests.test_wallet import WalletTestCase
+
+
+class TestStorageAccessors(WalletTestCase):
+
+    def test_get_view_does_not_copy(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('labels', {'x': 'y'})
+        self.assertIs(s.get_view('labels'), s.get_view('labels'))
+        self.assertIsNot(s.get('labels'), s.get_view('labels'))
+        self.assertEqual({}, s.get_view('missing', {}))
+
+    def test_put_owned(self):
+        s = WalletStorage(self.wallet_path)
+        s.write()
+        d = {'x': 'y'}
+        s.put_owned('labels', d)
+        self.assertIs(d, s.get_view('labels'))
+        self.assertTrue(s.modified)
+        s.write()
+        s.put_owned('labels', {'x': 'y'})
+        self.assertFalse(s.modified)
+        s.put_owned('labels', None)
+        self.assertTrue(s.modified)
+        self.assertEqual(None, s.get('labels'))
+
+    def test_put_item(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('labels', {'x': 'y'})
+        s.write()
+        s.put_item('labels', 'x', 'y')
+        self.assertFalse(s.modified)
+        s.put_item('labels', 'z', 'w')
+        s.put_item('labels', 'x', None)
+        s.put_item('labels', 'missing', None)
+        s.put_item('fiat_value', 'USD', {})
+        self.assertEqual({'z': 'w'}, s.get('labels'))
+        s.write()
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual({'z': 'w'}, s2.get('labels'))
+        self.assertEqual({'USD': {}}, s2.get('fiat_value'))
+
+    def test_unchanged_put_is_not_validated(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('labels', {'x': 'y'})
+        s.write()
+        with mock.patch.object(storage.json, 'dumps') as dumps:
+            s.put('labels', {'x': 'y'})
+        self.assertFalse(dumps.called)
+        self.assertFalse(s.modified)
+
+    def test_serialization_reuses_unchanged_keys(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('labels', {'x': 'y\nz', 'a': [1, {'b': None}]})
+        s.put('txi', {'aa': {'addr': {('bb:0', 1000)}}})
+        s.put('empty', {})
+        s.write()
+        self.assertEqual(json.dumps(s.data, indent=4, sort_keys=True, cls=storage.util.MyEncoder),
+                         s._serialize())
+        s.put('labels', {'x': 'z'})
+        self.assertNotIn('labels', s._fragments)
+        self.assertIn('txi', s._fragments)
+        s.write()
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual({'x': 'z'}, s2.get('labels'))
+        self.assertEqual({'aa': {'addr': [['bb:0', 1000]]}}, s2.get('txi'))
+
+
+class TestJournaledStorage(WalletTestCase):
+
+    def _new_storage(self):
+        s = WalletStorage(self.wallet_path)
+        s.set_journal(True)
+        s.put('transactions', {'aa': '00', 'bb': '11'})
+        s.write()
+        return s
+
+    def _journal_lines(self, s):
+        with open(s.journal_path()) as f:
+            return f.read().splitlines()
+
+    def test_write_appends_item_records(self):
+        s = self._new_storage()
+        self.assertFalse(os.path.exists(s.journal_path()))
+        with open(self.wallet_path) as f:
+            snapshot = f.read()
+        s.put('transactions', {'aa': '00', 'cc': '22'})
+        s.put('labels', {'x': 'y'})
+        s.write()
+        with open(self.wallet_path) as f:
+            self.assertEqual(snapshot, f.read())
+        records = [json.loads(line) for line in self._journal_lines(s)[1:]]
+        self.assertEqual([['put_item', 'transactions', 'cc', '22'],
+                          ['pop_item', 'transactions', 'bb'],
+                          ['put', 'labels', {'x': 'y'}]], records)
+
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual({'aa': '00', 'cc': '22'}, s2.get('transactions'))
+        self.assertEqual({'x': 'y'}, s2.get('labels'))
+        self.assertTrue(s2.is_journaled())
+
+    def test_put_item_records(self):
+        s = self._new_storage()
+        s.put_item('transactions', 'cc', '22')
+        s.put_item('transactions', 'aa', None)
+        s.write()
+        records = [json.loads(line) for line in self._journal_lines(s)[1:]]
+        self.assertEqual([['put_item', 'transactions', 'cc', '22'],
+                          ['pop_item', 'transactions', 'aa']], records)
+        self.assertEqual({'bb': '11', 'cc': '22'}, WalletStorage(self.wallet_path).get('transactions'))
+
+    def test_torn_record_is_ignored(self):
+        s = self._new_storage()
+        s.put('labels', {'x': 'y'})
+        s.write()
+        with open(s.journal_path(), 'a') as f:
+            f.write('["put","labels",{"x":')
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual({'x': 'y'}, s2.get('labels'))
+
+    def test_compact(self):
+        s = self._new_storage()
+        s.put('labels', {'x': 'y'})
+        s.write()
+        s.compact()
+        self.assertEqual(1, len(self._journal_lines(s)))
+        self.assertFalse(os.path.exists(self.wallet_path + '.journal.old'))
+        with open(self.wallet_path) as f:
+            self.assertEqual({'x': 'y'}, json.loads(f.read())['labels'])
+        s.put('labels', {'x': 'z'})
+        s.write()
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual({'x': 'z'}, s2.get('labels'))
+
+    def test_interrupted_compaction(self):
+        s = self._new_storage()
+        s.put('labels', {'x': 'y'})
+        s.write()
+        # crash after the journal was rotated, before the snapshot was renamed
+        with mock.patch.object(s, '_write_file', side_effect=OSError):
+            with self.assertRaises(OSError):
+                s.compact()
+        s.put('labels', {'x': 'z'})
+        s.write()
+        self.assertTrue(os.path.exists(self.wallet_path + '.journal.old'))
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual({'x': 'z'}, s2.get('labels'))
+        self.assertEqual({'aa': '00', 'bb': '11'}, s2.get('transactions'))
+        # the next write finishes the job
+        s2.put('labels', {})
+        s2.write()
+        self.assertFalse(os.path.exists(s2.journal_path()))
+        self.assertFalse(os.path.exists(self.wallet_path + '.journal.old'))
+
+    def test_stale_journal_is_skipped(self):
+        s = self._new_storage()
+        s.put('labels', {'x': 'y'})
+        s.write()
+        with open(s.journal_path()) as f:
+            journal = f.read()
+        s.put('labels', {'x': 'z'})
+        s.set_password(None)
+        s.write()
+        # as if we crashed before the journal was removed
+        with open(s.journal_path(), 'w') as f:
+            f.write(journal)
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual({'x': 'z'}, s2.get('labels'))
+
+    def test_background_compaction(self):
+        s = self._new_storage()
+        with mock.patch.object(storage, 'JOURNAL_MIN_COMPACT_SIZE', 0):
+            s.put('labels', {'x': 'y' * 1000})
+            s.write()
+        s._compaction_thread.join()
+        self.assertEqual(1, len(self._journal_lines(s)))
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual({'x': 'y' * 1000}, s2.get('labels'))
+
+    def test_encrypted_journal(self):
+        s = self._new_storage()
+        s.set_password('secret', storage.STO_EV_USER_PW)
+        s.write()
+        s.put('labels', {'x': 'y'})
+        s.write()
+        self.assertNotIn('labels', ''.join(self._journal_lines(s)))
+        s2 = WalletStorage(self.wallet_path)
+        self.assertTrue(s2.is_encrypted())
+        s2.decrypt('secret')
+        self.assertEqual({'x': 'y'}, s2.get('labels'))
+
+    def test_encrypted_journal_records(self):
+        s = self._new_storage()
+        s.set_password('secret', storage.STO_EV_USER_PW)
+        s.write()
+        # no ECIES per record
+        with mock.patch.object(storage.ecc.ECPubkey, 'encrypt_message') as encrypt_message:
+            s.put('labels', {'x': 'y'})
+            s.write()
+            s.put('labels', {'x': 'z'})
+            s.write()
+        self.assertFalse(encrypt_message.called)
+        lines = self._journal_lines(s)
+        self.assertEqual(3, len(lines))
+        # records cannot be moved
+        with open(s.journal_path(), 'w') as f:
+            f.write('\n'.join([lines[0], lines[2], lines[1]]) + '\n')
+        with self.assertRaises(storage.WalletFileException):
+            WalletStorage(self.wallet_path).decrypt('secret')
+        with open(s.journal_path(), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        s2 = WalletStorage(self.wallet_path)
+        s2.decrypt('secret')
+        self.assertEqual({'x': 'z'}, s2.get('labels'))
+        s2.put('labels', {'x': 'w'})
+        s2.write()
+        s3 = WalletStorage(self.wallet_path)
+        s3.decrypt('secret')
+        self.assertEqual({'x': 'w'}, s3.get('labels'))
+
+    def test_disable_journal(self):
+        s = self._new_storage()
+        s.put('labels', {'x': 'y'})
+        s.write()
+        s.set_journal(False)
+        s.write()
+        self.assertFalse(os.path.exists(s.journal_path()))
+        s2 = WalletStorage(self.wallet_path)
+        self.assertFalse(s2.is_journaled())
+        self.assertEqual({'x': 'y'}, s2.get('labels'))
+
+
+class TestStorageVersion(WalletTestCase):
+
+    def test_upgrade(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('seed_version', 17)
+        s.write()
+        s = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(s.requires_upgrade())
+        s.upgrade()
+        self.assertEqual(storage.FINAL_SEED_VERSION, WalletStorage(self.wallet_path).get('seed_version'))
+
+    def test_older_version_rejects_new_format(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('labels', {'x': 'y'})
+        s.set_journal(True)
+        s.write()
+        s.put('labels', {'x': 'z'})
+        s.write()
+        # the snapshot says that the journal must be read
+        with open(self.wallet_path) as f:
+            self.assertEqual(storage.FINAL_SEED_VERSION, json.load(f)['seed_version'])
+        with mock.patch.object(storage, 'FINAL_SEED_VERSION', 17):
+            with self.assertRaises(storage.WalletFileException) as e:
+                WalletStorage(self.wallet_path)
+            self.assertIn('too old', str(e.exception))
+
+
+class TestSqliteStorage(WalletTestCase):
+
+    txid1 = 'aa' * 32
+    txid2 = 'bb' * 32
+
+    def _wallet_data(self):
+        return {
+            'transactions': {self.txid1: '0100', self.txid2: '0200'},
+            'tx_fees': {self.txid2: 1000},
+            'txi': {self.txid2: {'addr1': {(self.txid1 + ':0', 5000)}}},
+            'txo': {self.txid1: {'addr1': [(0, 5000, False)]},
+                    self.txid2: {'addr2': [(0, 3000, False), (1, 1000, True)]}},
+            'spent_outpoints': {self.txid1: {0: self.txid2}},
+            'addr_history': {'addr1': [[self.txid1, 10], [self.txid2, 11]], 'addr2': [[self.txid2, 11]]},
+            'verified_tx3': {self.txid1: [10, 1500000000, 1]},
+            'labels': {'addr1': 'foo'},
+        }
+
+    def _sqlite_storage(self):
+        s = WalletStorage(self.wallet_path)
+        for k, v in self._wallet_data().items():
+            s.put(k, v)
+        s.write()
+        s.upgrade_to_sqlite()
+        return s
+
+    def test_upgrade(self):
+        s = self._sqlite_storage()
+        self.assertTrue(s.is_sqlite())
+        s2 = WalletStorage(self.wallet_path)
+        self.assertTrue(s2.is_sqlite())
+        expected = json.loads(json.dumps(self._wallet_data(), cls=storage.util.MyEncoder))
+        for k, v in expected.items():
+            self.assertEqual(v, s2.get(k), k)
+
+    def test_item_changes(self):
+        s = self._sqlite_storage()
+        txo = s.get('txo')
+        txo.pop(self.txid1)
+        s.put('txo', txo)
+        verified = s.get('verified_tx3')
+        verified[self.txid2] = [11, 1500000600, 0]
+        s.put('verified_tx3', verified)
+        s.put('labels', {'addr1': 'bar'})
+        s.write()
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual(json.loads(json.dumps(txo)), s2.get('txo'))
+        self.assertEqual(verified, s2.get('verified_tx3'))
+        self.assertEqual({'addr1': 'bar'}, s2.get('labels'))
+        s2.put('labels', None)
+        s2.put('spent_outpoints', {})
+        s2.write()
+        s3 = WalletStorage(self.wallet_path)
+        self.assertEqual(None, s3.get('labels'))
+        self.assertEqual({}, s3.get('spent_outpoints', {}))
+
+    def test_transactions_are_queried(self):
+        s = self._sqlite_storage()
+        for st in (s, WalletStorage(self.wallet_path)):
+            txs = st.get_view('transactions')
+            self.assertIsInstance(txs, wallet_db.TransactionsView)
+            self.assertEqual('0200', txs[self.txid2])
+            self.assertNotIn('cc' * 32, txs)
+            self.assertEqual(2, len(txs))
+        s.put_item('transactions', 'cc' * 32, '0300')
+        s.put_item('transactions', self.txid1, None)
+        self.assertEqual({self.txid2: '0200', 'cc' * 32: '0300'}, s.get('transactions'))
+        s.write()
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual({self.txid2: '0200', 'cc' * 32: '0300'}, s2.get('transactions'))
+        # a whole new value goes through the journal records
+        s2.put('transactions', {self.txid1: '0100'})
+        s2.write()
+        self.assertIsInstance(s2.get_view('transactions'), wallet_db.TransactionsView)
+        self.assertEqual({self.txid1: '0100'}, WalletStorage(self.wallet_path).get('transactions'))
+        s2.convert_format('json')
+        self.assertEqual({self.txid1: '0100'}, WalletStorage(self.wallet_path).get('transactions'))
+
+    def test_kv_items_are_rows(self):
+        s = self._sqlite_storage()
+        s.put_item('labels', 'addr2', 'bar')
+        s.write()
+        with mock.patch.object(storage.json, 'dumps', wraps=storage.json.dumps) as dumps:
+            s.put_item('labels', 'addr1', None)
+            s.put_item('labels', 'addr3', 'baz')
+            s.write()
+        # the two records and the value of the new row, not the whole dict
+        self.assertEqual(3, dumps.call_count)
+        rows = s._db.conn.execute("SELECT item, value FROM kv_items WHERE key='labels'").fetchall()
+        self.assertEqual({('addr2', '"bar"'), ('addr3', '"baz"')}, set(rows))
+        self.assertEqual({'addr2': 'bar', 'addr3': 'baz'}, WalletStorage(self.wallet_path).get('labels'))
+
+    def test_no_encryption(self):
+        s = self._sqlite_storage()
+        with self.assertRaises(storage.WalletFileException):
+            s.set_password('secret', storage.STO_EV_USER_PW)
+
+
+class TestBinaryStorage(WalletTestCase):
+
+    txid1 = TestSqliteStorage.txid1
+    txid2 = TestSqliteStorage.txid2
+    _wallet_data = TestSqliteStorage._wallet_data
+
+    def _expected(self):
+        return json.loads(json.dumps(self._wallet_data(), cls=storage.util.MyEncoder))
+
+    def _binary_storage(self):
+        s = WalletStorage(self.wallet_path)
+        for k, v in self._wallet_data().items():
+            s.put(k, v)
+        s.write()
+        s.convert_format('binary')
+        return s
+
+    def test_roundtrip(self):
+        s = self._binary_storage()
+        with open(self.wallet_path, 'rb') as f:
+            b = f.read()
+        self.assertTrue(b.startswith(wallet_binary.MAGIC))
+        # raw txids and transactions, no hex
+        self.assertIn(wallet_binary.TX_ITEM.pack(bytes.fromhex(self.txid1), 2) + b'\x01\x00', b)
+        self.assertNotIn(self.txid1.encode('ascii'), b)
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual('binary', s2.get_file_format())
+        self.assertEqual(self._expected(), {k: s2.get(k) for k in self._expected()})
+
+    def test_untyped_values_are_kept_as_json(self):
+        s = self._binary_storage()
+        odd = {
+            'transactions': {'not a txid': 'zz'},
+            'tx_fees': {self.txid1: None},
+            'verified_tx3': {self.txid1: [10, 1500000000]},
+            'txi': {self.txid1: {'addr1': [['%s:01' % self.txid2, 1]]}},
+            'txo': {self.txid1: {'addr1': [[1 << 32, 1, False]]}},
+            'addr_history': {'addr1': [[self.txid1, 1, 2]]},
+            'spent_outpoints': {},
+        }
+        for k, v in odd.items():
+            s.put(k, v)
+        s.write()
+        s2 = WalletStorage(self.wallet_path)
+        for k, v in odd.items():
+            self.assertEqual(v, s2.get(k), k)
+        # too large for the record type
+        self.assertEqual(wallet_binary.KEY_VALUE, wallet_binary.encode_key('tx_fees', {self.txid1: 1 << 63})[0])
+
+    def test_encoder_errors_are_raised(self):
+        with mock.patch.dict(wallet_binary.TYPED_KEYS, tx_fees=(wallet_binary.TX_FEES, mock.Mock(side_effect=TypeError), None)):
+            with self.assertRaises(TypeError):
+                wallet_binary.encode_key('tx_fees', {self.txid1: 1})
+
+    def test_changed_keys_are_encoded_again(self):
+        s = self._binary_storage()
+        self.assertIn('txo', s._fragments)
+        with mock.patch.object(wallet_binary, 'encode_key', wraps=wallet_binary.encode_key) as encode_key:
+            s.put('labels', {'addr1': 'bar'})
+            s.write()
+        self.assertEqual([mock.call('labels', {'addr1': 'bar'})], encode_key.call_args_list)
+        self.assertEqual({'addr1': 'bar'}, WalletStorage(self.wallet_path).get('labels'))
+
+    def test_convert_all_formats(self):
+        s = self._binary_storage()
+        for file_format in ('sqlite', 'binary', 'json', 'sqlite', 'json'):
+            s.convert_format(file_format)
+            s2 = WalletStorage(self.wallet_path)
+            self.assertEqual(file_format, s2.get_file_format())
+            self.assertEqual(self._expected(), {k: s2.get(k) for k in self._expected()})
+        self.assertFalse(os.path.exists(self.wallet_path + '-wal'))
+        with self.assertRaises(storage.WalletFileException):
+            s.convert_format('xml')
+
+    def test_journal(self):
+        s = self._binary_storage()
+        s.set_journal(True)
+        s.write()
+        s.put('labels', {'addr1': 'bar'})
+        s.write()
+        self.assertTrue(os.path.exists(s.journal_path()))
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual({'addr1': 'bar'}, s2.get('labels'))
+        self.assertEqual('binary', s2.get_file_format())
+
+    def test_no_encryption(self):
+        s = self._binary_storage()
+        with self.assertRaises(storage.WalletFileException):
+            s.set_password('secret', storage.STO_EV_USER_PW)
+
+    def test_corrupt_file(self):
+        self._binary_storage()
+        with open(self.wallet_path, 'rb') as f:
+            b = f.read()
+        with open(self.wallet_path, 'wb') as f:
+            f.write(b[:-3])
+        with self.assertRaises(storage.WalletFileException):
+            WalletStorage(self.wallet_path)
+
+
+class TestSegmentedEncryption(WalletTestCase):
+
+    def _encrypted_storage(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('labels', {'x': 'y'})
+        s.put('transactions', {'%064x' % i: '00' * 10 for i in range(2500)})
+        s.set_password('secret', storage.STO_EV_USER_PW)
+        s.write()
+        return s
+
+    def _segments(self):
+        with open(self.wallet_path) as f:
+            return f.read().split('\n')
+
+    def test_password_secret_matches_pbkdf2_module(self):
+        import hashlib, hmac, pbkdf2
+        expected = pbkdf2.PBKDF2('sécret', '', iterations=1024, macmodule=hmac, digestmodule=hashlib.sha512).read(64)
+        self.assertEqual(expected, storage.password_secret('sécret'))
+
+    def test_roundtrip(self):
+        s = self._encrypted_storage()
+        # header, labels, seed_version, and 3 segments of transactions
+        self.assertEqual(6, len(self._segments()))
+        s2 = WalletStorage(self.wallet_path)
+        self.assertTrue(s2.is_encrypted_with_user_pw())
+        s2.decrypt('secret')
+        self.assertEqual({'x': 'y'}, s2.get('labels'))
+        self.assertEqual(s.get('transactions'), s2.get('transactions'))
+        with self.assertRaises(storage.InvalidPassword):
+            WalletStorage(self.wallet_path).decrypt('wrong')
+
+    def test_only_changed_segments_are_encrypted_again(self):
+        self._encrypted_storage()
+        before = self._segments()
+        s = WalletStorage(self.wallet_path)
+        s.decrypt('secret')
+        txs = s.get('transactions')
+        txs['%064x' % 0] = '11' * 10
+        s.put('transactions', txs)
+        s.write()
+        after = self._segments()
+        self.assertEqual(len(before), len(after))
+        # the header, with the new digests, and one segment
+        self.assertEqual(1, len([seg for seg in after[1:] if seg not in before[1:]]))
+        s2 = WalletStorage(self.wallet_path)
+        s2.decrypt('secret')
+        self.assertEqual(txs, s2.get('transactions'))
+
+    def _write_segments(self, segments):
+        with open(self.wallet_path, 'w') as f:
+            f.write('\n'.join(segments))
+
+    def _assert_corrupt(self):
+        with self.assertRaises(storage.WalletFileException):
+            WalletStorage(self.wallet_path).decrypt('secret')
+
+    def test_segments_are_authenticated(self):
+        s = self._encrypted_storage()
+        old = self._segments()
+        txs = s.get('transactions')
+        txs['%064x' % 0] = '11' * 10
+        s.put('transactions', txs)
+        s.write()
+        new = self._segments()
+        changed = next(i for i in range(1, len(new)) if new[i] != old[i])
+        # missing, extra, moved, and taken from the previous write
+        self._write_segments(new[:-1])
+        self._assert_corrupt()
+        self._write_segments(new[:1])
+        self._assert_corrupt()
+        self._write_segments(new + [new[-1]])
+        self._assert_corrupt()
+        self._write_segments(new[:1] + new[2:] + new[1:2])
+        self._assert_corrupt()
+        self._write_segments(new[:changed] + [old[changed]] + new[changed + 1:])
+        self._assert_corrupt()
+        self._write_segments(old[:1] + new[1:])
+        self._assert_corrupt()
+        self._write_segments(new)
+        s2 = WalletStorage(self.wallet_path)
+        s2.decrypt('secret')
+        self.assertEqual(txs, s2.get('transactions'))
+        self.assertEqual(2, s2._segment_generation)
+
+    def test_legacy_file(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('labels', {'x': 'y'})
+        s.set_password('secret', storage.STO_EV_USER_PW)
+        s.write()
+        # rewrite it as one ECIES message, as older versions did
+        legacy = s._encrypt(json.dumps(s.data))
+        with open(self.wallet_path, 'w') as f:
+            f.write(legacy)
+        s2 = WalletStorage(self.wallet_path)
+        self.assertTrue(s2.is_encrypted())
+        s2.decrypt('secret')
+        self.assertEqual({'x': 'y'}, s2.get('labels'))
+
+    def test_cached_password_check(self):
+        s = self._encrypted_storage()
+        with mock.patch.object(storage.ecc.ECPrivkey, 'from_arbitrary_size_secret') as derive:
+            s.check_password('secret')
+            with self.assertRaises(storage.InvalidPassword):
+                s.check_password('wrong')
+        self.assertFalse(derive.called)
+        s.set_password('other', storage.STO_EV_USER_PW)
+        s.write()
+        s2 = WalletStorage(self.wallet_path)
+        s2.decrypt('other')
+        self.assertEqual({'x': 'y'}, s2.get('labels'))
+
+
+class TestWriteBehind(WalletTestCase):
+
+    def _read_labels(self):
+        with open(self.wallet_path) as f:
+            return json.loads(f.read()).get('labels')
+
+    def test_writes_are_coalesced(self):
+        s = WalletStorage(self.wallet_path)
+        s.write()
+        first = os.path.getsize(self.wallet_path)
+        s.set_write_behind(60, max_changes=100)
+        for i in range(5):
+            s.put('labels', {'x': str(i)})
+            s.write()
+        self.assertEqual(None, self._read_labels())
+        self.assertEqual(4, s.get_write_stats()['coalesced'])
+        s.flush()
+        self.assertEqual({'x': '4'}, self._read_labels())
+        self.assertEqual(None, s._write_timer)
+        stats = s.get_write_stats()
+        self.assertEqual(2, stats['writes'])
+        self.assertEqual(first + os.path.getsize(self.wallet_path), stats['bytes'])
+
+    def test_flush_after_delay(self):
+        s = WalletStorage(self.wallet_path)
+        s.write()
+        s.set_write_behind(0.01)
+        s.put('labels', {'x': 'y'})
+        s.write()
+        timer = s._write_timer
+        self.assertFalse(timer.daemon)
+        timer.join()
+        self.assertEqual({'x': 'y'}, self._read_labels())
+
+    def test_flush_after_max_changes(self):
+        s = WalletStorage(self.wallet_path)
+        s.write()
+        s.set_write_behind(60, max_changes=2)
+        s.put('labels', {'x': 'y'})
+        s.write()
+        s.put('labels', {'x': 'z'})
+        s.write()
+        # the write may be done already
+        timer = s._write_timer
+        if timer is not None:
+            timer.join()
+        self.assertEqual({'x': 'z'}, self._read_labels())
+
+    def test_flush_from_daemon_thread(self):
+        import threading
+        s = WalletStorage(self.wallet_path)
+        s.put('labels', {'x': 'y'})
+        t = threading.Thread(target=s.flush)
+        t.daemon = True
+        t.start()
+        t.join()
+        self.assertEqual({'x': 'y'}, self._read_labels())
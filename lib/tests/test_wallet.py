@@ -69,3 +69,54 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+
+class TestLazyTransactions(SequentialTestCase):
+
+    def test_transactions_are_cached_and_evicted(self):
+        from lib.tests.test_transaction import signed_blob, v2_blob
+        from lib.wallet import LazyTransactions
+        txs = LazyTransactions(lambda: {'a': signed_blob, 'b': v2_blob}, cache_size=1)
+        self.assertEqual(2, len(txs))
+        self.assertIn('a', txs)
+        tx = txs['a']
+        self.assertEqual(signed_blob, str(tx))
+        self.assertIs(tx, txs['a'])
+        txs['b']
+        self.assertIsNot(tx, txs['a'])
+        self.assertEqual(None, txs.get('c'))
+        self.assertEqual({'a', 'b'}, set(txs))
+
+    def test_set_and_delete(self):
+        from lib.tests.test_transaction import signed_blob
+        from lib.transaction import Transaction
+        from lib.wallet import LazyTransactions
+        txs = LazyTransactions()
+        tx = Transaction(signed_blob)
+        txs['a'] = tx
+        self.assertIs(tx, txs['a'])
+        self.assertEqual({'a': signed_blob}, txs.changes)
+        self.assertIs(tx, txs.pop('a'))
+        self.assertEqual(0, len(txs))
+        self.assertEqual({'a': None}, txs.changes)
+
+    def test_saved_and_changes(self):
+        from lib.tests.test_transaction import signed_blob, v2_blob
+        from lib.wallet import LazyTransactions
+        saved = {'a': signed_blob}
+        txs = LazyTransactions(lambda: saved)
+        txs['b'] = txs['a']
+        del txs['a']
+        self.assertEqual(['b'], list(txs))
+        self.assertEqual(1, len(txs))
+        self.assertNotIn('a', txs)
+        self.assertEqual(None, txs.get_raw('a'))
+        with self.assertRaises(KeyError):
+            del txs['a']
+        # saved by the wallet
+        saved = {'b': signed_blob}
+        txs.mark_saved('a')
+        txs.mark_saved('b')
+        self.assertEqual({}, txs.changes)
+        self.assertEqual(['b'], list(txs))
+        self.assertEqual(signed_blob, str(txs['b']))
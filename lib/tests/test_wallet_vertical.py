@@ -2,14 +2,20 @@ import unittest
 from unittest import mock
 import shutil
 import tempfile
+import json
+import os
+import threading
 from typing import Sequence
+from collections import defaultdict
+from decimal import Decimal
 
 import lib
-from lib import storage, bitcoin, keystore, constants
+from lib import storage, bitcoin, keystore, constants, wallet_binary, wallet_db
 from lib.transaction import Transaction
 from lib.simple_config import SimpleConfig
 from lib.wallet import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT, sweep
-from lib.util import bfh, bh2u
+from lib.util import bfh, bh2u, json_encode
+from lib.commands import Commands
 
 from plugins.trustedcoin import trustedcoin
 
@@ -1552,6 +1558,446 @@ class TestWalletHistory_SimpleRandomOrder(TestCaseForTestnet):
             w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
         self.assertEqual(27633300, sum(w.get_balance()))
 
+    def receive_txs(self, w, order, check=None):
+        """Receives the txs of txid_list in the given order, as unconfirmed.
+        check(w), if given, is called after each of them."""
+        for i in order:
+            tx = Transaction(self.transactions[self.txid_list[i]])
+            w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+            if check is not None:
+                check(w)
+
+    def remove_txs(self, w, order, check=None):
+        for i in order:
+            w.remove_transaction(self.txid_list[i])
+            if check is not None:
+                check(w)
+
+    def assert_utxos_match_history(self, w):
+        for addr in w.get_addresses():
+            received, sent = w.get_addr_io(addr)
+            expected = set(received) - set(sent)
+            self.assertEqual(expected, set(w.get_addr_utxo(addr)), addr)
+            for txo, x in w.get_addr_utxo(addr).items():
+                height, value, is_cb = received[txo]
+                self.assertEqual((height, value, is_cb), (x['height'], x['value'], x['coinbase']))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_utxo_index(self, mock_write):
+        w = self.create_old_wallet()
+        self.receive_txs(w, [5, 8, 17, 0, 9, 10, 12, 3, 15, 18, 2, 11, 14, 7, 16, 1, 4, 6, 13],
+                         check=self.assert_utxos_match_history)
+        self.assertEqual(27633300, sum(x['value'] for x in w.get_utxos()))
+        w.add_unverified_tx(self.txid_list[0], 1234)
+        self.assert_utxos_match_history(w)
+        self.remove_txs(w, [3, 12, 0, 7], check=self.assert_utxos_match_history)
+        self.receive_txs(w, [12, 3], check=self.assert_utxos_match_history)
+        w.load_utxos()
+        self.assert_utxos_match_history(w)
+
+    def assert_txo_index_matches_txo(self, w):
+        expected = {}
+        for txid, d in w.txo.items():
+            for addr, l in d.items():
+                for n, v, is_cb in l:
+                    expected[(txid, n)] = (addr, v, is_cb)
+        self.assertEqual(expected, w._txo_index)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_txo_index(self, mock_write):
+        w = self.create_old_wallet()
+        self.receive_txs(w, [13, 6, 4, 1, 16, 7, 14, 11, 2, 18, 15, 3, 12, 10, 9, 0, 17, 8, 5],
+                         check=self.assert_txo_index_matches_txo)
+        for txid in self.txid_list:
+            for txin in w.transactions[txid].inputs():
+                addr = w.get_txin_address(txin)
+                value = w.txin_value(txin)
+                self.assertEqual(addr is None, value is None)
+                if addr is not None:
+                    self.assertIn((txin['prevout_hash'] + ':%d' % txin['prevout_n'], value),
+                                  w.txi[txid][addr])
+        self.remove_txs(w, [3, 12, 0, 7], check=self.assert_txo_index_matches_txo)
+        w.load_txo_index()
+        self.assert_txo_index_matches_txo(w)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_get_depending_transactions(self, mock_write):
+        w = self.create_old_wallet()
+        self.receive_txs(w, [8, 3, 14, 0, 17, 5, 11, 1, 6, 18, 9, 2, 15, 12, 4, 10, 16, 7, 13])
+        def scan(tx_hash):
+            children = set()
+            for other_hash, tx in w.transactions.items():
+                if any(txin['prevout_hash'] == tx_hash for txin in tx.inputs()):
+                    children.add(other_hash)
+                    children |= scan(other_hash)
+            return children
+        for txid in self.txid_list:
+            self.assertEqual(scan(txid), w.get_depending_transactions(txid), txid)
+        self.assertNotEqual(set(), w.get_depending_transactions(self.txid_list[0]))
+        w.remove_transaction(self.txid_list[12])
+        for txid in self.txid_list:
+            self.assertEqual(scan(txid), w.get_depending_transactions(txid), txid)
+
+    def assert_spent_by_matches_spent_outpoints(self, w):
+        expected = {}
+        for prevout_hash, d in w.spent_outpoints.items():
+            for prevout_n, spending_txid in d.items():
+                expected.setdefault(spending_txid, set()).add((prevout_hash, prevout_n))
+        self.assertEqual(expected, w._spent_by)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_remove_transaction_without_raw_tx(self, mock_write):
+        w = self.create_old_wallet()
+        self.receive_txs(w, [4, 15, 9, 1, 18, 12, 7, 0, 13, 6, 3, 16, 10, 2, 17, 11, 5, 14, 8],
+                         check=self.assert_spent_by_matches_spent_outpoints)
+        for i in [3, 12, 0, 7]:
+            txid = self.txid_list[i]
+            w.transactions.pop(txid)
+            w.remove_transaction(txid)
+            self.assert_spent_by_matches_spent_outpoints(w)
+            self.assertNotIn(txid, w._spent_by)
+            for d in w.spent_outpoints.values():
+                self.assertNotIn(txid, d.values())
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_derived_indexes_saved(self, mock_write):
+        w = self.create_old_wallet()
+        self.receive_txs(w, [6, 17, 2, 10, 14, 0, 8, 12, 4, 16, 1, 11, 18, 5, 9, 13, 3, 15, 7])
+        w.remove_transaction(self.txid_list[12])
+        w.stop_threads()
+        self.assertIsNotNone(w.storage.get('derived_indexes'))
+        w2 = type(w)(w.storage)
+        self.assertIn('load_derived_indexes', w2.load_timings)
+        self.assertNotIn('load_local_history', w2.load_timings)
+        self.assertEqual(w._history_local, w2._history_local)
+        self.assertEqual(w._addr_utxos, w2._addr_utxos)
+        self.assertEqual(w._addr_spent, w2._addr_spent)
+        # heights are not saved, as addr_history is empty here
+        for txid, height in w.unverified_tx.items():
+            w2.add_unverified_tx(txid, height)
+        self.assertEqual(w.get_history(), w2.get_history())
+        self.assertEqual(w.get_balance(), w2.get_balance())
+        # the items of the changed addresses are saved with the
+        # transactions, so that the indexes survive an unclean exit
+        txid = self.txid_list[3]
+        changed = set(w2.txi[txid]) | set(w2.txo[txid])
+        w2.save_transactions()
+        w2.remove_transaction(txid)
+        with mock.patch.object(w2.storage, 'put_item', wraps=w2.storage.put_item) as put_item:
+            w2.save_transactions()
+        saved = {args[1] for args, kwargs in put_item.call_args_list if args[0] == 'history_local'}
+        self.assertEqual(changed, saved)
+        w3 = type(w)(w2.storage)
+        self.assertIn('load_derived_indexes', w3.load_timings)
+        self.assertEqual(w2._history_local, w3._history_local)
+        self.assertEqual(w2._addr_utxos, w3._addr_utxos)
+        self.assertEqual(w2._addr_spent, w3._addr_spent)
+        # indexes that do not match the transactions are rebuilt
+        for key in ('txi', 'txo'):
+            d = w2.storage.get(key)
+            d.pop(self.txid_list[0], None)
+            w2.storage.put(key, d)
+        w3 = type(w)(w2.storage)
+        self.assertIn('load_local_history', w3.load_timings)
+        self.assertNotIn(self.txid_list[0], w3.txo)
+        # also when another client replaced a tx, so that the counts are the same
+        w3.stop_threads()
+        self.assertIn('load_derived_indexes', type(w)(w3.storage).load_timings)
+        self.assertNotIn('load_local_history', type(w)(w3.storage).load_timings)
+        # and when they were saved by another version
+        stamp = w3.storage.get('derived_indexes')
+        w3.storage.put('derived_indexes', stamp[:1] + ['0.0'] + stamp[2:])
+        self.assertIn('load_local_history', type(w)(w3.storage).load_timings)
+        w3.storage.put('derived_indexes', stamp)
+        # a tx whose coins are all spent, so the saved UTXO index can be loaded
+        unspent = {ser.split(':')[0] for utxos in w3._addr_utxos.values() for ser in utxos}
+        old_txid = next(txid for txid in self.txid_list if txid in w3.txo and txid not in unspent)
+        new_txid = 'ff' * 32
+        for key in ('txi', 'txo'):
+            d = w3.storage.get(key)
+            if old_txid in d:
+                d[new_txid] = d.pop(old_txid)
+            w3.storage.put(key, d)
+        w4 = type(w)(w3.storage)
+        self.assertIn('load_local_history', w4.load_timings)
+        self.assertFalse(any(old_txid in txids for txids in w4._history_local.values()))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_full_history_capital_gains(self, mock_write):
+        w = self.create_old_wallet()
+        self.receive_txs(w, [1, 9, 16, 4, 11, 0, 13, 7, 18, 2, 14, 6, 10, 17, 3, 12, 5, 15, 8])
+        fx = mock.Mock(ccy='USD')
+        fx.is_enabled.return_value = True
+        fx.timestamp_rate.return_value = Decimal(5000)
+        for method in ('average', 'fifo'):
+            fx.get_cost_basis_method.return_value = method
+            h = w.get_full_history(fx=fx)
+            # the price never changed, so there are no gains
+            self.assertEqual(Decimal(0), h['summary']['capital_gains'].value)
+            self.assertEqual(Decimal(0), h['summary']['unrealized_gains'].value)
+            for item in h['transactions']:
+                self.assertEqual(item['value'].value * Decimal(5000) / bitcoin.COIN, item['fiat_value'].value)
+                if item['value'].value < 0:
+                    self.assertEqual(Decimal(0), item['capital_gain'].value)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_full_history_tx_received_during_cost_basis(self, mock_write):
+        w = self.create_old_wallet()
+        self.receive_txs(w, range(18))
+        fx = mock.Mock(ccy='USD')
+        fx.is_enabled.return_value = True
+        fx.timestamp_rate.return_value = Decimal(5000)
+        fx.get_cost_basis_method.return_value = 'average'
+        tx = Transaction(self.transactions[self.txid_list[18]])
+        receive = threading.Thread(target=w.receive_tx_callback, args=(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED))
+        get_cost_basis = w.get_cost_basis
+        def get_cost_basis_then_receive(*args):
+            cost_basis = get_cost_basis(*args)
+            # the network thread receives a tx before the page is read
+            receive.start()
+            receive.join(0.1)
+            return cost_basis
+        with mock.patch.object(w, 'get_cost_basis', get_cost_basis_then_receive):
+            h = w.get_full_history(fx=fx)
+        receive.join()
+        self.assertEqual(18, len(h['transactions']))
+        self.assertNotIn(tx.txid(), [item['txid'] for item in h['transactions']])
+        self.assertEqual(19, len(w.get_full_history(fx=fx)['transactions']))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_export_history(self, mock_write):
+        w = self.create_old_wallet()
+        self.receive_txs(w, [14, 3, 9, 0, 18, 6, 12, 1, 16, 8, 4, 11, 15, 2, 17, 7, 13, 5, 10])
+        summary = {}
+        items = list(w.iter_full_history(summary=summary))
+        expected = json.loads(json_encode(w.get_full_history()))
+        self.assertEqual(expected, json.loads(json_encode({'transactions': items, 'summary': summary})))
+        cmds = Commands(config=None, wallet=w, network=None)
+        self.assertEqual(expected, json.loads(cmds.history()))
+        user_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(user_dir, 'history.json')
+            r = json.loads(cmds.history(export_path=path, export_format='json'))
+            self.assertEqual(19, r['count'])
+            self.assertEqual(expected['summary'], r['summary'])
+            with open(path, encoding='utf-8') as f:
+                self.assertEqual(expected, json.load(f))
+            path = os.path.join(user_dir, 'history.jsonl')
+            cmds.history(export_path=path, offset=5, limit=10)
+            with open(path, encoding='utf-8') as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(expected['transactions'][5:15], lines[:-1])
+            # an unknown format leaves the file alone
+            with self.assertRaises(Exception):
+                cmds.history(export_path=path, export_format='xml')
+            with open(path, encoding='utf-8') as f:
+                self.assertEqual(lines, [json.loads(line) for line in f])
+        finally:
+            shutil.rmtree(user_dir)
+
+    def test_sqlite_wallet_queries_transactions(self):
+        user_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(storage.WalletStorage, '_write'):
+                w = self.create_old_wallet()
+            w.storage.path = os.path.join(user_dir, 'wallet')
+            order = [9, 18, 2, 0, 13, 3, 1, 11, 4, 17, 7, 14, 12, 15, 10, 8, 5, 6, 16]
+            self.receive_txs(w, order[:10])
+            w.save_transactions(write=True)
+            w.storage.upgrade_to_sqlite()
+            self.receive_txs(w, order[10:])
+            w.save_transactions(write=True)
+            self.assertEqual({}, w.transactions.changes)
+            w2 = lib.wallet.Standard_Wallet(storage.WalletStorage(w.storage.path))
+            self.assertIsInstance(w2.transactions.get_saved(), wallet_db.TransactionsView)
+            self.assertEqual(set(self.txid_list), set(w2.transactions))
+            self.assertEqual(str(w.transactions[self.txid_list[3]]), str(w2.transactions[self.txid_list[3]]))
+            self.assertEqual(27633300, sum(w2.get_balance()))
+            w2.storage._db.close()
+        finally:
+            shutil.rmtree(user_dir)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_save_transactions_copies(self, mock_write):
+        w = self.create_old_wallet()
+        # children first, so that adding the parents changes their txi in place
+        order = [18, 17, 16, 15, 14, 13, 12, 11, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0]
+        self.receive_txs(w, order[:10])
+        w.save_transactions()
+        saved = {key: w.storage.get(key) for key in ('txi', 'txo', 'spent_outpoints', 'addr_history')}
+        self.receive_txs(w, order[10:])
+        for key, value in saved.items():
+            self.assertEqual(value, w.storage.get(key), key)
+        w.save_transactions()
+        self.assertEqual(w.txi, w.storage.get('txi'))
+        self.assertEqual(w.txo, w.storage.get('txo'))
+        self.assertEqual({k: d for k, d in w.spent_outpoints.items() if d}, w.storage.get('spent_outpoints'))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_save_transactions_only_changed_items(self, mock_write):
+        w = self.create_old_wallet()
+        for i, j in enumerate([9, 18, 2, 0, 13, 3, 1, 11, 4, 17, 7, 14, 12, 15, 10, 8, 5, 6, 16]):
+            tx = Transaction(self.transactions[self.txid_list[j]])
+            w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+            if i % 4 == 0:
+                w.save_transactions()
+        w.remove_transaction(self.txid_list[16])
+        w.save_transactions()
+        with mock.patch.object(w.storage, 'put_item') as put_item:
+            w.save_transactions()
+        self.assertFalse(put_item.called)
+        with mock.patch.object(w.storage, 'put_item', wraps=w.storage.put_item) as put_item:
+            tx = Transaction(self.transactions[self.txid_list[16]])
+            w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+            w.save_transactions()
+        self.assertEqual({self.txid_list[16]} | {txin['prevout_hash'] for txin in tx.inputs()},
+                         {c[0][1] for c in put_item.call_args_list
+                          if c[0][0] not in ('addr_history', 'history_local', 'addr_utxos', 'addr_spent')})
+        self.assertEqual({txid: str(tx) for txid, tx in w.transactions.items()}, w.storage.get('transactions'))
+        self.assertEqual(w.txi, w.storage.get('txi'))
+        self.assertEqual(w.txo, w.storage.get('txo'))
+        self.assertEqual({k: d for k, d in w.spent_outpoints.items() if d}, w.storage.get('spent_outpoints'))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_save_transactions_binary_records(self, mock_write):
+        w = self.create_old_wallet()
+        self.receive_txs(w, [9, 18, 2, 0, 13, 3, 1, 11, 4, 17, 7, 14, 12, 15, 10, 8, 5, 6, 16])
+        w.verified_tx[self.txid_list[4]] = (1234, 1500000000, 1)
+        addr = w.get_receiving_addresses()[0]
+        w.receive_history_callback(addr, w.get_address_history(addr), {self.txid_list[4]: 1000})
+        w.save_transactions()
+        w.save_verified_tx()
+        b = w.storage._serialize_binary()
+        record_types = {}
+        offset = wallet_binary.HEADER.size
+        while offset < len(b):
+            t, n = wallet_binary.RECORD.unpack_from(b, offset)
+            offset += wallet_binary.RECORD.size
+            if t == wallet_binary.KEY_VALUE:
+                key = wallet_binary.unpack_str(b[offset:offset + n], 0)[0]
+            else:
+                key = wallet_binary.DECODERS[t][0]
+            record_types[key] = t
+            offset += n
+        for key, (t, encode, decode) in wallet_binary.TYPED_KEYS.items():
+            self.assertEqual(t, record_types[key], key)
+        spent_outpoints = w.storage.get('spent_outpoints')
+        self.assertEqual(json.loads(json.dumps(spent_outpoints)), wallet_binary.decode(b)['spent_outpoints'])
+        # the wallet keeps it in a defaultdict
+        record = wallet_binary.encode_key('spent_outpoints', defaultdict(dict, spent_outpoints))
+        self.assertEqual(wallet_binary.SPENT_OUTPOINTS, record[0])
+
+    def assert_balances_match_history(self, w):
+        local_height = w.get_local_height()
+        total = [0, 0, 0]
+        for addr in w.get_addresses():
+            balance = w._compute_addr_balance(addr, local_height)[0]
+            self.assertEqual(balance, w.get_addr_balance(addr), addr)
+            total = [a + b for a, b in zip(total, balance)]
+        self.assertEqual(tuple(total), w.get_balance())
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_balance_cache(self, mock_write):
+        w = self.create_old_wallet()
+        self.receive_txs(w, [9, 18, 2, 0, 13, 3, 1, 11, 4, 17, 7, 14, 12, 15, 10, 8, 5, 6, 16],
+                         check=self.assert_balances_match_history)
+        for i in [4, 11, 2]:
+            w.add_unverified_tx(self.txid_list[i], 1234)
+            self.assert_balances_match_history(w)
+        w.receive_history_callback(w.get_receiving_addresses()[0], [], {})
+        self.assert_balances_match_history(w)
+        self.remove_txs(w, [3, 12, 0], check=self.assert_balances_match_history)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_maintained_history(self, mock_write):
+        w = self.create_old_wallet()
+        order = [2, 12, 7, 9, 11, 10, 16, 6, 17, 1, 13, 15, 5, 8, 4, 0, 14, 18, 3]
+        for i in order:
+            tx = Transaction(self.transactions[self.txid_list[i]])
+            # distinct heights, so that the order is the same with a domain
+            w.receive_tx_callback(tx.txid(), tx, 1000 + (i * 7) % 19)
+            self.assertEqual(w.get_history(w.get_addresses()), w.get_history())
+        h = w.get_history()
+        self.assertEqual(19, len(h))
+        self.assertEqual(27633300, h[-1][5])
+        self.assertEqual(h[3:8], w.get_history_page(3, 5))
+        self.assertEqual(h[::-1][2:6], w.get_history_page(2, 4, newest_first=True))
+        self.assertEqual([], w.get_history_page(19))
+        # changes of height move transactions
+        w.add_unverified_tx(h[0][0], 1100)
+        w.add_unverified_tx(h[-1][0], TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual(w.get_history(w.get_addresses()), w.get_history())
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 1200
+        for j, (tx_hash, height, conf, timestamp, delta, balance) in enumerate(w.get_history()[:10]):
+            w.add_verified_tx(tx_hash, (height, 1500000000 + 1000 * j, 0))
+        h = w.get_history()
+        self.assertEqual(w.get_history(w.get_addresses()), h)
+        self.assertEqual([x for x in h if x[3] and 1500002000 <= x[3] < 1500005000],
+                         w.get_history_page(from_timestamp=1500002000, to_timestamp=1500005000))
+        for i in [3, 12]:
+            w.remove_transaction(self.txid_list[i])
+            self.assertEqual(w.get_history(w.get_addresses()), w.get_history())
+        # large updates are done with one sort
+        h = w.get_history()
+        w._history_stale.update(w.txi)
+        w._rebuild_history()
+        self.assertEqual(h, w.get_history())
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_page_timestamp_range(self, mock_write):
+        w = self.create_old_wallet()
+        for i in range(19):
+            tx = Transaction(self.transactions[self.txid_list[i]])
+            w.receive_tx_callback(tx.txid(), tx, 1000 + i)
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 1200
+        h = w.get_history()
+        # six hours between blocks, with some timestamps out of order;
+        # the txs of heights 1005 and 1012 are not verified yet, the last
+        # two are unconfirmed
+        for j, (tx_hash, height, conf, timestamp, delta, balance) in enumerate(h[:17]):
+            if height not in (1005, 1012):
+                w.add_verified_tx(tx_hash, (height, 1500000000 + 21600 * j - (5400 if j % 4 == 1 else 0), 0))
+        for tx_hash, height, conf, timestamp, delta, balance in h[17:]:
+            w.add_unverified_tx(tx_hash, TX_HEIGHT_UNCONFIRMED)
+        h = w.get_history()
+        now = 1600000000
+        bounds = [None, 1400000000, now + 1] + [1500000000 + 5400 * k for k in range(-2, 72, 3)]
+        with mock.patch('time.time', return_value=now):
+            for from_timestamp in bounds:
+                for to_timestamp in bounds:
+                    expected = [x for x in h
+                                if (from_timestamp is None or (x[3] or now) >= from_timestamp)
+                                and (to_timestamp is None or (x[3] or now) < to_timestamp)]
+                    self.assertEqual(expected, w.get_history_page(from_timestamp=from_timestamp,
+                                                                  to_timestamp=to_timestamp))
+            with mock.patch.object(w, 'get_tx_height', wraps=w.get_tx_height) as get_tx_height:
+                page = w.get_history_page(from_timestamp=1500000000, to_timestamp=1500000000 + 21600 * 17, limit=2)
+            self.assertEqual(2, len(page))
+            # the page, the txs that are not verified, and one near a bound
+            self.assertEqual(7, get_tx_height.call_count)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_balance_cache_coinbase_maturity(self, mock_write):
+        w = self.create_old_wallet()
+        addr = w.get_receiving_addresses()[0]
+        received = {'aa' * 32 + ':0': (1000, 5000, True)}
+        with mock.patch.object(w, 'get_addr_io', return_value=(received, {})), \
+                mock.patch.object(w, '_history_local', {addr: {'aa' * 32}}), \
+                mock.patch.object(w, 'get_local_height', return_value=1050) as local_height:
+            w._balances_dirty.add(addr)
+            self.assertEqual((0, 0, 5000), w.get_balance())
+            local_height.return_value = 1099
+            self.assertEqual((0, 0, 5000), w.get_balance())
+            local_height.return_value = 1100
+            self.assertEqual((5000, 0, 0), w.get_balance())
+            self.assertEqual((5000, 0, 0), w.get_addr_balance(addr))
+            # reorg
+            local_height.return_value = 1098
+            self.assertEqual((0, 0, 5000), w.get_addr_balance(addr))
+            self.assertEqual((0, 0, 5000), w.get_balance())
+
 
 class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
     transactions = {
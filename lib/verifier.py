@@ -54,7 +54,7 @@ class SPV(ThreadJob):
                 if header is None:
                     index = tx_height // 2016
                     if index < len(blockchain.checkpoints):
-                        self.network.request_chunk(interface, index)
+                        self.network.request_checkpointed_header(interface, tx_height)
                 else:
                     if (tx_hash not in self.requested_merkle
                             and tx_hash not in self.merkle_roots):
@@ -98,10 +98,10 @@ class SPV(ThreadJob):
                 "merkle verification failed for {} (missing header {})"
                 .format(tx_hash, tx_height))
             return
-        if header.get('merkle_root') != merkle_root:
+        if header.merkle_root != merkle_root:
             self.print_error(
                 "merkle verification failed for {} (merkle root mismatch {} != {})"
-                .format(tx_hash, header.get('merkle_root'), merkle_root))
+                .format(tx_hash, header.merkle_root, merkle_root))
             return
         # we passed all the tests
         self.merkle_roots[tx_hash] = merkle_root
@@ -111,7 +111,7 @@ class SPV(ThreadJob):
             self.requested_merkle.remove(tx_hash)
         except KeyError: pass
         self.print_error("verified %s" % tx_hash)
-        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
+        self.wallet.add_verified_tx(tx_hash, (tx_height, header.timestamp, pos))
         if self.is_up_to_date() and self.wallet.is_up_to_date():
             self.wallet.save_verified_tx(write=True)
 
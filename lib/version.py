@@ -2,6 +2,7 @@ ELECTRUM_VERSION = '3.2.2'   # version of the client package
 APK_VERSION = '3.2.2.0'      # read by buildozer.spec
 
 PROTOCOL_VERSION = '1.2'     # protocol version requested
+PROTOCOL_VERSION_HEADER_PROOFS = '1.4'  # requested too if header proofs are enabled
 
 # The hash of the mnemonic seed must begin with this
 SEED_PREFIX      = '01'      # Standard wallet
@@ -36,10 +36,12 @@ import copy
 import errno
 import traceback
 from functools import partial
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from collections.abc import MutableMapping
 from numbers import Number
 from decimal import Decimal
 import itertools
+import bisect
 
 import sys
 
@@ -66,6 +68,7 @@ from . import paymentrequest
 from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
 from .paymentrequest import InvoiceStore
 from .contacts import Contacts
+from .cost_basis import CostBasis, AVERAGE
 
 TX_STATUS = [
     _('Unconfirmed'),
@@ -74,6 +77,14 @@ TX_STATUS = [
     _('Local'),
 ]
 
+# version of the layout of the derived indexes in storage, see
+# Abstract_Wallet.save_derived_indexes
+DERIVED_INDEXES_VERSION = 2
+
+# how far block timestamps may be out of the order of the blocks,
+# see Abstract_Wallet.get_history_page
+BLOCK_TIMESTAMP_MARGIN = 4 * 3600
+
 TX_HEIGHT_LOCAL = -2
 TX_HEIGHT_UNCONF_PARENT = -1
 TX_HEIGHT_UNCONFIRMED = 0
@@ -173,6 +184,81 @@ class UnrelatedTransactionException(AddTransactionException):
 class CannotBumpFee(Exception): pass
 
 
+class LazyTransactions(MutableMapping):
+    '''txid -> Transaction, keeping only the raw hex of each transaction.
+
+    The raw transactions saved in the wallet file are not copied: get_saved
+    returns them, as a dict or, with the SQLite backend, as a view that
+    queries them by txid. The changes since the last save are kept in
+    self.changes, txid -> raw hex, or None if the transaction was removed.
+
+    Transaction objects are constructed on access, and the most recently
+    used ones are kept in a bounded cache, so transactions that are never
+    looked at again after sync do not stay deserialized in memory.
+    '''
+
+    def __init__(self, get_saved=dict, cache_size=1000):
+        self.get_saved = get_saved
+        self.changes = {}
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_raw(self, txid):
+        if txid in self.changes:
+            return self.changes[txid]
+        return self.get_saved().get(txid)
+
+    def mark_saved(self, txid):
+        self.changes.pop(txid, None)
+
+    def __getitem__(self, txid):
+        with self._lock:
+            tx = self._cache.get(txid)
+            if tx is not None:
+                self._cache.move_to_end(txid)
+                return tx
+            raw = self.get_raw(txid)
+            if raw is None:
+                raise KeyError(txid)
+            tx = Transaction(raw)
+            self._add_to_cache(txid, tx)
+            return tx
+
+    def __setitem__(self, txid, tx):
+        with self._lock:
+            self.changes[txid] = str(tx)
+            self._cache.pop(txid, None)
+            self._add_to_cache(txid, tx)
+
+    def _add_to_cache(self, txid, tx):
+        self._cache[txid] = tx
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def __delitem__(self, txid):
+        with self._lock:
+            if txid not in self:
+                raise KeyError(txid)
+            self.changes[txid] = None
+            self._cache.pop(txid, None)
+
+    def __contains__(self, txid):
+        if txid in self.changes:
+            return self.changes[txid] is not None
+        return txid in self.get_saved()
+
+    def __iter__(self):
+        changes = dict(self.changes)
+        txids = [txid for txid in self.get_saved() if txid not in changes]
+        txids.extend(txid for txid, raw in changes.items() if raw is not None)
+        return iter(txids)
+
+    def __len__(self):
+        saved = self.get_saved()
+        return len(saved) + sum((raw is not None) - (txid in saved) for txid, raw in list(self.changes.items()))
+
+
 class Abstract_Wallet(PrintError):
     """
     Wallet classes are created to handle various address generation methods.
@@ -203,20 +289,33 @@ class Abstract_Wallet(PrintError):
         self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
         self.fiat_value            = storage.get('fiat_value', {})
         self.receive_requests      = storage.get('payment_requests', {})
+        # items changed since the last save_transactions: txids (of
+        # transactions, txi, txo, tx_fees and spent_outpoints) and addresses
+        # (of addr_history and of the derived indexes)
+        self._dirty_txids = set()
+        self._dirty_addresses = set()
+        # False until the derived indexes in storage are complete
+        self._derived_indexes_saved = False
 
         # Verified transactions.  txid -> (height, timestamp, block_pos).  Access with self.lock.
-        self.verified_tx = storage.get('verified_tx3', {})
+        self.verified_tx = dict(storage.get_view('verified_tx3', {}))
         # Transactions pending verification.  txid -> tx_height. Access with self.lock.
         self.unverified_tx = defaultdict(int)
 
         self.load_keystore()
         self.load_addresses()
         self.test_addresses_sanity()
-        self.load_transactions()
-        self.load_local_history()
-        self.check_history()
-        self.load_unverified_transactions()
-        self.remove_local_transactions_we_dont_have()
+        # startup phase -> seconds
+        self.load_timings = OrderedDict()
+        self._timed_load(self.load_transactions)
+        if not self._timed_load(self.load_derived_indexes):
+            self._timed_load(self.load_local_history)
+            self._timed_load(self.load_utxos)
+        self._timed_load(self.check_history)
+        self._timed_load(self.load_unverified_transactions)
+        self._timed_load(self.remove_local_transactions_we_dont_have)
+        self.print_error("loaded in %.3fs:" % sum(self.load_timings.values()),
+                         ", ".join("%s %.3fs" % x for x in self.load_timings.items()))
 
         # There is a difference between wallet.up_to_date and network.is_up_to_date().
         # network.is_up_to_date() returns true when all requests have been answered and processed
@@ -232,8 +331,6 @@ class Abstract_Wallet(PrintError):
         self.invoices = InvoiceStore(self.storage)
         self.contacts = Contacts(self.storage)
 
-        self.coin_price_cache = {}
-
 
     def diagnostic_name(self):
         return self.basename()
@@ -244,79 +341,188 @@ class Abstract_Wallet(PrintError):
     def get_master_public_key(self):
         return None
 
-    @profiler
+    def _timed_load(self, func):
+        t0 = time.time()
+        r = func()
+        self.load_timings[func.__name__] = time.time() - t0
+        return r
+
     def load_transactions(self):
         # load txi, txo, tx_fees
-        self.txi = self.storage.get('txi', {})
-        for txid, d in list(self.txi.items()):
-            for addr, lst in d.items():
-                self.txi[txid][addr] = set([tuple(x) for x in lst])
-        self.txo = self.storage.get('txo', {})
-        self.tx_fees = self.storage.get('tx_fees', {})
-        tx_list = self.storage.get('transactions', {})
+        self.txi = {}
+        for txid, d in self.storage.get_view('txi', {}).items():
+            self.txi[txid] = {addr: set([tuple(x) for x in lst]) for addr, lst in d.items()}
+        # the entries of txo are replaced, never modified; no need to copy them
+        self.txo = dict(self.storage.get_view('txo', {}))
+        self.tx_fees = dict(self.storage.get_view('tx_fees', {}))
         # load transactions
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
+        self.transactions = LazyTransactions(lambda: self.storage.get_view('transactions', {}))
+        for tx_hash in self.transactions:
             if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None:
                 self.print_error("removing unreferenced tx", tx_hash)
                 self.transactions.pop(tx_hash)
+                self._dirty_txids.add(tx_hash)
         # load spent_outpoints
-        _spent_outpoints = self.storage.get('spent_outpoints', {})
+        _spent_outpoints = self.storage.get_view('spent_outpoints', {})
         self.spent_outpoints = defaultdict(dict)
+        self._spent_by = {}  # spending txid -> set of (prevout_hash, prevout_n)
         for prevout_hash, d in _spent_outpoints.items():
             for prevout_n_str, spending_txid in d.items():
                 prevout_n = int(prevout_n_str)
                 self.spent_outpoints[prevout_hash][prevout_n] = spending_txid
+                self._spent_by.setdefault(spending_txid, set()).add((prevout_hash, prevout_n))
+        self.load_txo_index()
 
     @profiler
+    def load_txo_index(self):
+        self._txo_index = {}  # (txid, n) -> (address, value, is_coinbase)
+        for txid in self.txo:
+            self._add_tx_to_txo_index(txid)
+
+    def _add_tx_to_txo_index(self, txid):
+        for addr, l in self.txo.get(txid, {}).items():
+            for n, v, is_cb in l:
+                self._txo_index[(txid, n)] = (addr, v, is_cb)
+
+    def _remove_tx_from_txo_index(self, txid):
+        for addr, l in self.txo.get(txid, {}).items():
+            for n, v, is_cb in l:
+                self._txo_index.pop((txid, n), None)
+
+    def load_utxos(self):
+        self._addr_utxos = {}  # address -> {'txid:n': (txid, n, value, is_coinbase)}
+        self._addr_spent = {}  # address -> {'txid:n': number of txi spending it}
+        for txid in set(self.txi) | set(self.txo):
+            self._add_tx_to_utxos(txid)
+
     def load_local_history(self):
         self._history_local = {}  # address -> set(txid)
         for txid in itertools.chain(self.txi, self.txo):
             self._add_tx_to_local_history(txid)
+        self._reset_balances()
+        self._reset_history()
+
+    def _get_derived_indexes_stamp(self):
+        return [DERIVED_INDEXES_VERSION, ELECTRUM_VERSION, self.storage.get('seed_version')]
+
+    def load_derived_indexes(self):
+        """Load the indexes saved by save_derived_indexes. Returns False
+        if there are none or they do not match the transactions, in
+        which case they have to be rebuilt."""
+        if self.storage.get('derived_indexes') != self._get_derived_indexes_stamp():
+            return False
+        try:
+            history_local = {addr: set(l) for addr, l in self.storage.get_view('history_local').items()}
+            # the indexes are saved with the transactions, but other
+            # versions of Electrum may have changed the transactions
+            txids = set(txid for d in (self.txi, self.txo) for txid, x in d.items() if x)
+            if set().union(*history_local.values()) != txids:
+                raise ValueError('history does not match the transactions')
+            addr_utxos = {}
+            for addr, l in self.storage.get_view('addr_utxos').items():
+                utxos = addr_utxos[addr] = {}
+                for ser in l:
+                    prevout_hash, prevout_n = ser.split(':')
+                    prevout_n = int(prevout_n)
+                    _addr, v, is_cb = self._txo_index[(prevout_hash, prevout_n)]
+                    utxos[ser] = (prevout_hash, prevout_n, v, is_cb)
+            addr_spent = {addr: dict(spent) for addr, spent in self.storage.get_view('addr_spent').items()}
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            self.print_error("cannot load derived indexes", repr(e))
+            return False
+        self._history_local = history_local
+        self._addr_utxos = addr_utxos
+        self._addr_spent = addr_spent
+        self._derived_indexes_saved = True
+        self._reset_balances()
+        self._reset_history()
+        return True
+
+    def save_derived_indexes(self, write=False):
+        """Save all of the derived indexes. Afterwards, save_transactions
+        saves the items of the addresses that changed."""
+        with self.transaction_lock:
+            self.storage.put_owned('history_local', {addr: list(txids) for addr, txids in self._history_local.items()})
+            self.storage.put_owned('addr_utxos', {addr: list(utxos) for addr, utxos in self._addr_utxos.items()})
+            self.storage.put_owned('addr_spent', {addr: dict(spent) for addr, spent in self._addr_spent.items()})
+            self.storage.put('derived_indexes', self._get_derived_indexes_stamp())
+            self._derived_indexes_saved = True
+            if write:
+                self.storage.write()
 
     def remove_local_transactions_we_dont_have(self):
         txid_set = set(self.txi) | set(self.txo)
         for txid in txid_set:
+            if txid in self.transactions:
+                continue
             tx_height = self.get_tx_height(txid)[0]
-            if tx_height == TX_HEIGHT_LOCAL and txid not in self.transactions:
+            if tx_height == TX_HEIGHT_LOCAL:
                 self.remove_transaction(txid)
 
     @profiler
     def save_transactions(self, write=False):
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('addr_history', self.history)
-            self.storage.put('spent_outpoints', self.spent_outpoints)
+            # the sets are swapped, not cleared: receive_history_callback
+            # does not take transaction_lock
+            txids, self._dirty_txids = self._dirty_txids, set()
+            addresses, self._dirty_addresses = self._dirty_addresses, set()
+            put_item = self.storage.put_item
+            for txid in txids:
+                # copies of what is modified in place: the sets of txi and
+                # the dicts of spent_outpoints
+                txi = self.txi.get(txid)
+                spent = self.spent_outpoints.get(txid)
+                put_item('transactions', txid, self.transactions.get_raw(txid))
+                self.transactions.mark_saved(txid)
+                put_item('txi', txid, None if txi is None else {addr: set(l) for addr, l in txi.items()})
+                put_item('txo', txid, self.txo.get(txid))
+                put_item('tx_fees', txid, self.tx_fees.get(txid))
+                put_item('spent_outpoints', txid, dict(spent) if spent else None)
+            for addr in addresses:
+                put_item('addr_history', addr, self.history.get(addr))
+            if not self._derived_indexes_saved:
+                self.save_derived_indexes()
+            else:
+                for addr in addresses:
+                    txids = self._history_local.get(addr)
+                    utxos = self._addr_utxos.get(addr)
+                    spent = self._addr_spent.get(addr)
+                    put_item('history_local', addr, None if txids is None else list(txids))
+                    put_item('addr_utxos', addr, None if utxos is None else list(utxos))
+                    put_item('addr_spent', addr, None if spent is None else dict(spent))
             if write:
                 self.storage.write()
 
     def save_verified_tx(self, write=False):
         with self.lock:
-            self.storage.put('verified_tx3', self.verified_tx)
+            # the values are never modified in place, a shallow copy is enough
+            self.storage.put_owned('verified_tx3', dict(self.verified_tx))
             if write:
                 self.storage.write()
 
     def clear_history(self):
         with self.lock:
             with self.transaction_lock:
+                for d in (self.transactions, self.txi, self.txo, self.tx_fees, self.spent_outpoints):
+                    self._dirty_txids.update(d)
+                self._dirty_addresses.update(self.history)
+                self._dirty_addresses.update(self._history_local)
                 self.txi = {}
                 self.txo = {}
+                self._txo_index = {}
                 self.tx_fees = {}
                 self.spent_outpoints = defaultdict(dict)
+                self._spent_by = {}
                 self.history = {}
                 self.verified_tx = {}
-                self.transactions = {}
+                for txid in list(self.transactions):
+                    del self.transactions[txid]
+                self._addr_utxos = {}
+                self._addr_spent = {}
+                self._reset_balances()
+                self._reset_history()
                 self.save_transactions()
 
-    @profiler
     def check_history(self):
         save = False
 
@@ -325,6 +531,7 @@ class Abstract_Wallet(PrintError):
 
         for addr in hist_addrs_not_mine:
             self.history.pop(addr)
+            self._dirty_addresses.add(addr)
             save = True
 
         for addr in hist_addrs_mine:
@@ -452,19 +659,23 @@ class Abstract_Wallet(PrintError):
                 and tx_hash in self.verified_tx:
             with self.lock:
                 self.verified_tx.pop(tx_hash)
+                self._invalidate_tx(tx_hash)
             if self.verifier:
                 self.verifier.remove_spv_proof_for_tx(tx_hash)
 
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
             with self.lock:
-                self.unverified_tx[tx_hash] = tx_height
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self.unverified_tx[tx_hash] = tx_height
+                    self._invalidate_tx(tx_hash)
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            self._invalidate_tx(tx_hash)
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
@@ -482,8 +693,9 @@ class Abstract_Wallet(PrintError):
                 if tx_height >= height:
                     header = blockchain.read_header(tx_height)
                     # fixme: use block hash, not timestamp
-                    if not header or header.get('timestamp') != timestamp:
+                    if not header or header.timestamp != timestamp:
                         self.verified_tx.pop(tx_hash, None)
+                        self._invalidate_tx(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -560,17 +772,11 @@ class Abstract_Wallet(PrintError):
             if self.is_mine(addr):
                 is_mine = True
                 is_relevant = True
-                d = self.txo.get(txin['prevout_hash'], {}).get(addr, [])
-                for n, v, cb in d:
-                    if n == txin['prevout_n']:
-                        value = v
-                        break
-                else:
-                    value = None
-                if value is None:
+                item = self._txo_index.get((txin['prevout_hash'], txin['prevout_n']))
+                if item is None or item[0] != addr:
                     is_pruned = True
                 else:
-                    v_in += value
+                    v_in += item[1]
             else:
                 is_partial = True
         if not is_mine:
@@ -664,22 +870,18 @@ class Abstract_Wallet(PrintError):
         return received, sent
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
         out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out[txo] = x
+        with self.lock, self.transaction_lock:
+            for txo, (prevout_hash, prevout_n, value, is_cb) in self._addr_utxos.get(address, {}).items():
+                x = {
+                    'address':address,
+                    'value':value,
+                    'prevout_n':prevout_n,
+                    'prevout_hash':prevout_hash,
+                    'height':self.get_tx_height(prevout_hash)[0],
+                    'coinbase':is_cb
+                }
+                out[txo] = x
         return out
 
     # return the total amount ever received by an address
@@ -689,10 +891,64 @@ class Abstract_Wallet(PrintError):
 
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     def get_addr_balance(self, address):
+        with self.lock, self.transaction_lock:
+            return self._get_addr_balance(address, self.get_local_height())
+
+    def _reset_balances(self):
+        # address -> ((c, u, x), lo, hi, mine); valid while lo <= local height < hi,
+        # which depends on coinbase maturity
+        self._balances = {}
+        # addresses whose cached balance is out of date
+        self._balances_dirty = set(self._history_local)
+        # addresses with coinbase outputs, their balance depends on the local height
+        self._balances_maturing = set()
+        # sum of the cached balances of the addresses that are mine
+        self._balance_total = (0, 0, 0)
+
+    def _invalidate_tx(self, txid):
+        # called when the txi/txo entries or the height of txid change
+        with self.transaction_lock:
+            self._balances_dirty.update(self.txi.get(txid, {}))
+            self._balances_dirty.update(self.txo.get(txid, {}))
+            self._history_stale.add(txid)
+            # for the derived indexes
+            self._dirty_addresses.update(self.txi.get(txid, {}))
+            self._dirty_addresses.update(self.txo.get(txid, {}))
+
+    def _get_addr_balance(self, address, local_height):
+        entry = self._balances.get(address)
+        if entry is not None:
+            balance, lo, hi, mine = entry
+            if address not in self._balances_dirty and lo <= local_height < hi:
+                return balance
+            if mine:
+                self._balance_total = tuple(a - b for a, b in zip(self._balance_total, balance))
+        elif address not in self._history_local:
+            return 0, 0, 0
+        balance, lo, hi = self._compute_addr_balance(address, local_height)
+        mine = self.is_mine(address)
+        if mine:
+            self._balance_total = tuple(a + b for a, b in zip(self._balance_total, balance))
+        self._balances[address] = balance, lo, hi, mine
+        self._balances_dirty.discard(address)
+        if lo > 0 or hi < float('inf'):
+            self._balances_maturing.add(address)
+        else:
+            self._balances_maturing.discard(address)
+        return balance
+
+    def _compute_addr_balance(self, address, local_height):
         received, sent = self.get_addr_io(address)
         c = u = x = 0
-        local_height = self.get_local_height()
+        lo, hi = 0, float('inf')
         for txo, (tx_height, v, is_cb) in received.items():
+            if is_cb:
+                # the coin matures when the local height reaches mature_height
+                mature_height = tx_height + COINBASE_MATURITY
+                if mature_height > local_height:
+                    hi = min(hi, mature_height)
+                else:
+                    lo = max(lo, mature_height)
             if is_cb and tx_height + COINBASE_MATURITY > local_height:
                 x += v
             elif tx_height > 0:
@@ -704,7 +960,7 @@ class Abstract_Wallet(PrintError):
                     c -= v
                 else:
                     u -= v
-        return c, u, x
+        return (c, u, x), lo, hi
 
     def get_spendable_coins(self, domain, config):
         confirmed_only = config.get('confirmed_only', False)
@@ -717,12 +973,15 @@ class Abstract_Wallet(PrintError):
         domain = set(domain)
         if exclude_frozen:
             domain = set(domain) - self.frozen_addresses
+        # only addresses with coins
+        domain &= self._addr_utxos.keys()
+        local_height = self.get_local_height()
         for addr in domain:
             utxos = self.get_addr_utxo(addr)
             for x in utxos.values():
                 if confirmed_only and x['height'] <= 0:
                     continue
-                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
+                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > local_height:
                     continue
                 coins.append(x)
                 continue
@@ -741,16 +1000,20 @@ class Abstract_Wallet(PrintError):
         return self.get_balance(self.frozen_addresses)
 
     def get_balance(self, domain=None):
-        if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
-        cc = uu = xx = 0
-        for addr in domain:
-            c, u, x = self.get_addr_balance(addr)
-            cc += c
-            uu += u
-            xx += x
-        return cc, uu, xx
+        with self.lock, self.transaction_lock:
+            local_height = self.get_local_height()
+            if domain is None:
+                # only bring the addresses that changed up to date
+                for addr in self._balances_dirty | self._balances_maturing:
+                    self._get_addr_balance(addr, local_height)
+                return self._balance_total
+            cc = uu = xx = 0
+            for addr in set(domain):
+                c, u, x = self._get_addr_balance(addr, local_height)
+                cc += c
+                uu += u
+                xx += x
+            return cc, uu, xx
 
     def get_address_history(self, addr):
         h = []
@@ -781,18 +1044,55 @@ class Abstract_Wallet(PrintError):
                 else:
                     self._history_local[addr] = cur_hist
 
+    def _add_tx_to_utxos(self, txid):
+        self._invalidate_tx(txid)
+        for addr, l in self.txi.get(txid, {}).items():
+            for ser, v in l:
+                self._spend_utxo(addr, ser)
+        for addr, l in self.txo.get(txid, {}).items():
+            for n, v, is_cb in l:
+                ser = txid + ':%d' % n
+                if ser not in self._addr_spent.get(addr, {}):
+                    self._addr_utxos.setdefault(addr, {})[ser] = (txid, n, v, is_cb)
+
+    def _remove_tx_from_utxos(self, txid):
+        self._invalidate_tx(txid)
+        for addr, l in self.txo.get(txid, {}).items():
+            utxos = self._addr_utxos.get(addr, {})
+            for n, v, is_cb in l:
+                utxos.pop(txid + ':%d' % n, None)
+            if not utxos:
+                self._addr_utxos.pop(addr, None)
+        for addr, l in self.txi.get(txid, {}).items():
+            spent = self._addr_spent.get(addr, {})
+            for ser, v in l:
+                count = spent.get(ser, 0) - 1
+                if count > 0:
+                    spent[ser] = count
+                    continue
+                spent.pop(ser, None)
+                # the coin is unspent again, if we still have it
+                prevout_hash, prevout_n = ser.split(':')
+                prevout_n = int(prevout_n)
+                item = self._txo_index.get((prevout_hash, prevout_n))
+                if item is not None and item[0] == addr:
+                    self._addr_utxos.setdefault(addr, {})[ser] = (prevout_hash, prevout_n, item[1], item[2])
+            if not spent:
+                self._addr_spent.pop(addr, None)
+
+    def _spend_utxo(self, addr, ser):
+        spent = self._addr_spent.setdefault(addr, {})
+        spent[ser] = spent.get(ser, 0) + 1
+        utxos = self._addr_utxos.get(addr)
+        if utxos and utxos.pop(ser, None) and not utxos:
+            self._addr_utxos.pop(addr)
+
     def get_txin_address(self, txi):
         addr = txi.get('address')
         if addr and addr != "(pubkey)":
             return addr
-        prevout_hash = txi.get('prevout_hash')
-        prevout_n = txi.get('prevout_n')
-        dd = self.txo.get(prevout_hash, {})
-        for addr, l in dd.items():
-            for n, v, is_cb in l:
-                if n == prevout_n:
-                    return addr
-        return None
+        item = self._txo_index.get((txi.get('prevout_hash'), txi.get('prevout_n')))
+        return item[0] if item else None
 
     def get_txout_address(self, txo):
         _type, x, v = txo
@@ -880,19 +1180,18 @@ class Abstract_Wallet(PrintError):
                     to_remove |= self.get_depending_transactions(conflicting_tx_hash)
                 for tx_hash2 in to_remove:
                     self.remove_transaction(tx_hash2)
+            # the entries of a previous call are replaced below
+            self._remove_tx_from_utxos(tx_hash)
             # add inputs
             def add_value_from_prev_output():
-                dd = self.txo.get(prevout_hash, {})
-                # note: this nested loop takes linear time in num is_mine outputs of prev_tx
-                for addr, outputs in dd.items():
-                    # note: instead of [(n, v, is_cb), ...]; we could store: {n -> (v, is_cb)}
-                    for n, v, is_cb in outputs:
-                        if n == prevout_n:
-                            if addr and self.is_mine(addr):
-                                if d.get(addr) is None:
-                                    d[addr] = set()
-                                d[addr].add((ser, v))
-                            return
+                item = self._txo_index.get((prevout_hash, prevout_n))
+                if item is None:
+                    return
+                addr, v, is_cb = item
+                if addr and self.is_mine(addr):
+                    if d.get(addr) is None:
+                        d[addr] = set()
+                    d[addr].add((ser, v))
             self.txi[tx_hash] = d = {}
             for txi in tx.inputs():
                 if txi['type'] == 'coinbase':
@@ -900,9 +1199,10 @@ class Abstract_Wallet(PrintError):
                 prevout_hash = txi['prevout_hash']
                 prevout_n = txi['prevout_n']
                 ser = prevout_hash + ':%d' % prevout_n
-                self.spent_outpoints[prevout_hash][prevout_n] = tx_hash
+                self._add_spent_outpoint(prevout_hash, prevout_n, tx_hash)
                 add_value_from_prev_output()
             # add outputs
+            self._remove_tx_from_txo_index(tx_hash)
             self.txo[tx_hash] = d = {}
             for n, txo in enumerate(tx.outputs()):
                 v = txo[2]
@@ -912,6 +1212,7 @@ class Abstract_Wallet(PrintError):
                     if d.get(addr) is None:
                         d[addr] = []
                     d[addr].append((n, v, is_coinbase))
+                    self._txo_index[(tx_hash, n)] = (addr, v, is_coinbase)
                     # give v to txi that spends me
                     next_tx = self.spent_outpoints[tx_hash].get(n)
                     if next_tx is not None:
@@ -920,32 +1221,42 @@ class Abstract_Wallet(PrintError):
                             dd[addr] = set()
                         if (ser, v) not in dd[addr]:
                             dd[addr].add((ser, v))
+                            self._dirty_txids.add(next_tx)
+                            self._spend_utxo(addr, ser)
+                            self._invalidate_tx(next_tx)
                         self._add_tx_to_local_history(next_tx)
+            self._add_tx_to_utxos(tx_hash)
             # add to local history
             self._add_tx_to_local_history(tx_hash)
             # save
             self.transactions[tx_hash] = tx
+            self._dirty_txids.add(tx_hash)
             return True
 
+    def _add_spent_outpoint(self, prevout_hash, prevout_n, tx_hash):
+        d = self.spent_outpoints[prevout_hash]
+        old = d.get(prevout_n)
+        if old is not None and old != tx_hash:
+            outpoints = self._spent_by.get(old)
+            if outpoints:
+                outpoints.discard((prevout_hash, prevout_n))
+                if not outpoints:
+                    self._spent_by.pop(old)
+        d[prevout_n] = tx_hash
+        self._dirty_txids.add(prevout_hash)
+        self._spent_by.setdefault(tx_hash, set()).add((prevout_hash, prevout_n))
+
     def remove_transaction(self, tx_hash):
         def remove_from_spent_outpoints():
-            # undo spends in spent_outpoints
-            if tx is not None:  # if we have the tx, this branch is faster
-                for txin in tx.inputs():
-                    if txin['type'] == 'coinbase':
-                        continue
-                    prevout_hash = txin['prevout_hash']
-                    prevout_n = txin['prevout_n']
-                    self.spent_outpoints[prevout_hash].pop(prevout_n, None)
-                    if not self.spent_outpoints[prevout_hash]:
-                        self.spent_outpoints.pop(prevout_hash)
-            else:  # expensive but always works
-                for prevout_hash, d in list(self.spent_outpoints.items()):
-                    for prevout_n, spending_txid in d.items():
-                        if spending_txid == tx_hash:
-                            self.spent_outpoints[prevout_hash].pop(prevout_n, None)
-                            if not self.spent_outpoints[prevout_hash]:
-                                self.spent_outpoints.pop(prevout_hash)
+            # undo spends in spent_outpoints; this works without the tx
+            for prevout_hash, prevout_n in self._spent_by.pop(tx_hash, ()):
+                d = self.spent_outpoints.get(prevout_hash)
+                if d is None or d.get(prevout_n) != tx_hash:
+                    continue
+                d.pop(prevout_n)
+                self._dirty_txids.add(prevout_hash)
+                if not d:
+                    self.spent_outpoints.pop(prevout_hash)
             # Remove this tx itself; if nothing spends from it.
             # It is not so clear what to do if other txns spend from it, but it will be
             # removed when those other txns are removed.
@@ -954,9 +1265,12 @@ class Abstract_Wallet(PrintError):
 
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
-            tx = self.transactions.pop(tx_hash, None)
+            self._dirty_txids.add(tx_hash)
+            self.transactions.pop(tx_hash, None)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
+            self._remove_tx_from_utxos(tx_hash)
+            self._remove_tx_from_txo_index(tx_hash)
             self.txi.pop(tx_hash, None)
             self.txo.pop(tx_hash, None)
 
@@ -972,9 +1286,11 @@ class Abstract_Wallet(PrintError):
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.verified_tx.pop(tx_hash, None)
+                    self._invalidate_tx(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.history[addr] = hist
+            self._dirty_addresses.add(addr)
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -987,11 +1303,157 @@ class Abstract_Wallet(PrintError):
 
         # Store fees
         self.tx_fees.update(tx_fees)
+        self._dirty_txids.update(tx_fees)
+
+    def _reset_history(self):
+        # history of the whole wallet, in the order of get_txpos: (txpos, txid)
+        # keys, and the delta and running balance of each tx
+        self._history_keys = []
+        self._history_deltas = []
+        self._history_balances = []
+        # the running balances are valid before this index
+        self._history_clean = 0
+        self._history_key = {}  # txid -> key
+        # txs to (re)insert
+        self._history_stale = set(itertools.chain(self.txi, self.txo))
+
+    def _get_wallet_tx_delta(self, txid):
+        """Effect of tx on the wallet, None if it is not in the wallet history."""
+        delta = None
+        for addr, d in self.txi.get(txid, {}).items():
+            if self.is_mine(addr):
+                delta = (delta or 0) - sum(v for n, v in d)
+        for addr, d in self.txo.get(txid, {}).items():
+            if self.is_mine(addr):
+                delta = (delta or 0) + sum(v for n, v, cb in d)
+        return delta
+
+    def _update_history(self):
+        if len(self._history_stale) > 64 + len(self._history_keys) // 8:
+            self._rebuild_history()
+            return
+        keys = self._history_keys
+        for txid in self._history_stale:
+            key = self._history_key.pop(txid, None)
+            if key is not None:
+                i = bisect.bisect_left(keys, key)
+                del keys[i], self._history_deltas[i], self._history_balances[i]
+                self._history_clean = min(self._history_clean, i)
+            delta = self._get_wallet_tx_delta(txid)
+            if delta is None:
+                continue
+            key = self._history_key[txid] = (self.get_txpos(txid), txid)
+            i = bisect.bisect_left(keys, key)
+            keys.insert(i, key)
+            self._history_deltas.insert(i, delta)
+            self._history_balances.insert(i, None)
+            self._history_clean = min(self._history_clean, i)
+        self._history_stale.clear()
+
+    def _rebuild_history(self):
+        # one sort instead of inserting many txs one at a time
+        stale = self._history_stale
+        entries = [(key, delta) for key, delta in zip(self._history_keys, self._history_deltas)
+                   if key[1] not in stale]
+        for txid in stale:
+            self._history_key.pop(txid, None)
+            delta = self._get_wallet_tx_delta(txid)
+            if delta is None:
+                continue
+            key = self._history_key[txid] = (self.get_txpos(txid), txid)
+            entries.append((key, delta))
+        entries.sort()
+        self._history_keys = [key for key, delta in entries]
+        self._history_deltas = [delta for key, delta in entries]
+        self._history_balances = [None] * len(entries)
+        self._history_clean = 0
+        stale.clear()
+
+    def _update_history_balances(self, end):
+        i = self._history_clean
+        balance = self._history_balances[i - 1] if i else 0
+        for i in range(i, end):
+            balance += self._history_deltas[i]
+            self._history_balances[i] = balance
+        self._history_clean = max(self._history_clean, end)
+
+    def get_history_page(self, offset=0, limit=None, from_timestamp=None, to_timestamp=None, newest_first=False):
+        """Part of the history of the whole wallet, in the format of
+        get_history. Transactions without a timestamp are taken as
+        happening now. Only the requested items are built."""
+        with self.lock, self.transaction_lock:
+            self._update_history()
+            indexes = range(len(self._history_keys))
+            if from_timestamp is not None or to_timestamp is not None:
+                indexes = self._get_history_indexes_in_range(from_timestamp, to_timestamp)
+            if newest_first:
+                indexes = indexes[::-1]
+            indexes = indexes[offset:None if limit is None else offset + limit]
+            if not indexes:
+                return []
+            self._update_history_balances(max(indexes[0], indexes[-1]) + 1)
+            out = []
+            for i in indexes:
+                tx_hash = self._history_keys[i][1]
+                height, conf, timestamp = self.get_tx_height(tx_hash)
+                out.append((tx_hash, height, conf, timestamp, self._history_deltas[i], self._history_balances[i]))
+            return out
+
+    def _get_history_indexes_in_range(self, from_timestamp, to_timestamp):
+        # The history is sorted by height, and so, nearly, by block
+        # timestamp: verified txs are located by bisection, and only
+        # checked one by one near the bounds. Txs that are not verified
+        # are taken as happening now; they are few, and checked one by one.
+        keys = self._history_keys
+        now = time.time()
+        def in_range(i):
+            timestamp = self.get_tx_height(keys[i][1])[2] or now
+            return (from_timestamp is None or timestamp >= from_timestamp) \
+                   and (to_timestamp is None or timestamp < to_timestamp)
+        # unconfirmed and local txs are at the end, see get_txpos
+        tail = bisect.bisect_left(keys, ((1e9, 0),))
+        unverified = set(range(tail, len(keys)))
+        for txid in self.unverified_tx:
+            key = self._history_key.get(txid)
+            if key is not None:
+                unverified.add(bisect.bisect_left(keys, key))
+        def bisect_timestamp(timestamp):
+            # first verified tx of the history at or after timestamp
+            lo, hi = 0, tail
+            while lo < hi:
+                mid = j = (lo + hi) // 2
+                while j < hi and keys[j][1] not in self.verified_tx:
+                    j += 1
+                if j < hi and (self.verified_tx[keys[j][1]][1] or now) < timestamp:
+                    lo = j + 1
+                else:
+                    hi = mid
+            return lo
+        if from_timestamp is None:
+            start = inner_start = 0
+        else:
+            start = bisect_timestamp(from_timestamp - BLOCK_TIMESTAMP_MARGIN)
+            inner_start = bisect_timestamp(from_timestamp + BLOCK_TIMESTAMP_MARGIN)
+        if to_timestamp is None:
+            end = inner_end = tail
+        else:
+            end = bisect_timestamp(to_timestamp + BLOCK_TIMESTAMP_MARGIN)
+            inner_end = max(inner_start, bisect_timestamp(to_timestamp - BLOCK_TIMESTAMP_MARGIN))
+        inner_start = min(inner_start, inner_end)
+        checked = itertools.chain(range(start, inner_start), range(inner_end, end), unverified)
+        indexes = set(range(inner_start, inner_end)).difference(unverified)
+        indexes.update(filter(in_range, checked))
+        return sorted(indexes)
 
     def get_history(self, domain=None):
-        # get domain
         if domain is None:
-            domain = self.get_addresses()
+            with self.lock, self.transaction_lock:
+                h = self.get_history_page()
+                # fixme: this may happen if history is incomplete
+                if (h[-1][5] if h else 0) != sum(self.get_balance()):
+                    self.print_error("Error: history not synchronized")
+                    return []
+                return h
         domain = set(domain)
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
@@ -1042,20 +1504,46 @@ class Abstract_Wallet(PrintError):
         return balance
 
     @profiler
-    def get_full_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None, show_addresses=False):
+    def get_full_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None, show_addresses=False,
+                         offset=0, limit=None):
+        summary = {}
+        out = list(self.iter_full_history(domain, from_timestamp, to_timestamp, fx, show_addresses,
+                                          offset, limit, summary))
+        return {
+            'transactions': out,
+            'summary': summary
+        }
+
+    def _get_history_and_cost_basis(self, domain, from_timestamp, to_timestamp, fx, offset, limit):
+        # both under one lock, so that every tx of the page has a fiat value
+        with self.lock, self.transaction_lock:
+            cost_basis = None
+            if fx and fx.is_enabled():
+                cost_basis = self.get_cost_basis(domain, fx.timestamp_rate, fx.ccy, fx.get_cost_basis_method())
+            if domain is None:
+                h = self.get_history_page(offset, limit, from_timestamp or None, to_timestamp or None)
+            else:
+                h = [item for item in self.get_history(domain)
+                     if not (from_timestamp and (item[3] or time.time()) < from_timestamp)
+                     and not (to_timestamp and (item[3] or time.time()) >= to_timestamp)]
+                h = h[offset:None if limit is None else offset + limit]
+            return h, cost_basis
+
+    def iter_full_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None, show_addresses=False,
+                          offset=0, limit=None, summary=None):
+        """Like get_full_history, but yields the items one at a time. The
+        summary dict, if given, is filled in once all items were yielded."""
         from .util import timestamp_to_datetime, Satoshis, Fiat
-        out = []
+        start_balance = end_balance = None
         income = 0
         expenditures = 0
         capital_gains = Decimal(0)
         fiat_income = Decimal(0)
         fiat_expenditures = Decimal(0)
-        h = self.get_history(domain)
+        h, cost_basis = self._get_history_and_cost_basis(domain, from_timestamp, to_timestamp, fx,
+                                                         offset, limit)
+        count = 0
         for tx_hash, height, conf, timestamp, value, balance in h:
-            if from_timestamp and (timestamp or time.time()) < from_timestamp:
-                continue
-            if to_timestamp and (timestamp or time.time()) >= to_timestamp:
-                continue
             item = {
                 'txid':tx_hash,
                 'height':height,
@@ -1073,21 +1561,22 @@ class Abstract_Wallet(PrintError):
             # value may be None if wallet is not fully synchronized
             if value is None:
                 continue
+            if count == 0:
+                start_balance = None if balance is None else balance - value
+            count += 1
+            end_balance = balance
             # fixme: use in and out values
             if value < 0:
                 expenditures += -value
             else:
                 income += value
             # fiat computations
-            if fx and fx.is_enabled():
-                date = timestamp_to_datetime(timestamp)
-                fiat_value = self.get_fiat_value(tx_hash, fx.ccy)
-                fiat_default = fiat_value is None
-                fiat_value = fiat_value if fiat_value is not None else value / Decimal(COIN) * self.price_at_timestamp(tx_hash, fx.timestamp_rate)
+            if cost_basis:
+                fiat_value, fiat_default = cost_basis.fiat_values[tx_hash]
                 item['fiat_value'] = Fiat(fiat_value, fx.ccy)
                 item['fiat_default'] = fiat_default
                 if value < 0:
-                    acquisition_price = - value / Decimal(COIN) * self.average_price(tx_hash, fx.timestamp_rate, fx.ccy)
+                    acquisition_price = cost_basis.acquisition_prices[tx_hash]
                     liquidation_price = - fiat_value
                     item['acquisition_price'] = Fiat(acquisition_price, fx.ccy)
                     cg = liquidation_price - acquisition_price
@@ -1096,42 +1585,34 @@ class Abstract_Wallet(PrintError):
                     fiat_expenditures += -fiat_value
                 else:
                     fiat_income += fiat_value
-            out.append(item)
+            yield item
         # add summary
-        if out:
-            b, v = out[0]['balance'].value, out[0]['value'].value
-            start_balance = None if b is None or v is None else b - v
-            end_balance = out[-1]['balance'].value
-            if from_timestamp is not None and to_timestamp is not None:
-                start_date = timestamp_to_datetime(from_timestamp)
-                end_date = timestamp_to_datetime(to_timestamp)
-            else:
-                start_date = None
-                end_date = None
-            summary = {
-                'start_date': start_date,
-                'end_date': end_date,
-                'start_balance': Satoshis(start_balance),
-                'end_balance': Satoshis(end_balance),
-                'income': Satoshis(income),
-                'expenditures': Satoshis(expenditures)
-            }
-            if fx and fx.is_enabled():
-                unrealized = self.unrealized_gains(domain, fx.timestamp_rate, fx.ccy)
-                summary['capital_gains'] = Fiat(capital_gains, fx.ccy)
-                summary['fiat_income'] = Fiat(fiat_income, fx.ccy)
-                summary['fiat_expenditures'] = Fiat(fiat_expenditures, fx.ccy)
-                summary['unrealized_gains'] = Fiat(unrealized, fx.ccy)
-                summary['start_fiat_balance'] = Fiat(fx.historical_value(start_balance, start_date), fx.ccy)
-                summary['end_fiat_balance'] = Fiat(fx.historical_value(end_balance, end_date), fx.ccy)
-                summary['start_fiat_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
-                summary['end_fiat_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
+        if summary is None or count == 0:
+            return
+        if from_timestamp is not None and to_timestamp is not None:
+            start_date = timestamp_to_datetime(from_timestamp)
+            end_date = timestamp_to_datetime(to_timestamp)
         else:
-            summary = {}
-        return {
-            'transactions': out,
-            'summary': summary
-        }
+            start_date = None
+            end_date = None
+        summary.update({
+            'start_date': start_date,
+            'end_date': end_date,
+            'start_balance': Satoshis(start_balance),
+            'end_balance': Satoshis(end_balance),
+            'income': Satoshis(income),
+            'expenditures': Satoshis(expenditures)
+        })
+        if cost_basis:
+            unrealized = cost_basis.unrealized_gains
+            summary['capital_gains'] = Fiat(capital_gains, fx.ccy)
+            summary['fiat_income'] = Fiat(fiat_income, fx.ccy)
+            summary['fiat_expenditures'] = Fiat(fiat_expenditures, fx.ccy)
+            summary['unrealized_gains'] = Fiat(unrealized, fx.ccy)
+            summary['start_fiat_balance'] = Fiat(fx.historical_value(start_balance, start_date), fx.ccy)
+            summary['end_fiat_balance'] = Fiat(fx.historical_value(end_balance, end_date), fx.ccy)
+            summary['start_fiat_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
+            summary['end_fiat_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
 
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash, '')
@@ -1319,7 +1800,7 @@ class Abstract_Wallet(PrintError):
             self.storage.put('stored_height', self.get_local_height())
         self.save_transactions()
         self.save_verified_tx()
-        self.storage.write()
+        self.storage.flush()
 
     def wait_until_synchronized(self, callback=None):
         def wait_for_wallet():
@@ -1709,6 +2190,7 @@ class Abstract_Wallet(PrintError):
     def add_address(self, address):
         if address not in self.history:
             self.history[address] = []
+            self._dirty_addresses.add(address)
         if self.synchronizer:
             self.synchronizer.add(address)
 
@@ -1785,21 +2267,23 @@ class Abstract_Wallet(PrintError):
     def get_depending_transactions(self, tx_hash):
         """Returns all (grand-)children of tx_hash in this wallet."""
         children = set()
-        # TODO rewrite this to use self.spent_outpoints
-        for other_hash, tx in self.transactions.items():
-            for input in (tx.inputs()):
-                if input["prevout_hash"] == tx_hash:
-                    children.add(other_hash)
-                    children |= self.get_depending_transactions(other_hash)
+        todo = [tx_hash]
+        while todo:
+            txid = todo.pop()
+            # spent_outpoints maps the outputs of txid to the txns spending them
+            for other_hash in set(self.spent_outpoints.get(txid, {}).values()):
+                if other_hash in children or other_hash not in self.transactions:
+                    continue
+                children.add(other_hash)
+                todo.append(other_hash)
         return children
 
     def txin_value(self, txin):
         txid = txin['prevout_hash']
         prev_n = txin['prevout_n']
-        for address, d in self.txo.get(txid, {}).items():
-            for n, v, cb in d:
-                if n == prev_n:
-                    return v
+        item = self._txo_index.get((txid, prev_n))
+        if item is not None:
+            return item[1]
         # may occur if wallet is not synchronized
         return None
 
@@ -1808,46 +2292,21 @@ class Abstract_Wallet(PrintError):
         height, conf, timestamp = self.get_tx_height(txid)
         return price_func(timestamp if timestamp else time.time())
 
-    def unrealized_gains(self, domain, price_func, ccy):
-        coins = self.get_utxos(domain)
-        now = time.time()
-        p = price_func(now)
-        ap = sum(self.coin_price(coin['prevout_hash'], price_func, ccy, self.txin_value(coin)) for coin in coins)
-        lp = sum([coin['value'] for coin in coins]) * p / Decimal(COIN)
-        return lp - ap
-
-    def average_price(self, txid, price_func, ccy):
-        """ Average acquisition price of the inputs of a transaction """
-        input_value = 0
-        total_price = 0
-        for addr, d in self.txi.get(txid, {}).items():
-            for ser, v in d:
-                input_value += v
-                total_price += self.coin_price(ser.split(':')[0], price_func, ccy, v)
-        return total_price / (input_value/Decimal(COIN))
+    def get_cost_basis(self, domain, price_func, ccy, method=AVERAGE):
+        """Acquisition prices and unrealized gains of the history of domain,
+        computed in one pass. See cost_basis.CostBasis."""
+        cost_basis = CostBasis(self, price_func, ccy, method)
+        if domain is not None:
+            history = [(item[0], item[4]) for item in self.get_history(domain)]
+            return cost_basis.run(history, self.get_utxos(domain))
+        with self.lock, self.transaction_lock:
+            # read the maintained history in place
+            self._update_history()
+            history = zip((key[1] for key in self._history_keys), self._history_deltas)
+            return cost_basis.run(history, self.get_utxos(), self._history_key.__contains__)
 
-    def coin_price(self, txid, price_func, ccy, txin_value):
-        """
-        Acquisition price of a coin.
-        This assumes that either all inputs are mine, or no input is mine.
-        """
-        if txin_value is None:
-            return Decimal('NaN')
-        cache_key = "{}:{}:{}".format(str(txid), str(ccy), str(txin_value))
-        result = self.coin_price_cache.get(cache_key, None)
-        if result is not None:
-            return result
-        if self.txi.get(txid, {}) != {}:
-            result = self.average_price(txid, price_func, ccy) * txin_value/Decimal(COIN)
-            self.coin_price_cache[cache_key] = result
-            return result
-        else:
-            fiat_value = self.get_fiat_value(txid, ccy)
-            if fiat_value is not None:
-                return fiat_value
-            else:
-                p = self.price_at_timestamp(txid, price_func)
-                return p * txin_value/Decimal(COIN)
+    def unrealized_gains(self, domain, price_func, ccy):
+        return self.get_cost_basis(domain, price_func, ccy).unrealized_gains
 
     def is_billing_address(self, addr):
         # overloaded for TrustedCoin wallets
@@ -1971,6 +2430,7 @@ class Imported_Wallet(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self.history.pop(address, None)
+            self._dirty_addresses.add(address)
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
@@ -1987,6 +2447,9 @@ class Imported_Wallet(Simple_Wallet):
 
         pubkey = self.get_public_key(address)
         self.addresses.pop(address)
+        # no longer part of the wallet balance and history
+        self._balances_dirty.add(address)
+        self._history_stale.update(self._history_local.get(address, ()))
         if pubkey:
             # delete key iff no other address uses it (e.g. p2pkh and p2wpkh for same key)
             for txin_type in bitcoin.WIF_SCRIPT_TYPES.keys():
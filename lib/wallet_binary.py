@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+'''Binary wallet file format.
+
+The file is a header followed by records:
+
+    header:  MAGIC, version (uint16)
+    record:  type (uint8), length (uint32), payload
+
+Generic keys are stored in a KEY_VALUE record holding the key and its
+JSON value. Each of the per-transaction structures is stored in a record
+of its own type, as packed arrays with txids as 32 raw bytes and
+transactions as raw bytes. A value that does not fit its record type is
+stored as JSON instead, so the conversion is lossless for any wallet.
+
+All integers are little-endian. Strings are utf-8, prefixed with their
+length as uint16.
+'''
+import json
+import re
+import struct
+from collections.abc import Mapping
+
+from . import util
+from .util import WalletFileException
+
+
+MAGIC = b'ELECTRUM-WALLET\x00'
+VERSION = 1
+
+(KEY_VALUE, TRANSACTIONS, TX_FEES, VERIFIED_TX, ADDR_HISTORY,
+ TXI, TXO, SPENT_OUTPOINTS) = range(8)
+
+HEADER = struct.Struct('<%dsH' % len(MAGIC))
+RECORD = struct.Struct('<BI')
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+# number of strings, length in bytes
+STRINGS_HEADER = struct.Struct('<II')
+TX_ITEM = struct.Struct('<32sI')
+FEE_ITEM = struct.Struct('<32sq')
+VERIFIED_ITEM = struct.Struct('<32sqqq')
+HISTORY_ITEM = struct.Struct('<32sq')
+TXI_ITEM = struct.Struct('<32sIq')
+TXO_ITEM = struct.Struct('<Iq?')
+SPENT_ITEM = struct.Struct('<32sI32s')
+
+OUTPUT_INDEX = re.compile('0|[1-9][0-9]{0,9}')
+
+
+def is_binary_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class NotEncodable(Exception):
+    '''A value does not fit the record type of its key.'''
+
+
+# The encoders take values as they are in memory, and raise NotEncodable
+# for anything json.dumps would not turn into what the decoder returns.
+# Such values are stored as JSON; any other error is a bug.
+
+def hex_bytes(s):
+    if type(s) is not str:
+        raise NotEncodable('not a string: %r' % (s,))
+    try:
+        b = bytes.fromhex(s)
+    except ValueError:
+        raise NotEncodable('not hex')
+    # fromhex also takes upper case and whitespace
+    if b.hex() != s:
+        raise NotEncodable('not lower case hex')
+    return b
+
+
+def txid_bytes(txid):
+    b = hex_bytes(txid)
+    if len(b) != 32:
+        raise NotEncodable('not a txid: %r' % txid)
+    return b
+
+
+def check_int(x):
+    if type(x) is not int or not -(1 << 63) <= x < 1 << 63:
+        raise NotEncodable('not an int64: %r' % (x,))
+    return x
+
+
+def check_uint32(x):
+    if type(x) is not int or not 0 <= x < 1 << 32:
+        raise NotEncodable('not a uint32: %r' % (x,))
+    return x
+
+
+def output_index(n):
+    '''n, or the int it stands for as a dict key'''
+    if type(n) is str and OUTPUT_INDEX.fullmatch(n):
+        n = int(n)
+    return check_uint32(n)
+
+
+def items(d):
+    # dict subclasses too, such as the defaultdicts of the wallet
+    if not isinstance(d, Mapping):
+        raise NotEncodable('not a dict')
+    return d.items()
+
+
+def check_tuple(x, n):
+    '''x, if it is a list or tuple of n values'''
+    if type(x) not in (list, tuple) or len(x) != n:
+        raise NotEncodable('not a list of %d: %r' % (n, x))
+    return x
+
+
+def pack_str(s):
+    b = s.encode('utf8')
+    return U16.pack(len(b)) + b
+
+
+def unpack_str(b, offset):
+    n, = U16.unpack_from(b, offset)
+    offset += U16.size
+    return str(b[offset:offset + n], 'utf8'), offset + n
+
+
+def pack_strings(strings):
+    '''A table of strings, none of which may contain NUL.'''
+    if any(type(x) is not str for x in strings):
+        raise NotEncodable('not a string')
+    try:
+        b = '\0'.join(strings).encode('utf8')
+    except UnicodeEncodeError:
+        raise NotEncodable('not utf8')
+    if b.count(b'\0') != max(len(strings) - 1, 0):
+        raise NotEncodable('string with NUL')
+    return U32.pack(len(strings)) + U32.pack(len(b)) + b
+
+
+def unpack_strings(b, offset):
+    count, n = STRINGS_HEADER.unpack_from(b, offset)
+    offset += STRINGS_HEADER.size
+    strings = str(b[offset:offset + n], 'utf8').split('\0') if count else []
+    if len(strings) != count:
+        raise ValueError('bad string table')
+    return strings, offset + n
+
+
+def pack_array(values):
+    return U32.pack(len(values)) + struct.pack('<%dI' % len(values), *values)
+
+
+def unpack_array(b, offset):
+    count, = U32.unpack_from(b, offset)
+    offset += U32.size
+    return struct.unpack_from('<%dI' % count, b, offset), offset + 4 * count
+
+
+def split_list(l, counts):
+    '''Split l into consecutive lists of the given lengths.'''
+    if sum(counts) != len(l):
+        raise ValueError('bad item count')
+    i = 0
+    for n in counts:
+        yield l[i:i + n]
+        i += n
+
+
+def check_list(l):
+    if type(l) not in (list, tuple, set):
+        raise NotEncodable('not a list')
+    return l
+
+
+def encode_transactions(d):
+    parts = []
+    for txid, raw in items(d):
+        raw = hex_bytes(raw)
+        parts.append(TX_ITEM.pack(txid_bytes(txid), len(raw)))
+        parts.append(raw)
+    return b''.join(parts)
+
+def decode_transactions(b):
+    d = {}
+    offset = 0
+    unpack_from, size = TX_ITEM.unpack_from, TX_ITEM.size
+    while offset < len(b):
+        txid, n = unpack_from(b, offset)
+        offset += size
+        d[txid.hex()] = b[offset:offset + n].hex()
+        offset += n
+    return d
+
+
+def encode_tx_fees(d):
+    return b''.join(FEE_ITEM.pack(txid_bytes(txid), check_int(fee)) for txid, fee in items(d))
+
+def decode_tx_fees(b):
+    return {txid.hex(): fee for txid, fee in FEE_ITEM.iter_unpack(b)}
+
+
+def encode_verified_tx(d):
+    parts = []
+    for txid, item in items(d):
+        height, timestamp, pos = check_tuple(item, 3)
+        parts.append(VERIFIED_ITEM.pack(txid_bytes(txid), check_int(height), check_int(timestamp), check_int(pos)))
+    return b''.join(parts)
+
+def decode_verified_tx(b):
+    return {txid.hex(): [height, timestamp, pos] for txid, height, timestamp, pos in VERIFIED_ITEM.iter_unpack(b)}
+
+
+def encode_addr_history(d):
+    addrs, counts, rows = [], [], []
+    for addr, hist in items(d):
+        if type(hist) is set:
+            raise NotEncodable('not a list')
+        addrs.append(addr)
+        counts.append(len(check_list(hist)))
+        for item in hist:
+            txid, height = check_tuple(item, 2)
+            rows.append(HISTORY_ITEM.pack(txid_bytes(txid), check_int(height)))
+    return pack_strings(addrs) + pack_array(counts) + b''.join(rows)
+
+def decode_addr_history(b):
+    addrs, offset = unpack_strings(b, 0)
+    counts, offset = unpack_array(b, offset)
+    rows = [[txid.hex(), height] for txid, height in HISTORY_ITEM.iter_unpack(b[offset:])]
+    return dict(zip(addrs, split_list(rows, counts)))
+
+
+def encode_addr_lists(d, encode_item):
+    '''txid -> address -> list of items, as in txi and txo.
+
+    Stored as the txids, the number of addresses of each, a table of the
+    distinct addresses, the table index and list length of each address
+    of each txid, and then all the items.
+    '''
+    txids, naddrs, table, index, pairs, counts, rows = [], [], [], {}, [], [], []
+    for txid, addrs in items(d):
+        txids.append(txid_bytes(txid))
+        naddrs.append(len(items(addrs)))
+        for addr, l in addrs.items():
+            i = index.get(addr)
+            if i is None:
+                i = index[addr] = len(table)
+                table.append(addr)
+            pairs.append(i)
+            counts.append(len(check_list(l)))
+            rows.extend(map(encode_item, l))
+    return (U32.pack(len(txids)) + b''.join(txids) + pack_array(naddrs) + pack_strings(table)
+            + pack_array(pairs) + pack_array(counts) + b''.join(rows))
+
+def decode_addr_lists(b, item, decode_items):
+    n, = U32.unpack_from(b, 0)
+    offset = U32.size + 32 * n
+    txids = b[U32.size:offset].hex()
+    naddrs, offset = unpack_array(b, offset)
+    table, offset = unpack_strings(b, offset)
+    pairs, offset = unpack_array(b, offset)
+    counts, offset = unpack_array(b, offset)
+    addrs = [table[i] for i in pairs]
+    lists = split_list(decode_items(item.iter_unpack(b[offset:])), counts)
+    d = {}
+    i = 0
+    for j, na in enumerate(naddrs):
+        d[txids[64 * j:64 * j + 64]] = {addr: next(lists) for addr in addrs[i:i + na]}
+        i += na
+    return d
+
+
+def encode_txi_item(x):
+    prevout, v = check_tuple(x, 2)
+    if type(prevout) is not str or prevout.count(':') != 1:
+        raise NotEncodable('not a prevout')
+    prevout_hash, n = prevout.split(':')
+    return TXI_ITEM.pack(txid_bytes(prevout_hash), output_index(n), check_int(v))
+
+def decode_txi_items(items):
+    return [['%s:%d' % (prevout_hash.hex(), n), v] for prevout_hash, n, v in items]
+
+
+def encode_txo_item(x):
+    n, v, is_coinbase = check_tuple(x, 3)
+    if type(is_coinbase) is not bool:
+        raise NotEncodable('not a bool')
+    return TXO_ITEM.pack(check_uint32(n), check_int(v), is_coinbase)
+
+def decode_txo_items(items):
+    return list(map(list, items))
+
+
+def encode_txi(d):
+    return encode_addr_lists(d, encode_txi_item)
+
+def decode_txi(b):
+    return decode_addr_lists(b, TXI_ITEM, decode_txi_items)
+
+
+def encode_txo(d):
+    return encode_addr_lists(d, encode_txo_item)
+
+def decode_txo(b):
+    return decode_addr_lists(b, TXO_ITEM, decode_txo_items)
+
+
+def encode_spent_outpoints(d):
+    parts = []
+    for prevout_hash, spenders in items(d):
+        # an empty dict would be lost
+        if not items(spenders):
+            raise NotEncodable('no spenders')
+        prevout_hash = txid_bytes(prevout_hash)
+        for n, spender in spenders.items():
+            parts.append(SPENT_ITEM.pack(prevout_hash, output_index(n), txid_bytes(spender)))
+    return b''.join(parts)
+
+def decode_spent_outpoints(b):
+    d = {}
+    for prevout_hash, n, spender in SPENT_ITEM.iter_unpack(b):
+        prevout_hash = prevout_hash.hex()
+        spenders = d.get(prevout_hash)
+        if spenders is None:
+            spenders = d[prevout_hash] = {}
+        spenders[str(n)] = spender.hex()
+    return d
+
+
+# key -> (record type, encoder, decoder)
+TYPED_KEYS = {
+    'transactions': (TRANSACTIONS, encode_transactions, decode_transactions),
+    'tx_fees': (TX_FEES, encode_tx_fees, decode_tx_fees),
+    'verified_tx3': (VERIFIED_TX, encode_verified_tx, decode_verified_tx),
+    'addr_history': (ADDR_HISTORY, encode_addr_history, decode_addr_history),
+    'txi': (TXI, encode_txi, decode_txi),
+    'txo': (TXO, encode_txo, decode_txo),
+    'spent_outpoints': (SPENT_OUTPOINTS, encode_spent_outpoints, decode_spent_outpoints),
+}
+DECODERS = {t: (key, decode) for key, (t, encode, decode) in TYPED_KEYS.items()}
+
+
+def encode_header():
+    return HEADER.pack(MAGIC, VERSION)
+
+
+def record(t, payload):
+    return RECORD.pack(t, len(payload)) + payload
+
+
+def encode_key(key, value):
+    '''Return the record of one top-level key.'''
+    typed = TYPED_KEYS.get(key)
+    if typed:
+        t, encode = typed[0], typed[1]
+        try:
+            return record(t, encode(value))
+        except NotEncodable:
+            pass
+    value = json.dumps(value, cls=util.MyEncoder)
+    return record(KEY_VALUE, pack_str(key) + value.encode('utf8'))
+
+
+def decode(b):
+    '''Return the data stored in a binary wallet file.'''
+    try:
+        return _decode(b)
+    except (struct.error, UnicodeDecodeError, ValueError) as e:
+        raise WalletFileException('corrupt binary wallet file: %r' % e)
+
+
+def _decode(b):
+    magic, version = HEADER.unpack_from(b, 0)
+    if magic != MAGIC:
+        raise WalletFileException('not a binary wallet file')
+    if version > VERSION:
+        raise WalletFileException('binary wallet file version %d is not supported' % version)
+    data = {}
+    offset = HEADER.size
+    while offset < len(b):
+        t, n = RECORD.unpack_from(b, offset)
+        offset += RECORD.size
+        payload = b[offset:offset + n]
+        if len(payload) != n:
+            raise WalletFileException('truncated binary wallet file')
+        offset += n
+        if t == KEY_VALUE:
+            key, i = unpack_str(payload, 0)
+            data[key] = json.loads(str(payload[i:], 'utf8'))
+        elif t in DECODERS:
+            key, decode_value = DECODERS[t]
+            data[key] = decode_value(payload)
+        else:
+            raise WalletFileException('unknown record type %d' % t)
+    return data
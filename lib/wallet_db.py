@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import json
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+from . import util
+from .util import PrintError, WalletFileException
+
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS kv_items (key TEXT, item TEXT, value TEXT NOT NULL, PRIMARY KEY (key, item));
+CREATE TABLE IF NOT EXISTS transactions (txid TEXT PRIMARY KEY, raw TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS tx_fees (txid TEXT PRIMARY KEY, fee INTEGER);
+CREATE TABLE IF NOT EXISTS verified_tx3 (txid TEXT PRIMARY KEY, height INTEGER, timestamp INTEGER, pos INTEGER);
+CREATE TABLE IF NOT EXISTS addr_history (address TEXT, pos INTEGER, txid TEXT, height INTEGER, PRIMARY KEY (address, pos));
+CREATE TABLE IF NOT EXISTS txi (txid TEXT, address TEXT, prevout TEXT, value INTEGER);
+CREATE INDEX IF NOT EXISTS txi_txid ON txi (txid);
+CREATE TABLE IF NOT EXISTS txo (txid TEXT, address TEXT, n INTEGER, value INTEGER, is_coinbase INTEGER);
+CREATE INDEX IF NOT EXISTS txo_txid ON txo (txid);
+CREATE TABLE IF NOT EXISTS spent_outpoints (prevout_hash TEXT, n INTEGER, spender TEXT, PRIMARY KEY (prevout_hash, n));
+'''
+
+
+def is_sqlite_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+class Table(object):
+    '''Maps the items of one top-level storage key to the rows of a table.
+
+    Subclasses define rows(item, value), the rows of one item, and
+    load(rows), the value of the key. Values are in the form json.loads
+    would return them. Rows are only written, and read back all at once
+    when the file is opened; the tables are indexed for item updates.
+    '''
+    name = None
+    item_column = 'txid'
+    columns = ()
+
+
+class TransactionsTable(Table):
+    name = 'transactions'
+    columns = ('txid', 'raw')
+
+    def rows(self, txid, raw):
+        return [(txid, raw)]
+
+    def load(self, rows):
+        return {txid: raw for txid, raw in rows}
+
+
+class FeesTable(Table):
+    name = 'tx_fees'
+    columns = ('txid', 'fee')
+
+    def rows(self, txid, fee):
+        return [(txid, fee)]
+
+    def load(self, rows):
+        return {txid: fee for txid, fee in rows}
+
+
+class VerifiedTable(Table):
+    name = 'verified_tx3'
+    columns = ('txid', 'height', 'timestamp', 'pos')
+
+    def rows(self, txid, v):
+        height, timestamp, pos = v
+        return [(txid, height, timestamp, pos)]
+
+    def load(self, rows):
+        return {txid: [height, timestamp, pos] for txid, height, timestamp, pos in rows}
+
+
+class HistoryTable(Table):
+    name = 'addr_history'
+    item_column = 'address'
+    columns = ('address', 'pos', 'txid', 'height')
+
+    def rows(self, address, hist):
+        return [(address, i, txid, height) for i, (txid, height) in enumerate(hist)]
+
+    def load(self, rows):
+        d = {}
+        for address, pos, txid, height in sorted(rows, key=lambda r: r[:2]):
+            d.setdefault(address, []).append([txid, height])
+        return d
+
+
+class TxiTable(Table):
+    name = 'txi'
+    columns = ('txid', 'address', 'prevout', 'value')
+
+    def rows(self, txid, d):
+        return [(txid, addr, prevout, v) for addr, l in d.items() for prevout, v in l]
+
+    def load(self, rows):
+        d = {}
+        for txid, addr, prevout, v in rows:
+            d.setdefault(txid, {}).setdefault(addr, []).append([prevout, v])
+        return d
+
+
+class TxoTable(Table):
+    name = 'txo'
+    columns = ('txid', 'address', 'n', 'value', 'is_coinbase')
+
+    def rows(self, txid, d):
+        return [(txid, addr, n, v, is_cb) for addr, l in d.items() for n, v, is_cb in l]
+
+    def load(self, rows):
+        d = {}
+        for txid, addr, n, v, is_cb in rows:
+            d.setdefault(txid, {}).setdefault(addr, []).append([n, v, bool(is_cb)])
+        return d
+
+
+class SpentOutpointsTable(Table):
+    name = 'spent_outpoints'
+    item_column = 'prevout_hash'
+    columns = ('prevout_hash', 'n', 'spender')
+
+    def rows(self, prevout_hash, d):
+        return [(prevout_hash, int(n), spender) for n, spender in d.items()]
+
+    def load(self, rows):
+        d = {}
+        for prevout_hash, n, spender in rows:
+            d.setdefault(prevout_hash, {})[str(n)] = spender
+        return d
+
+
+TABLES = {t.name: t for t in (TransactionsTable(), FeesTable(), VerifiedTable(), HistoryTable(),
+                              TxiTable(), TxoTable(), SpentOutpointsTable())}
+
+
+class TransactionsView(MutableMapping):
+    '''The transactions table as a dict txid -> raw hex, queried by txid.
+
+    The raw transactions are the bulk of a wallet file; they are not
+    loaded. Changes are made in the database at once, and committed by
+    the next write of the storage.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+
+    def _execute(self, sql, args=()):
+        with self.db.lock:
+            return self.db.conn.execute(sql, args).fetchall()
+
+    def __getitem__(self, txid):
+        r = self._execute('SELECT raw FROM transactions WHERE txid=?', (txid,))
+        if not r:
+            raise KeyError(txid)
+        return r[0][0]
+
+    def __setitem__(self, txid, raw):
+        self._execute('INSERT OR REPLACE INTO transactions VALUES (?, ?)', (txid, raw))
+
+    def __delitem__(self, txid):
+        if txid not in self:
+            raise KeyError(txid)
+        self._execute('DELETE FROM transactions WHERE txid=?', (txid,))
+
+    def __contains__(self, txid):
+        return bool(self._execute('SELECT 1 FROM transactions WHERE txid=?', (txid,)))
+
+    def __iter__(self):
+        return iter([r[0] for r in self._execute('SELECT txid FROM transactions')])
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM transactions')[0][0]
+
+    def __deepcopy__(self, memo):
+        return dict(self)
+
+
+# tables that are queried instead of loaded
+VIEWS = {'transactions': TransactionsView}
+
+
+class WalletDB(PrintError):
+    '''SQLite backend of WalletStorage.
+
+    The large per-transaction structures are kept in their own tables,
+    one or more rows per item, everything else as JSON in a key-value
+    table, with the items of dicts in rows of their own. Changes are
+    applied as the item-level records WalletStorage produces, so a write
+    costs as much as the change.
+
+    The raw transactions are not loaded: load_data returns a
+    TransactionsView for them, which the wallet queries by txid.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        # the storage lock serializes access
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # the storage lock serializes everything but the views
+        self.lock = threading.RLock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def load_data(self):
+        with self.lock:
+            data = {}
+            for key, value in self.conn.execute('SELECT key, value FROM kv'):
+                data[key] = json.loads(value)
+            for key, item, value in self.conn.execute('SELECT key, item, value FROM kv_items'):
+                data[key][item] = json.loads(value)
+            for name, table in TABLES.items():
+                # an empty dict is stored as no rows, and loads as a missing key
+                if name in VIEWS or not self._has_rows(name):
+                    continue
+                data[name] = table.load(self.conn.execute(
+                    'SELECT %s FROM %s' % (', '.join(table.columns), name)))
+            self.attach_views(data)
+            return data
+
+    def attach_views(self, data):
+        '''Replace the values of data that are kept in the database by views.'''
+        with self.lock:
+            for name, view in VIEWS.items():
+                if not isinstance(data.get(name, {}), view) and self._has_rows(name):
+                    data[name] = view(self)
+
+    def detach_views(self, data):
+        '''Load the values of data that are views, before the database is closed.'''
+        with self.lock:
+            for name, view in VIEWS.items():
+                if isinstance(data.get(name), view):
+                    data[name] = dict(data[name])
+
+    def _has_rows(self, name):
+        return self.conn.execute('SELECT 1 FROM %s LIMIT 1' % name).fetchone() is not None
+
+    def save_data(self, data):
+        '''Replace the contents of the database with data.'''
+        data = json.loads(json.dumps(data, cls=util.MyEncoder))
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM kv')
+            self.conn.execute('DELETE FROM kv_items')
+            for name in TABLES:
+                self.conn.execute('DELETE FROM %s' % name)
+            for key, value in data.items():
+                self._put(key, value)
+
+    def apply(self, records):
+        '''Apply journal records, in one database transaction. This also
+        commits the changes made through the views.'''
+        with self.lock, self.conn:
+            for record in records:
+                op, key = record[0], record[1]
+                table = TABLES.get(key)
+                if op == 'put':
+                    self._put(key, record[2])
+                elif op == 'pop':
+                    if table:
+                        self.conn.execute('DELETE FROM %s' % key)
+                    self.conn.execute('DELETE FROM kv WHERE key=?', (key,))
+                    self.conn.execute('DELETE FROM kv_items WHERE key=?', (key,))
+                elif op == 'put_item' and table is None:
+                    self.conn.execute('INSERT OR IGNORE INTO kv VALUES (?, ?)', (key, '{}'))
+                    self.conn.execute('INSERT OR REPLACE INTO kv_items VALUES (?, ?, ?)',
+                                      (key, record[2], json.dumps(record[3])))
+                elif op == 'pop_item' and table is None:
+                    self.conn.execute('DELETE FROM kv_items WHERE key=? AND item=?', (key, record[2]))
+                elif op in ('put_item', 'pop_item'):
+                    self._delete_item(table, record[2])
+                    if op == 'put_item':
+                        self._insert(table, table.rows(record[2], record[3]))
+                else:
+                    raise WalletFileException('unknown journal record: %s' % op)
+
+    def _put(self, key, value):
+        table = TABLES.get(key)
+        if table is None:
+            # a dict is stored as {} and one row per item, so that an item
+            # can be updated alone
+            self.conn.execute('DELETE FROM kv_items WHERE key=?', (key,))
+            is_dict = isinstance(value, dict)
+            self.conn.execute('INSERT OR REPLACE INTO kv VALUES (?, ?)', (key, '{}' if is_dict else json.dumps(value)))
+            if is_dict:
+                self.conn.executemany('INSERT INTO kv_items VALUES (?, ?, ?)',
+                                      [(key, item, json.dumps(v)) for item, v in value.items()])
+            return
+        self.conn.execute('DELETE FROM %s' % key)
+        for item, v in value.items():
+            self._insert(table, table.rows(item, v))
+
+    def _delete_item(self, table, item):
+        self.conn.execute('DELETE FROM %s WHERE %s=?' % (table.name, table.item_column), (item,))
+
+    def _insert(self, table, rows):
+        self.conn.executemany('INSERT INTO %s VALUES (%s)' % (table.name, ', '.join('?' * len(table.columns))), rows)